@@ -1,7 +1,22 @@
+import base64
+import json
+import os
+import time
 from datetime import datetime, timedelta
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify
+from events import ChangeFeed
+from exchange import ExchangeRates
+from metrics import SlowRequestProfiler, registry
 from models import *
-from storage import JsonDataEngine
+from money import MAX_MINOR_UNITS, format_amount, parse_amount, parse_rate
+from passwords import PasswordHasher, PasswordPoolBusy
+from reference import ReferenceData
+from reports import MAX_TOP_ACCOUNTS, BankReports
+from scheduler import PaymentScheduler
+from storage import PERIOD_PREFIX, create_data_engine
+from summaries import BalanceSummaries
+from tokens import TokenCache
+from transfers import TransferEngine, TransferError
 import jwt
 
 app = Flask(__name__)
@@ -9,72 +24,408 @@ app = Flask(__name__)
 # Secret key for JWT, change this to a strong secret in production
 JWT_SECRET_KEY = "your_jwt_secret_key"
 
-# Instantiate JsonDataEngine with the file path
-data_engine = JsonDataEngine(file_path="data.json")
+# Number of verified tokens kept so repeat requests skip the JWT signature check
+TOKEN_CACHE_SIZE = 10000
+
+# scrypt cost factor for stored passwords, and the pool that verifies them off the request threads
+PASSWORD_HASH_COST = int(os.environ.get("BANK_PASSWORD_HASH_COST", 2 ** 14))
+PASSWORD_WORKERS = int(os.environ.get("BANK_PASSWORD_WORKERS", os.cpu_count() or 1))
+PASSWORD_MAX_PENDING = 64
+
+# Maximum number of transfers accepted by /user/transactions/batch
+MAX_BATCH_TRANSFERS = 10000
+
+# Page sizes for /user/transactions and /user/messages
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+# Accounts listed per currency by /bank/<bank_id>/reports/top_accounts unless a limit is given
+DEFAULT_TOP_ACCOUNTS = 10
+
+# How long clients and shared caches may reuse /info responses before revalidating them (seconds)
+REFERENCE_MAX_AGE = 300
+
+# Longest a /user/events request waits for new events, and the SSE keep-alive interval
+MAX_EVENT_WAIT = 30
+SSE_KEEPALIVE = 15
+
+# When set, cProfile stats of the slowest N requests are kept in BANK_PROFILE_DIR (one request is profiled at a time)
+PROFILE_SLOWEST = int(os.environ.get("BANK_PROFILE_SLOWEST", 0))
+PROFILE_DIR = os.environ.get("BANK_PROFILE_DIR", "profiles")
+
+# Storage engine: "json" rewrites the whole file on every change, "journal" appends each change to data.json.journal,
+# "sqlite" keeps everything in an SQLite database (import an existing data.json with `python storage.py import-json`).
+# The JSON engines are single-process; sqlite can be shared by several workers, e.g.
+#   BANK_STORAGE_ENGINE=sqlite gunicorn --workers 4 --threads 8 app:app
+STORAGE_ENGINE = os.environ.get("BANK_STORAGE_ENGINE", "json")
+# Snapshot format of the JSON engines: "json" is readable, "binary" is compressed and columnar and loads and saves
+# faster (convert existing data with `python storage.py convert data.json data.bin --format binary`)
+SNAPSHOT_FORMAT = os.environ.get("BANK_SNAPSHOT_FORMAT", "json")
+# History segments keep each account's messages and transactions in a data file beside the snapshot, read on first
+# access; the snapshot alone is then incomplete, so they are only on by default with the binary format
+HISTORY_SEGMENTS = os.environ.get("BANK_HISTORY_SEGMENTS", "1" if SNAPSHOT_FORMAT == "binary" else "0") != "0"
+DATA_FILE = os.environ.get("BANK_DATA_FILE", "bank.db" if STORAGE_ENGINE == "sqlite" else "data.bin" if SNAPSHOT_FORMAT == "binary" else "data.json")
+
+# Group commit for the JSON engines: concurrent commits share one durable write. The window (ms) holds each write
+# open for more commits, trading latency for fewer writes; at 0 batches only form while a write is in progress
+GROUP_COMMIT = os.environ.get("BANK_GROUP_COMMIT", "1") != "0"
+GROUP_COMMIT_WINDOW_MS = float(os.environ.get("BANK_GROUP_COMMIT_WINDOW_MS", 0))
+GROUP_COMMIT_MAX = int(os.environ.get("BANK_GROUP_COMMIT_MAX", 256))
+
+# Client addresses allowed to read /metrics and /info/token_cache (comma separated); localhost only by default.
+# Behind a reverse proxy on the same host every client shares its address, so keep that proxy from forwarding them.
+METRICS_ADDRESSES = {address.strip() for address in os.environ.get("BANK_METRICS_ADDRESSES", "127.0.0.1,::1").split(",") if address.strip()}
+
+# Standing orders are run by a scheduler thread in each worker; set to 0 to leave them to other workers.
+# With several sqlite workers every one may run it: a run re-checks the order inside the write transaction.
+SCHEDULER = os.environ.get("BANK_SCHEDULER", "1") != "0"
+
+data_engine = create_data_engine(STORAGE_ENGINE, DATA_FILE, group_commit=GROUP_COMMIT, group_commit_window=GROUP_COMMIT_WINDOW_MS / 1000,
+                                 group_commit_max=GROUP_COMMIT_MAX, history_segments=HISTORY_SEGMENTS,
+                                 snapshot_format=SNAPSHOT_FORMAT)
 
 # Load data from the file
 data_engine.load_data()
 
+# Logouts are stored through the storage engine so every worker process revokes the token and a restart keeps it revoked
+token_cache = TokenCache(JWT_SECRET_KEY, data_engine.find_revoked_tokens, max_size=TOKEN_CACHE_SIZE)
+data_engine.add_listener(token_cache.on_commit)
+password_hasher = PasswordHasher(n=PASSWORD_HASH_COST, workers=PASSWORD_WORKERS, max_pending=PASSWORD_MAX_PENDING)
+
+# Serialized /info responses, rebuilt only after currencies or banks change
+reference_data = ReferenceData(data_engine)
+
+# Per-user balance summaries kept current by every commit, served with an ETag
+balance_summaries = BalanceSummaries(data_engine)
+
+# Balance, transaction and message deltas pushed to /user/events subscribers
+change_feed = ChangeFeed(data_engine)
+
+# Conversion table over every bank's published rates, rebuilt only when a rate changes
+exchange_rates = ExchangeRates(data_engine)
+
+# Bank admin reports aggregated over columns (with NumPy when it is installed), cached until a commit touches the bank
+bank_reports = BankReports(data_engine)
+
+# Transfers lock only the two accounts involved, so unrelated transfers run in parallel
+transfer_engine = TransferEngine(data_engine, exchange_rates)
+
+# Standing orders due next, kept in a heap; missed runs are caught up on at startup
+payment_scheduler = PaymentScheduler(data_engine, transfer_engine)
+if SCHEDULER:
+    payment_scheduler.start()
+
+registry.instrument(token_cache, ("verify",), "bank_token_seconds")
+registry.instrument(password_hasher, ("verify", "hash"), "bank_password_seconds")
+
+def token_cache_metrics():
+    stats = token_cache.stats()
+    yield "bank_token_cache_entries", {}, stats["size"]
+    yield "bank_token_cache_hits_total", {}, stats["hits"]
+    yield "bank_token_cache_misses_total", {}, stats["misses"]
+    yield "bank_token_cache_revoked", {}, stats["revoked"]
+
+registry.add_collector(token_cache_metrics)
+
+profiler = SlowRequestProfiler(PROFILE_DIR, PROFILE_SLOWEST) if PROFILE_SLOWEST else None
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+    g.profile = profiler.start() if profiler else None
+
+@app.after_request
+def record_request_metrics(response):
+    seconds = time.perf_counter() - g.request_start
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    registry.observe("bank_request_seconds", seconds, route=route, method=request.method)
+    registry.increment("bank_requests_total", route=route, method=request.method, status=str(response.status_code))
+    if g.profile is not None:
+        profiler.finish(g.profile, seconds, f"{request.method} {route}")
+    return response
+
+@app.before_request
+def sync_storage():
+    # Lets this worker's caches catch up with commits made by other workers before answering
+    data_engine.sync()
+
 def generate_jwt_token(user_id):
     payload = {
         "user_id": user_id,
+        "iat": time.time(),  # Issue time; also keeps two logins in the same second from sharing a token (and a logout)
         "exp": datetime.utcnow() + timedelta(days=1)  # Token expiration time
     }
     token = jwt.encode(payload, JWT_SECRET_KEY, algorithm="HS256")
     return token
 
 def verify_jwt_token(token):
-    try:
-        payload = jwt.decode(token, JWT_SECRET_KEY, algorithms=["HS256"])
-        return payload["user_id"]
-    except jwt.ExpiredSignatureError:
-        return None  # Token has expired
-    except jwt.InvalidTokenError:
-        return None  # Invalid token
+    return token_cache.verify(token)
 
-def authenticate_user():
+def bearer_token():
     token = request.headers.get("Authorization")
     if token and token.startswith("Bearer "):
-        token = token.split("Bearer ")[1]
+        return token.split("Bearer ")[1]
+    return None
+
+def authenticate_user():
+    token = bearer_token()
+    if token:
         user_id = verify_jwt_token(token)
         return user_id
     return None
 
-@app.route("/info/banks", methods=["POST"])
+def bank_admin_error(user_id, bank_id, permission):
+    # None when the user administers the bank with the given permission, otherwise the error response to send
+    bank = data_engine.find_bank_by_id(bank_id)
+    if bank is None:
+        return jsonify({"error": "Bank not found"}), 404
+    if not any(admin.user_id == user_id and admin.allows(permission) for admin in bank.admin_authentication):
+        return jsonify({"error": "User is not permitted to do this for the bank"}), 403
+    return None
+
+def internal_endpoint_error():
+    # None when the client may read operational endpoints, otherwise the error response to send
+    if request.remote_addr not in METRICS_ADDRESSES:
+        return jsonify({"error": "Not permitted from this address"}), 403
+    return None
+
+def encode_cursor(cursor):
+    if cursor is None:
+        return None
+    return base64.urlsafe_b64encode(json.dumps(cursor, separators=(",", ":")).encode()).decode()
+
+def decode_cursor(value):
+    if not value:
+        return None
+    try:
+        cursor = json.loads(base64.urlsafe_b64decode(value.encode()))
+    except ValueError:
+        raise ValueError("malformed cursor")
+    if not isinstance(cursor, dict):
+        raise ValueError("malformed cursor")
+    return cursor
+
+def parse_time(value):
+    # Normalize to the format Transaction.when is stored in so the bounds compare as strings
+    if not value:
+        return None
+    return datetime.fromisoformat(value).strftime("%Y-%m-%d %H:%M:%S.%f")
+
+def page_arguments():
+    limit = int(request.args.get("limit", DEFAULT_PAGE_SIZE))
+    if limit < 1 or limit > MAX_PAGE_SIZE:
+        raise ValueError(f"limit must be between 1 and {MAX_PAGE_SIZE}")
+    cursor = decode_cursor(request.args.get("cursor"))
+    if cursor is not None:
+        data_engine.check_cursor(cursor)
+    return limit, cursor
+
+def reference_response(name):
+    body, etag = reference_data.get(name)
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        response = app.response_class(body, mimetype="application/json")
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = f"public, max-age={REFERENCE_MAX_AGE}"
+    return response
+
+@app.route("/info/banks", methods=["GET", "POST"])
 def banks():
-    banksL = data_engine.find_banks()
-    return jsonify({"banks": banksL}), 401
+    return reference_response("banks")
 
-@app.route("/info/currencies", methods=["POST"])
+@app.route("/info/currencies", methods=["GET", "POST"])
 def currencies():
-    currenciesL = data_engine.find_currencies()
-    return jsonify({"currencies": currenciesL}), 401
+    return reference_response("currencies")
+
+@app.route("/info/exchange_rates", methods=["GET", "POST"])
+def exchange_rate_list():
+    return reference_response("exchange_rates")
+
+@app.route("/info/exchange_rates/quote")
+def exchange_rate_quote():
+    from_currency = data_engine.find_currency_by_id(request.args.get("from"))
+    to_currency = data_engine.find_currency_by_id(request.args.get("to"))
+    if not from_currency or not to_currency or from_currency is to_currency:
+        return jsonify({"error": "Invalid currencies"}), 400
+    try:
+        amount = parse_amount(request.args.get("amount", "1"), from_currency.scale)
+    except ValueError as e:
+        return jsonify({"error": f"Invalid query: {e}"}), 400
+    if amount <= 0:
+        return jsonify({"error": "Invalid query: amount must be positive"}), 400
+
+    conversion = exchange_rates.convert(from_currency, to_currency, amount)
+    if conversion is None:
+        return jsonify({"error": "No exchange rate between the chosen currencies"}), 404
+    if conversion.to_amount > MAX_MINOR_UNITS:
+        return jsonify({"error": "Invalid query: converted amount is too large"}), 400
+    return jsonify(conversion.display_json(from_currency.scale, to_currency.scale))
+
+@app.route("/bank/<bank_id>/exchange_rates", methods=["POST"])
+def publish_exchange_rate(bank_id):
+    user_id = authenticate_user()
+    if user_id:
+        error = bank_admin_error(user_id, bank_id, "exchange_rates")
+        if error:
+            return error
+
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            return jsonify({"error": "Request body must be a JSON object"}), 400
+        from_currency = data_engine.find_currency_by_id(data.get("from"))
+        to_currency = data_engine.find_currency_by_id(data.get("to"))
+        if not from_currency or not to_currency or from_currency is to_currency:
+            return jsonify({"error": "Invalid currencies"}), 400
+        # Banks quote their own currencies; rates between two other banks' currencies come from those banks
+        if bank_id not in (from_currency.bank_id, to_currency.bank_id):
+            return jsonify({"error": "A bank can only publish rates for its own currencies"}), 403
+        try:
+            rate = parse_rate(data.get("rate"))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+        data_engine.set_exchange_rate(ExchangeRate(bank_id, from_currency.currency_id, to_currency.currency_id, rate,
+                                                   datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")))
+        return jsonify({"message": "Exchange rate published"}), 200
+
+    return jsonify({"error": "User not authenticated"}), 401
+
+@app.route("/bank/<bank_id>/reports/deposits")
+def bank_deposits_report(bank_id):
+    user_id = authenticate_user()
+    if user_id:
+        error = bank_admin_error(user_id, bank_id, "reports")
+        if error:
+            return error
+
+        deposits = []
+        for currency_id, totals in bank_reports.balances(bank_id).items():
+            deposits.append({
+                "currency_id": currency_id,
+                "total": format_amount(totals["total"], data_engine.find_currency_by_id(currency_id).scale),
+                "accounts": totals["accounts"]
+            })
+        return jsonify({"deposits": deposits})
+
+    return jsonify({"error": "User not authenticated"}), 401
+
+@app.route("/bank/<bank_id>/reports/top_accounts")
+def bank_top_accounts_report(bank_id):
+    user_id = authenticate_user()
+    if user_id:
+        error = bank_admin_error(user_id, bank_id, "reports")
+        if error:
+            return error
+        try:
+            limit = int(request.args.get("limit", DEFAULT_TOP_ACCOUNTS))
+            if limit < 1 or limit > MAX_TOP_ACCOUNTS:
+                raise ValueError(f"limit must be between 1 and {MAX_TOP_ACCOUNTS}")
+        except ValueError as e:
+            return jsonify({"error": f"Invalid query: {e}"}), 400
+
+        currency_id = request.args.get("currency")
+        top_accounts = []
+        for report_currency_id, totals in bank_reports.balances(bank_id).items():
+            if currency_id is not None and report_currency_id != currency_id:
+                continue
+            scale = data_engine.find_currency_by_id(report_currency_id).scale
+            top_accounts.append({
+                "currency_id": report_currency_id,
+                "accounts": [{"account_id": account_id, "balance": format_amount(balance, scale)} for account_id, balance in totals["top"][:limit]]
+            })
+        return jsonify({"top_accounts": top_accounts})
+
+    return jsonify({"error": "User not authenticated"}), 401
+
+@app.route("/bank/<bank_id>/reports/volume")
+def bank_volume_report(bank_id):
+    user_id = authenticate_user()
+    if user_id:
+        error = bank_admin_error(user_id, bank_id, "reports")
+        if error:
+            return error
+        period = request.args.get("period", "day")
+        if period not in PERIOD_PREFIX:
+            return jsonify({"error": f"Invalid query: period must be one of {', '.join(PERIOD_PREFIX)}"}), 400
+        try:
+            since = parse_time(request.args.get("since"))
+            until = parse_time(request.args.get("until"))
+        except ValueError as e:
+            return jsonify({"error": f"Invalid query: {e}"}), 400
+
+        # Whole periods: every period the since and until times fall in is included
+        prefix = PERIOD_PREFIX[period]
+        volume = []
+        report = bank_reports.volume(bank_id, period)
+        for key in sorted(report):
+            if (since is not None and key < since[:prefix]) or (until is not None and key > until[:prefix]):
+                continue
+            for currency_id, (money_in, money_out, count) in sorted(report[key].items()):
+                scale = data_engine.find_currency_by_id(currency_id).scale
+                volume.append({"period": key, "currency_id": currency_id, "in": format_amount(money_in, scale),
+                               "out": format_amount(money_out, scale), "count": count})
+        return jsonify({"period": period, "volume": volume})
+
+    return jsonify({"error": "User not authenticated"}), 401
+
+@app.route("/metrics")
+def metrics():
+    error = internal_endpoint_error()
+    if error:
+        return error
+    return app.response_class(registry.render(), mimetype="text/plain; version=0.0.4")
+
+@app.route("/info/token_cache")
+def token_cache_stats():
+    error = internal_endpoint_error()
+    if error:
+        return error
+    return jsonify(token_cache.stats())
 
 @app.route("/user/login", methods=["POST"])
 def login():
     data = request.get_json()
 
     user = data_engine.find_user(email=data["email"])
-    if user and data["password"] == user.password:
-        jwt_token = generate_jwt_token(user.user_id)
-        return jsonify({"message": "Login successful", "jwt_token": jwt_token}), 200
+    try:
+        if password_hasher.verify(data["password"], user.password if user else None):
+            # Plaintext and outdated hashes are replaced now that the password is known
+            if password_hasher.needs_rehash(user.password):
+                data_engine.set_password(user, password_hasher.hash(data["password"]))
+            jwt_token = generate_jwt_token(user.user_id)
+            return jsonify({"message": "Login successful", "jwt_token": jwt_token}), 200
+    except PasswordPoolBusy:
+        return jsonify({"error": "Too many login attempts in progress, try again shortly"}), 503
 
     return jsonify({"error": "Invalid credentials"}), 401
 
+@app.route("/user/logout", methods=["POST"])
+def logout():
+    user_id = authenticate_user()
+    if user_id:
+        revocation = token_cache.revocation(bearer_token())
+        if revocation:
+            data_engine.mutate(revocation)
+        return jsonify({"message": "Logout successful"}), 200
+
+    return jsonify({"error": "User not authenticated"}), 401
+
 @app.route("/user/balance")
 def view_balance():
     user_id = authenticate_user()
     if user_id:
-        user_accounts = data_engine.find_user_accounts(user_id)
-        if user_accounts:
-            balances = []
-            for account in user_accounts:
-                balances.extend([{
-                    "account_id": account.account_id,
-                    "currency_id": balance.currency_id,
-                    "balance": balance.balance
-                } for balance in account.balance])
-            return jsonify({"balances": balances})
+        summary = balance_summaries.get(user_id)
+        if summary:
+            body, etag = summary
+            # Pollers that already hold the current version get an empty 304
+            if request.if_none_match.contains(etag):
+                response = app.response_class(status=304)
+            else:
+                response = app.response_class(body, mimetype="application/json")
+            response.set_etag(etag)
+            response.headers["Cache-Control"] = "private, no-cache"
+            return response
         return jsonify({"error": "User does not have any accounts"}), 400
     return jsonify({"error": "User not authenticated"}), 401
 
@@ -82,72 +433,143 @@ def view_balance():
 def make_transaction():
     user_id = authenticate_user()
     if user_id:
-        data = request.get_json()
-
-        # Validate sender and recipient accounts
-        sender_account: Account = data_engine.find_account_by_id(user_id, data["from"])
-        recipient_account: Account = data_engine.find_account_by_id(user_id, data["to"])
-
-        if not sender_account or not recipient_account:
-            return jsonify({"error": "Invalid sender or recipient account"}), 400
-
-        # Validate ownership of the sender account
-        if sender_account.owner.owner_id != user_id:
-            return jsonify({"error": "User does not own the specified sender account"}), 401
-
-        # Validate specified currency in sender and recipient accounts
-        currency = data.get("currency")
-
-        if not data_engine.find_currency_by_id(currency):
-            return jsonify({"error": "Invalid or missing currency"}), 400
-
-        # Validate if both accounts can have the chosen currency
-        if not any(balance.currency_id == currency for balance in sender_account.balance) or \
-           not any(balance.currency_id == currency for balance in recipient_account.balance):
-            return jsonify({"error": "Invalid currency for sender or recipient account"}), 400
-
-        # Validate if the user has enough balance in the sender account
-        sender_balance = next((balance.balance for balance in sender_account.balance if balance.currency_id == currency), None)
-        if not sender_balance or sender_balance < data["amount"]:
-            return jsonify({"error": "Insufficient balance in the sender account"}), 400
-
-        # Calculate new balances
-        new_sender_balance = sender_balance - data["amount"]
-        recipient_balance = next((balance.balance for balance in recipient_account.balance if balance.currency_id == currency), None)
-        if not recipient_balance:
-            return jsonify({"error": "Recipient cannot have the chosen currency"}), 500
-
-        new_recipient_balance = recipient_balance + data["amount"]
-
-        # Update balances
-        sender_account.balance = [Balance(currency_id=currency, balance=new_sender_balance)]
-        recipient_account.balance = [Balance(currency_id=currency, balance=new_recipient_balance)]
-
-        # Create a new Transaction object for the sender
-        sender_transaction = Transaction(
-            from_id=sender_account.account_id,
-            to_id=recipient_account.account_id,
-            when=datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f"),
-            currency_id=currency,
-            previous_balance=sender_balance + data["amount"],
-            new_balance=new_sender_balance
-        )
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            return jsonify({"error": "Request body must be a JSON object"}), 400
+
+        try:
+            transfer_engine.transfer(user_id, data)
+        except TransferError as e:
+            return jsonify({"error": e.message}), e.status
+
+        return jsonify({"message": "Transaction successful"}), 200
+
+    return jsonify({"error": "User not authenticated"}), 401
+
+@app.route("/user/standing_orders", methods=["GET", "POST"])
+def standing_orders():
+    user_id = authenticate_user()
+    if user_id:
+        if request.method == "POST":
+            data = request.get_json(silent=True)
+            if not isinstance(data, dict):
+                return jsonify({"error": "Request body must be a JSON object"}), 400
+            try:
+                order = payment_scheduler.create(user_id, data)
+            except TransferError as e:
+                return jsonify({"error": e.message}), e.status
+            scale = data_engine.find_currency_by_id(order.currency_id).scale
+            return jsonify({"message": "Standing order created", "standing_order": order.display_json(scale)}), 200
+
+        orders = [order.display_json(data_engine.find_currency_by_id(order.currency_id).scale)
+                  for order in data_engine.find_standing_orders(user_id)]
+        return jsonify({"standing_orders": orders}), 200
+
+    return jsonify({"error": "User not authenticated"}), 401
 
-        # Create a new Transaction object for the recipient
-        recipient_transaction = Transaction(
-            from_id=sender_account.account_id,
-            to_id=recipient_account.account_id,
-            when=datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f"),
-            currency_id=currency,
-            previous_balance=recipient_balance - data["amount"],
-            new_balance=new_recipient_balance
+@app.route("/user/standing_orders/<order_id>/cancel", methods=["POST"])
+def cancel_standing_order(order_id):
+    user_id = authenticate_user()
+    if user_id:
+        if not payment_scheduler.cancel(user_id, order_id):
+            return jsonify({"error": "Standing order not found"}), 404
+        return jsonify({"message": "Standing order cancelled"}), 200
+
+    return jsonify({"error": "User not authenticated"}), 401
+
+@app.route("/user/transactions/batch", methods=["POST"])
+def make_transactions_batch():
+    user_id = authenticate_user()
+    if user_id:
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            return jsonify({"error": "Request body must be a JSON object"}), 400
+        transfers = data.get("transfers")
+
+        if not isinstance(transfers, list) or not transfers or not all(isinstance(t, dict) for t in transfers):
+            return jsonify({"error": "Missing or invalid list of transfers"}), 400
+        if len(transfers) > MAX_BATCH_TRANSFERS:
+            return jsonify({"error": f"A batch can hold at most {MAX_BATCH_TRANSFERS} transfers"}), 400
+
+        # "atomic" applies all transfers or none, "best_effort" applies every valid transfer
+        mode = data.get("mode", "atomic")
+        if mode not in ("atomic", "best_effort"):
+            return jsonify({"error": "Invalid batch mode"}), 400
+
+        results = transfer_engine.transfer_batch(user_id, transfers, atomic=mode == "atomic")
+        applied = sum(1 for result in results if result["status"] == "applied")
+        return jsonify({"applied": applied, "results": results}), 200 if applied else 400
+
+    return jsonify({"error": "User not authenticated"}), 401
+
+@app.route("/user/transactions")
+def view_transactions():
+    user_id = authenticate_user()
+    if user_id:
+        try:
+            limit, cursor = page_arguments()
+            since = parse_time(request.args.get("since"))
+            until = parse_time(request.args.get("until"))
+        except ValueError as e:
+            return jsonify({"error": f"Invalid query: {e}"}), 400
+
+        page, next_cursor = data_engine.find_transactions(
+            user_id, limit, cursor,
+            account_id=request.args.get("account"),
+            since=since,
+            until=until,
+            currency_id=request.args.get("currency"),
+            counterparty=request.args.get("counterparty")
         )
 
-        sender_account.transactions.append(sender_transaction)
-        recipient_account.transactions.append(recipient_transaction)
-        data_engine.save_data()
+        transactions = []
+        for account_id, transaction in page:
+            scale = data_engine.find_currency_by_id(transaction.currency_id).scale
+            entry = {
+                "account_id": account_id,
+                "from": transaction.from_id,
+                "to": transaction.to_id,
+                "when": transaction.when,
+                "currency_id": transaction.currency_id,
+                "previous_balance": format_amount(transaction.previous_balance, scale),
+                "new_balance": format_amount(transaction.new_balance, scale)
+            }
+            conversion = transaction.conversion
+            if conversion is not None:
+                entry["conversion"] = conversion.display_json(data_engine.find_currency_by_id(conversion.from_currency_id).scale,
+                                                              data_engine.find_currency_by_id(conversion.to_currency_id).scale)
+            transactions.append(entry)
+        return jsonify({"transactions": transactions, "next_cursor": encode_cursor(next_cursor)})
 
-        return jsonify({"message": "Transaction successful"}), 200
+    return jsonify({"error": "User not authenticated"}), 401
+
+@app.route("/user/transactions/summary")
+def view_transaction_summary():
+    user_id = authenticate_user()
+    if user_id:
+        period = request.args.get("period", "month")
+        if period not in PERIOD_PREFIX:
+            return jsonify({"error": f"Invalid query: period must be one of {', '.join(PERIOD_PREFIX)}"}), 400
+        try:
+            since = parse_time(request.args.get("since"))
+            until = parse_time(request.args.get("until"))
+        except ValueError as e:
+            return jsonify({"error": f"Invalid query: {e}"}), 400
+
+        totals = data_engine.transaction_totals(
+            user_id, period,
+            account_id=request.args.get("account"),
+            since=since,
+            until=until,
+            currency_id=request.args.get("currency"),
+            counterparty=request.args.get("counterparty")
+        )
+
+        for total in totals:
+            scale = data_engine.find_currency_by_id(total["currency_id"]).scale
+            total["in"] = format_amount(total["in"], scale)
+            total["out"] = format_amount(total["out"], scale)
+        return jsonify({"period": period, "totals": totals})
 
     return jsonify({"error": "User not authenticated"}), 401
 
@@ -155,10 +577,60 @@ def make_transaction():
 def view_messages():
     user_id = authenticate_user()
     if user_id:
-        messages = data_engine.get_messages(user_id)
-        return jsonify({"messages": messages})
+        try:
+            limit, cursor = page_arguments()
+        except ValueError as e:
+            return jsonify({"error": f"Invalid query: {e}"}), 400
+
+        page, next_cursor = data_engine.find_messages(
+            user_id, limit, cursor,
+            account_id=request.args.get("account"),
+            counterparty=request.args.get("counterparty")
+        )
+
+        messages = [{"account_id": account_id, "owner": message.owner.to_json(), "data": message.data} for account_id, message in page]
+        return jsonify({"messages": messages, "next_cursor": encode_cursor(next_cursor)})
+
+    return jsonify({"error": "User not authenticated"}), 401
+
+@app.route("/user/events")
+def view_events():
+    user_id = authenticate_user()
+    if user_id:
+        try:
+            after = request.args.get("after", request.headers.get("Last-Event-ID"))
+            timeout = float(request.args.get("timeout", MAX_EVENT_WAIT))
+            # Also refuses NaN, which no deadline comparison would ever end
+            if not 0 <= timeout:
+                raise ValueError("timeout must be a non-negative number of seconds")
+            timeout = min(timeout, MAX_EVENT_WAIT)
+        except ValueError as e:
+            return jsonify({"error": f"Invalid query: {e}"}), 400
+
+        if "text/event-stream" in request.headers.get("Accept", ""):
+            def stream(last_event_id):
+                if last_event_id is None:
+                    last_event_id = change_feed.subscribe(user_id)
+                while True:
+                    events, last_event_id, reset = change_feed.wait(user_id, last_event_id, SSE_KEEPALIVE)
+                    if reset:
+                        yield f"event: reset\nid: {last_event_id}\ndata: {{}}\n\n"
+                    for event in events:
+                        yield f"id: {event['id']}\ndata: {json.dumps(event)}\n\n"
+                    if not events and not reset:
+                        yield ": keep-alive\n\n"
+
+            return Response(stream(after), mimetype="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+        # Without an id the client is starting out: it gets the current position to poll from
+        if after is None:
+            return jsonify({"events": [], "last_event_id": change_feed.subscribe(user_id), "reset": False})
+
+        events, last_event_id, reset = change_feed.wait(user_id, after, timeout)
+        return jsonify({"events": events, "last_event_id": last_event_id, "reset": reset})
 
     return jsonify({"error": "User not authenticated"}), 401
 
 if __name__ == "__main__":
-    app.run(debug=True)
+    # The reloader re-runs this file in a child process, which would load the data a second time
+    app.run(debug=True, use_reloader=False)
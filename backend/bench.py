@@ -0,0 +1,824 @@
+import argparse
+import gc
+import json
+import logging
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Tuple
+from exchange import ExchangeRates
+from scheduler import PaymentScheduler
+from models import DataModel
+from passwords import PasswordHasher, hash_password
+from metrics import registry
+from reports import BankReports, numpy
+from storage import DataEngine, JsonDataEngine, SqliteDataEngine, create_data_engine
+from transfers import TransferEngine, TransferError
+
+def generate_data(users: int, banks: int, accounts_per_user: int, transactions_per_account: int, seed: int = 0,
+                  currencies_per_account: int = 1) -> dict:
+    rng = random.Random(seed)
+    new_id = lambda: str(uuid.UUID(int=rng.getrandbits(128), version=4))
+    created_at = "2023-12-09 13:46:59.591897"
+    start = datetime(2023, 12, 9, 13, 46, 59)
+
+    bank_list = []
+    currency_list = []
+    for b in range(banks):
+        bank_id = new_id()
+        currency_list.append({
+            "currency_id": new_id(),
+            "name": f"Currency {b}",
+            "code": f"C{b:02d}",
+            "symbol": "§",
+            "bank_id": bank_id,
+            "created_at": created_at,
+            "scale": 2
+        })
+        bank_list.append({
+            "bank_id": bank_id,
+            "name": f"Bank {b}",
+            "bank_type": "country",
+            "created_at": created_at,
+            "account_types": [{"type_id": new_id(), "name": "Personal", "description": "For personal uses"}],
+            "admin_authentication": [],
+            "accounts": []
+        })
+
+    user_list = []
+    for u in range(users):
+        user_id = new_id()
+        user_list.append({
+            "user_id": user_id,
+            "name": f"user{u}",
+            "email": f"user{u}@example.com",
+            "password": f"password{u}",
+            "created_at": created_at
+        })
+        for _ in range(accounts_per_user):
+            b = rng.randrange(banks)
+            # The bank's own currency first, then others drawn from the remaining banks
+            held = [b]
+            if currencies_per_account > 1:
+                held += rng.sample([other for other in range(banks) if other != b], currencies_per_account - 1)
+            bank_list[b]["accounts"].append({
+                "account_id": new_id(),
+                "bank_id": bank_list[b]["bank_id"],
+                "type_id": bank_list[b]["account_types"][0]["type_id"],
+                "owner": {"type": "user", "owner_id": user_id},
+                "created_at": created_at,
+                "balance": [{"currency_id": currency_list[c]["currency_id"], "balance": 100000000} for c in held],
+                "messages": [],
+                "transactions": [],
+                "authentication": []
+            })
+
+    accounts = [account for bank in bank_list for account in bank["accounts"]]
+    for account in accounts:
+        currency_id = account["balance"][0]["currency_id"]
+        for t in range(transactions_per_account):
+            counterparty = rng.choice(accounts)["account_id"]
+            account["transactions"].append({
+                "from": account["account_id"],
+                "to": counterparty,
+                "when": (start + timedelta(minutes=t)).strftime("%Y-%m-%d %H:%M:%S.%f"),
+                "currency": {"currency_id": currency_id, "previous_balance": 100000000, "new_balance": 100000000}
+            })
+
+    return {"money_format": "minor_units", "currencies": currency_list, "users": user_list, "banks": bank_list}
+
+def write_dataset(data: dict, directory: str) -> str:
+    file_path = os.path.join(directory, "data.json")
+    with open(file_path, "w") as file:
+        json.dump(data, file)
+    return file_path
+
+def open_engine(engine_type: str, data: dict, directory: str, **options) -> DataEngine:
+    if engine_type == "sqlite":
+        # Single process, so there are no other workers' commits to poll for
+        engine = SqliteDataEngine(database_path=os.path.join(directory, "bank.db"), sync_interval=0)
+        engine.load_data()
+        engine.import_json(data)
+        return engine
+    engine = create_data_engine(engine_type, write_dataset(data, directory), **options)
+    engine.load_data()
+    return engine
+
+def money_supply(engine: DataEngine, account_ids: list) -> dict:
+    totals = {}
+    for account_id in account_ids:
+        for currency_id, balance in engine.find_account_by_id(account_id).balances.items():
+            totals[currency_id] = totals.get(currency_id, 0) + balance
+    return totals
+
+def snapshot_supply(data: dict) -> dict:
+    totals = {}
+    for bank in data["banks"]:
+        for account in bank["accounts"]:
+            for balance in account["balance"]:
+                totals[balance["currency_id"]] = totals.get(balance["currency_id"], 0) + balance["balance"]
+    return totals
+
+def watch_snapshots(engine: DataEngine) -> list:
+    # The money supply of every snapshot a JSON engine writes, read from the data on its way to disk
+    supplies = []
+    write_snapshot = engine.write_snapshot
+    def checked_write(data: dict):
+        supplies.append(snapshot_supply(data))
+        write_snapshot(data)
+    engine.write_snapshot = checked_write
+    return supplies
+
+def peak_rss_mb() -> float:
+    # ru_maxrss survives exec on Linux and would report the parent's peak, so prefer this process's own high-water mark
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def time_per_call(func, args_list) -> float:
+    start = time.perf_counter()
+    for args in args_list:
+        func(*args)
+    return (time.perf_counter() - start) / len(args_list) * 1e6
+
+def bench_lookups(args):
+    print(f"{'users':>8} {'accounts':>9} {'find_user':>10} {'find_account':>13} {'user_accounts':>14} {'currency':>9} {'bank':>7}  (us/call)")
+    for users in args.users:
+        data = generate_data(users, args.banks, args.accounts_per_user, 0)
+        with tempfile.TemporaryDirectory() as directory:
+            engine = JsonDataEngine(file_path=write_dataset(data, directory))
+            engine.load_data()
+
+        rng = random.Random(1)
+        emails = [(u["email"],) for u in rng.choices(data["users"], k=args.calls)]
+        user_ids = [(u["user_id"],) for u in rng.choices(data["users"], k=args.calls)]
+        accounts = [a for bank in data["banks"] for a in bank["accounts"]]
+        account_ids = [(a["account_id"],) for a in rng.choices(accounts, k=args.calls)]
+        currency_ids = [(c["currency_id"],) for c in rng.choices(data["currencies"], k=args.calls)]
+        bank_ids = [(b["bank_id"],) for b in rng.choices(data["banks"], k=args.calls)]
+
+        print(f"{users:>8} {len(accounts):>9} "
+              f"{time_per_call(engine.find_user, emails):>10.3f} "
+              f"{time_per_call(engine.find_account_by_id, account_ids):>13.3f} "
+              f"{time_per_call(engine.find_user_accounts, user_ids):>14.3f} "
+              f"{time_per_call(engine.find_currency_by_id, currency_ids):>9.3f} "
+              f"{time_per_call(engine.find_bank_by_id, bank_ids):>7.3f}")
+
+def transfer_groups(data: dict) -> list:
+    # (currency_id, accounts holding it) pairs to draw sender and recipient from
+    by_currency = {}
+    for bank in data["banks"]:
+        for account in bank["accounts"]:
+            for balance in account["balance"]:
+                by_currency.setdefault(balance["currency_id"], []).append(account)
+    return list(by_currency.items())
+
+def run_transfers(transfer_engine: TransferEngine, currency_groups: list, threads: int, transfers: int) -> Tuple[int, int, float]:
+    # Random transfers split over the threads; returns (transfers attempted, rejected, seconds)
+    rejected = []
+
+    def worker(seed):
+        rng = random.Random(seed)
+        count = 0
+        for _ in range(transfers // threads):
+            currency_id, group = rng.choice(currency_groups)
+            sender, recipient = rng.choice(group), rng.choice(group)
+            try:
+                transfer_engine.transfer(sender["owner"]["owner_id"], {
+                    "from": sender["account_id"],
+                    "to": recipient["account_id"],
+                    "currency": currency_id,
+                    "amount": rng.randint(1, 100)
+                })
+            except TransferError:
+                count += 1
+        rejected.append(count)
+
+    workers = [threading.Thread(target=worker, args=(seed,)) for seed in range(threads)]
+    start = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return transfers // threads * threads, sum(rejected), time.perf_counter() - start
+
+def bench_stress(args):
+    data = generate_data(args.users, args.banks, args.accounts_per_user, 0)
+    account_ids = [a["account_id"] for bank in data["banks"] for a in bank["accounts"]]
+    currency_groups = transfer_groups(data)
+
+    if args.switch_interval:
+        sys.setswitchinterval(args.switch_interval)
+    print(f"{'threads':>7} {'transfers':>9} {'rejected':>8} {'seconds':>8} {'per sec':>9} {'snapshots':>9}  money supply")
+    for threads in args.threads:
+        with tempfile.TemporaryDirectory() as directory:
+            engine = open_engine(args.engine, data, directory)
+            before = money_supply(engine, account_ids)
+            # Each snapshot written during the run must hold the same total: one taken halfway through a transfer would not
+            snapshots = watch_snapshots(engine) if args.engine != "sqlite" else []
+            done, rejected, elapsed = run_transfers(TransferEngine(engine), currency_groups, threads, args.transfers)
+            after = money_supply(engine, account_ids)
+        torn = sum(1 for supply in snapshots if supply != before)
+        conserved = after == before and not torn
+        print(f"{threads:>7} {done:>9} {rejected:>8} {elapsed:>8.3f} {done / elapsed:>9.0f} {len(snapshots):>9}  "
+              f"{'conserved' if conserved else f'CHANGED ({torn} snapshots off)'}")
+        if not conserved:
+            raise SystemExit("Money supply changed under concurrent transfers")
+
+def bench_currencies(args):
+    print(f"{'currencies':>10} {'validate us':>11} {'transfers':>9} {'rejected':>8} {'seconds':>8} {'per sec':>9}  money supply")
+    for currencies in args.currencies:
+        data = generate_data(args.users, max(args.banks, currencies), args.accounts_per_user, 0, currencies_per_account=currencies)
+        account_ids = [a["account_id"] for bank in data["banks"] for a in bank["accounts"]]
+        currency_groups = transfer_groups(data)
+        rng = random.Random(1)
+        requests = []
+        for _ in range(args.calls):
+            currency_id, group = rng.choice(currency_groups)
+            sender, recipient = rng.choice(group), rng.choice(group)
+            requests.append((sender["owner"]["owner_id"], {"from": sender["account_id"], "to": recipient["account_id"], "currency": currency_id, "amount": 1}))
+
+        with tempfile.TemporaryDirectory() as directory:
+            engine = open_engine(args.engine, data, directory)
+            # Compaction snapshots grow with the balances written; leave them out so only transfers are measured
+            engine.compact_every = float("inf")
+            transfer_engine = TransferEngine(engine)
+            before = money_supply(engine, account_ids)
+            # The balance lookups a transfer makes, without the storage write after them
+            validate = time_per_call(transfer_engine.validate, requests)
+            done, rejected, elapsed = run_transfers(transfer_engine, currency_groups, args.threads, args.transfers)
+            after = money_supply(engine, account_ids)
+        # Every currency of every account must still be there with the same total
+        conserved = after == before and len(after) == len(data["currencies"])
+        print(f"{currencies:>10} {validate:>11.2f} {done:>9} {rejected:>8} {elapsed:>8.3f} {done / elapsed:>9.0f}  {'conserved' if conserved else 'CHANGED'}")
+        if not conserved:
+            raise SystemExit("Balances changed or went missing on multi-currency accounts")
+
+def bench_scheduler(args):
+    print(f"{'orders':>7} {'batch':>6} {'runs':>7} {'seconds':>8} {'runs/sec':>9} {'commits':>8}  money supply")
+    for orders in args.orders:
+        data = generate_data(args.users, args.banks, 1, 0)
+        rng = random.Random(1)
+        groups = transfer_groups(data)
+        now = datetime.now()
+        # Daily orders that have each missed the given number of runs, as after downtime
+        start = (now - timedelta(days=args.missed - 1, minutes=1)).strftime("%Y-%m-%d %H:%M:%S.%f")
+        for _ in range(orders):
+            currency_id, group = rng.choice(groups)
+            sender, recipient = rng.choice(group), rng.choice(group)
+            sender.setdefault("standing_orders", []).append({
+                "order_id": str(uuid.UUID(int=rng.getrandbits(128), version=4)), "account_id": sender["account_id"],
+                "to": recipient["account_id"], "currency_id": currency_id, "amount": rng.randint(1, 100),
+                "interval": "day", "every": 1, "start": start, "runs": 0, "created_at": start
+            })
+        account_ids = [a["account_id"] for bank in data["banks"] for a in bank["accounts"]]
+
+        for batch_size in args.batch_sizes:
+            with tempfile.TemporaryDirectory() as directory:
+                engine = open_engine(args.engine, data, directory)
+                # Compaction snapshots grow with the orders stored; leave them out so only the runs are measured
+                engine.compact_every = float("inf")
+                before = money_supply(engine, account_ids)
+                scheduler = PaymentScheduler(engine, TransferEngine(engine), batch_size=batch_size)
+                scheduler.load()
+                commits = counter_total("bank_storage_commits_total")
+                start_time = time.perf_counter()
+                runs = scheduler.run_due(now.strftime("%Y-%m-%d %H:%M:%S.%f"))
+                elapsed = time.perf_counter() - start_time
+                commits = counter_total("bank_storage_commits_total") - commits
+                after = money_supply(engine, account_ids)
+                # Running again at the same time must find nothing left to do
+                repeated = scheduler.run_due(now.strftime("%Y-%m-%d %H:%M:%S.%f"))
+            conserved = after == before
+            print(f"{orders:>7} {batch_size:>6} {runs:>7} {elapsed:>8.3f} {runs / elapsed:>9.0f} {commits:>8.0f}  {'conserved' if conserved else 'CHANGED'}")
+            if not conserved or runs != orders * args.missed or repeated:
+                raise SystemExit("Standing orders ran the wrong number of times or changed the money supply")
+
+def bench_exchange(args):
+    print(f"{'currencies':>10} {'table pairs':>11} {'build ms':>9} {'quote us':>9} {'validate us':>11} {'converted us':>12}")
+    for currencies in args.currencies:
+        data = generate_data(args.users, currencies, 1, 0)
+        rng = random.Random(1)
+        # Every currency is quoted against the first, so any other pair converts through it
+        hub = data["currencies"][0]["currency_id"]
+        data["exchange_rates"] = [{"bank_id": c["bank_id"], "from": c["currency_id"], "to": hub, "rate": f"{rng.uniform(0.1, 10):.6f}",
+                                   "updated_at": "2023-12-09 13:46:59.591897"} for c in data["currencies"][1:]]
+        accounts = [account for bank in data["banks"] for account in bank["accounts"]]
+        same, converted, pairs = [], [], []
+        for _ in range(args.calls):
+            sender, recipient = rng.choice(accounts), rng.choice(accounts)
+            currency_id, to_currency = sender["balance"][0]["currency_id"], recipient["balance"][0]["currency_id"]
+            request = {"from": sender["account_id"], "to": recipient["account_id"], "currency": currency_id, "amount": 1000}
+            pairs.append((currency_id, to_currency))
+            if currency_id == to_currency:
+                same.append((sender["owner"]["owner_id"], request))
+            else:
+                converted.append((sender["owner"]["owner_id"], {**request, "to_currency": to_currency}))
+
+        with tempfile.TemporaryDirectory() as directory:
+            engine = open_engine(args.engine, data, directory)
+            exchange_rates = ExchangeRates(engine)
+            start = time.perf_counter()
+            table = exchange_rates.quotes()
+            build = (time.perf_counter() - start) * 1000
+            quote = time_per_call(exchange_rates.quote, pairs)
+            transfer_engine = TransferEngine(engine, exchange_rates)
+            validate = time_per_call(transfer_engine.validate, same) if same else float("nan")
+            validate_converted = time_per_call(transfer_engine.validate, converted) if converted else float("nan")
+        print(f"{currencies:>10} {len(table):>11} {build:>9.1f} {quote:>9.2f} {validate:>11.2f} {validate_converted:>12.2f}")
+
+def bench_reports(args):
+    print(f"{'engine':>8} {'rows':>8} {'objects ms':>10} {'python ms':>9} {'numpy ms':>8} {'cached us':>9} {'after transfer ms':>17}  (daily volume + balances)")
+    for transactions in args.transactions:
+        data = generate_data(args.users, 1, 1, transactions)
+        bank_id = data["banks"][0]["bank_id"]
+        accounts = data["banks"][0]["accounts"]
+        currency_id = data["currencies"][0]["currency_id"]
+
+        for engine_type in args.engine:
+            with tempfile.TemporaryDirectory() as directory:
+                engine = open_engine(engine_type, data, directory)
+                engine.compact_every = float("inf")
+                engine.bank_history_columns(bank_id)  # Loads the histories, which are stored apart on the JSON engines
+
+                def objects():
+                    # What the reports cost walking every account's Transaction objects
+                    volume, deposits = {}, {}
+                    for account in map(engine.find_account_by_id, (a["account_id"] for a in accounts)):
+                        for currency, balance in account.balances.items():
+                            deposits[currency] = deposits.get(currency, 0) + balance
+                        for t in account.transactions:
+                            totals = volume.setdefault((t.when[:10], t.currency_id), [0, 0, 0])
+                            delta = t.new_balance - t.previous_balance
+                            totals[0 if delta >= 0 else 1] += abs(delta)
+                            totals[2] += 1
+                    return volume, deposits
+
+                def cold(use_numpy: bool):
+                    reports = BankReports(engine, use_numpy=use_numpy)
+                    start = time.perf_counter()
+                    result = reports.volume(bank_id, "day"), reports.balances(bank_id)
+                    return result, (time.perf_counter() - start) * 1000
+
+                start = time.perf_counter()
+                volume, deposits = objects()
+                walked = (time.perf_counter() - start) * 1000
+                python_result, python_ms = cold(False)
+                numpy_result, numpy_ms = cold(True) if numpy is not None else (python_result, float("nan"))
+                if python_result != numpy_result or sum(total[2] for totals in python_result[0].values() for total in totals.values()) != len(accounts) * transactions:
+                    raise SystemExit("Report aggregations disagree")
+
+                reports = BankReports(engine, use_numpy=numpy is not None)
+                reports.volume(bank_id, "day")
+                reports.balances(bank_id)
+                cached = time_per_call(lambda: (reports.volume(bank_id, "day"), reports.balances(bank_id)), [()] * args.calls)
+                # One transfer makes only today's volume and the balances stale
+                sender, recipient = engine.find_account_by_id(accounts[0]["account_id"]), engine.find_account_by_id(accounts[1]["account_id"])
+                engine.transfer(sender, recipient, currency_id, 1)
+                start = time.perf_counter()
+                reports.volume(bank_id, "day")
+                reports.balances(bank_id)
+                refreshed = (time.perf_counter() - start) * 1000
+            print(f"{engine_type:>8} {len(accounts) * transactions:>8} {walked:>10.1f} {python_ms:>9.1f} {numpy_ms:>8.1f} {cached:>9.2f} {refreshed:>17.1f}")
+
+def counter_total(name: str) -> float:
+    with registry.lock:
+        return sum(registry.counters.get(name, {}).values())
+
+def bench_group_commit(args):
+    data = generate_data(args.users, args.banks, args.accounts_per_user, 0)
+    currency_groups = transfer_groups(data)
+    modes = [("off", {"group_commit": False})]
+    modes += [(f"{window:g} ms", {"group_commit": True, "group_commit_window": window / 1000, "group_commit_max": args.max}) for window in args.windows]
+
+    print(f"{'engine':>8} {'mode':>8} {'threads':>7} {'transfers':>9} {'seconds':>8} {'per sec':>9} {'writes':>7} {'commits/write':>13}")
+    for engine_type in args.engine:
+        for mode, options in modes:
+            for threads in args.threads:
+                with tempfile.TemporaryDirectory() as directory:
+                    engine = open_engine(engine_type, data, directory, **options)
+                    # Compactions are snapshots too; leave them out so only commit writes are counted
+                    engine.compact_every = float("inf")
+                    saves, commits = counter_total("bank_storage_saves_total"), counter_total("bank_storage_commits_total")
+                    done, _, elapsed = run_transfers(TransferEngine(engine), currency_groups, threads, args.transfers)
+                    saves = counter_total("bank_storage_saves_total") - saves
+                    commits = counter_total("bank_storage_commits_total") - commits
+                print(f"{engine_type:>8} {mode:>8} {threads:>7} {done:>9} {elapsed:>8.3f} {done / elapsed:>9.0f} {saves:>7.0f} {commits / saves:>13.1f}")
+
+def bench_search(args):
+    print(f"{'engine':>8} {'tx/account':>10} {'warm-up ms':>10} {'counterparty':>13} {'time range':>11} {'month totals':>13} {'scan':>10}  (us/call)")
+    for transactions in args.transactions:
+        data = generate_data(args.users, 1, args.accounts_per_user, transactions)
+        rng = random.Random(1)
+        accounts = data["banks"][0]["accounts"]
+        owners = [(a["owner"]["owner_id"], rng.choice(accounts)["account_id"]) for a in rng.choices(accounts, k=args.calls)]
+        # A one hour window in the middle of the histories, which cover transactions_per_account minutes
+        since = (datetime(2023, 12, 9, 13, 46, 59) + timedelta(minutes=transactions // 2)).strftime("%Y-%m-%d %H:%M:%S.%f")
+        until = (datetime(2023, 12, 9, 14, 46, 59) + timedelta(minutes=transactions // 2)).strftime("%Y-%m-%d %H:%M:%S.%f")
+
+        def scan(user_id, counterparty):
+            # What a search cost before the indexes: every transaction of every account, materialized and compared
+            return sum(1 for account in engine.find_user_accounts(user_id) for t in account.transactions
+                       if t.from_id == counterparty or t.to_id == counterparty)
+
+        for engine_type in args.engine:
+            with tempfile.TemporaryDirectory() as directory:
+                engine = open_engine(engine_type, data, directory)
+                start = time.perf_counter()
+                for user_id, _ in owners:
+                    engine.find_transactions(user_id, 1)  # Loads the histories and, on the JSON engines, builds the indexes
+                build = (time.perf_counter() - start) * 1000
+                counterparty = time_per_call(lambda u, c: engine.find_transactions(u, 50, counterparty=c), owners)
+                time_range = time_per_call(lambda u, c: engine.find_transactions(u, 50, since=since, until=until), owners)
+                totals = time_per_call(lambda u, c: engine.transaction_totals(u, "month", counterparty=c), owners)
+                scanned = time_per_call(scan, owners[:max(1, args.calls // 10)])
+            print(f"{engine_type:>8} {transactions:>10} {build:>10.1f} {counterparty:>13.1f} {time_range:>11.1f} {totals:>13.1f} {scanned:>10.1f}")
+
+def bench_load_once(args):
+    # Runs in a fresh interpreter so the peak RSS belongs to this load alone
+    start = time.perf_counter()
+    if args.mode == "lazy":
+        engine = JsonDataEngine(file_path=args.path, history_segments=True)
+        engine.load_data()
+    else:
+        with open(args.path, "r") as file:
+            if args.mode == "stream":
+                model, _ = DataModel.loads(file.read())
+            else:
+                model = DataModel.from_json(json.load(file))
+    elapsed = time.perf_counter() - start
+    gc.collect()
+    print(json.dumps({"seconds": elapsed, "peak_rss_mb": peak_rss_mb()}))
+
+def bench_load(args):
+    accounts = args.users * args.accounts_per_user
+    with tempfile.TemporaryDirectory() as directory:
+        data = generate_data(args.users, args.banks, args.accounts_per_user, max(1, args.transactions // accounts))
+        file_path = write_dataset(data, directory)
+
+        # The same dataset saved with history segments, where only account headers load at startup
+        os.mkdir(os.path.join(directory, "lazy"))
+        lazy_engine = JsonDataEngine(file_path=write_dataset(data, os.path.join(directory, "lazy")), history_segments=True)
+        lazy_engine.load_data()
+        lazy_engine.save_data()
+        del data, lazy_engine
+        gc.collect()
+
+        print(f"{os.path.getsize(file_path) / 2**20:.1f} MB data.json, {accounts} accounts, {args.transactions} transactions")
+        print(f"{'loader':>8} {'seconds':>8} {'peak RSS MB':>12}")
+        for mode in ("tree", "stream", "lazy"):
+            path = os.path.join(directory, "lazy", "data.json") if mode == "lazy" else file_path
+            output = subprocess.run([sys.executable, __file__, "load-once", path, mode], capture_output=True, text=True, check=True).stdout
+            result = json.loads(output)
+            print(f"{mode:>8} {result['seconds']:>8.2f} {result['peak_rss_mb']:>12.0f}")
+
+# Snapshot layouts of the JSON engine: (history_segments, snapshot_format)
+SNAPSHOT_LAYOUTS = {"json-inline": (False, "json"), "json": (True, "json"), "binary": (True, "binary")}
+
+def bench_snapshot_once(args):
+    # Saves the dataset in one layout and loads it back, in a fresh interpreter so earlier layouts' memory is gone
+    history_segments, snapshot_format = SNAPSHOT_LAYOUTS[args.layout]
+    source = JsonDataEngine(file_path=args.source, history_segments=False)
+    source.load_data()
+    os.makedirs(args.directory)
+    target_path = os.path.join(args.directory, "data")
+    engine = JsonDataEngine(file_path=target_path, history_segments=history_segments, snapshot_format=snapshot_format)
+    engine.data_model = source.data_model
+    engine.build_indexes()
+    start = time.perf_counter()
+    engine.save_data()  # Every history is new to this engine, so this writes all of them
+    save = time.perf_counter() - start
+    del source, engine
+    gc.collect()
+    size = sum(os.path.getsize(os.path.join(args.directory, name)) for name in os.listdir(args.directory))
+
+    start = time.perf_counter()
+    engine = JsonDataEngine(file_path=target_path, history_segments=history_segments, snapshot_format=snapshot_format)
+    engine.load_data()
+    opened = time.perf_counter() - start
+    for account in engine.accounts_by_id.values():
+        account.load_history()
+    loaded = time.perf_counter() - start
+    print(json.dumps({"bytes": size, "save": save, "open": opened, "load": loaded}))
+
+def bench_snapshot(args):
+    print(f"{'transactions':>12} {'layout':>11} {'MB':>8} {'save s':>7} {'open s':>7} {'load s':>7}  (load reads every history)")
+    for transactions in args.transactions:
+        with tempfile.TemporaryDirectory() as directory:
+            source = write_dataset(generate_data(args.users, args.banks, 1, max(1, transactions // args.users)), directory)
+            gc.collect()
+            for layout in args.layouts:
+                output = subprocess.run([sys.executable, __file__, "snapshot-once", source, os.path.join(directory, layout), layout],
+                                        capture_output=True, text=True, check=True).stdout
+                result = json.loads(output)
+                print(f"{transactions:>12} {layout:>11} {result['bytes'] / 2**20:>8.1f} {result['save']:>7.2f} {result['open']:>7.2f} {result['load']:>7.2f}")
+
+def bench_logins(args):
+    stored = hash_password("correct horse battery staple", args.cost)
+    print(f"scrypt n={args.cost}, {args.clients} concurrent clients, {args.seconds}s per run")
+    print(f"{'workers':>7} {'logins':>7} {'per sec':>8}")
+    for workers in args.workers:
+        hasher = PasswordHasher(n=args.cost, workers=workers, max_pending=args.clients)
+        counts = []
+        deadline = time.perf_counter() + args.seconds
+
+        def client():
+            count = 0
+            while time.perf_counter() < deadline:
+                hasher.verify("correct horse battery staple", stored)
+                count += 1
+            counts.append(count)
+
+        clients = [threading.Thread(target=client) for _ in range(args.clients)]
+        start = time.perf_counter()
+        for thread in clients:
+            thread.start()
+        for thread in clients:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        hasher.pool.shutdown()
+        logins = sum(counts)
+        print(f"{workers:>7} {logins:>7} {logins / elapsed:>8.1f}")
+
+def percentile(sorted_values: list, fraction: float) -> float:
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+def http_workload(data: dict, rng: random.Random) -> dict:
+    # Request builders for each endpoint; each returns (method, path, json body or None, user index)
+    users = data["users"]
+    accounts_by_owner = {}
+    accounts_by_currency = {}
+    for bank in data["banks"]:
+        for account in bank["accounts"]:
+            accounts_by_owner.setdefault(account["owner"]["owner_id"], []).append(account)
+            accounts_by_currency.setdefault(account["balance"][0]["currency_id"], []).append(account)
+
+    def transaction(u):
+        sender = rng.choice(accounts_by_owner[users[u]["user_id"]])
+        currency_id = sender["balance"][0]["currency_id"]
+        recipient = rng.choice(accounts_by_currency[currency_id])
+        return {"from": sender["account_id"], "to": recipient["account_id"], "currency": currency_id, "amount": "0.01"}
+
+    return {
+        "login": lambda u: ("POST", "/user/login", {"email": users[u]["email"], "password": users[u]["password"]}),
+        "balance": lambda u: ("GET", "/user/balance", None),
+        "transaction": lambda u: ("POST", "/user/transaction", transaction(u)),
+        "messages": lambda u: ("GET", "/user/messages?limit=50", None)
+    }
+
+def bench_http_once(args):
+    # Runs in a fresh interpreter per engine and target, so app.py picks up its storage settings at import
+    # and the peak RSS belongs to this run alone (server and load generator share the process)
+    with open(args.path, "r") as file:
+        data = json.load(file)
+    os.environ["BANK_STORAGE_ENGINE"] = args.engine
+    os.environ["BANK_DATA_FILE"] = args.data_file
+    os.environ["BANK_PASSWORD_HASH_COST"] = str(args.cost)
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    import app
+
+    if args.target == "server":
+        import requests
+        from werkzeug.serving import make_server
+        server = make_server("127.0.0.1", 0, app.app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base_url = f"http://127.0.0.1:{server.server_port}"
+
+        def new_client():
+            session = requests.Session()
+            return lambda method, path, body, headers: session.request(method, base_url + path, json=body, headers=headers).status_code
+    else:
+        def new_client():
+            client = app.app.test_client()
+            return lambda method, path, body, headers: client.open(path, method=method, json=body, headers=headers).status_code
+
+    rng = random.Random(args.seed)
+    workload = http_workload(data, rng)
+    # Logged-in users the authenticated endpoints are spread over
+    user_indexes = rng.sample(range(len(data["users"])), min(len(data["users"]), args.sessions))
+    setup = app.app.test_client()
+    tokens = {}
+    for u in user_indexes:
+        method, path, body = workload["login"](u)
+        tokens[u] = setup.post(path, json=body).json["jwt_token"]
+
+    results = []
+    for endpoint in args.endpoints:
+        for concurrency in args.concurrency:
+            requests_list = []
+            for _ in range(args.requests):
+                u = rng.choice(user_indexes)
+                requests_list.append((*workload[endpoint](u), {"Authorization": f"Bearer {tokens[u]}"}))
+            latencies = []
+            errors = []
+
+            def worker(batch):
+                send = new_client()
+                local_latencies = []
+                local_errors = 0
+                for method, path, body, headers in batch:
+                    start = time.perf_counter()
+                    status = send(method, path, body, headers)
+                    local_latencies.append(time.perf_counter() - start)
+                    if status >= 400:
+                        local_errors += 1
+                latencies.extend(local_latencies)
+                errors.append(local_errors)
+
+            workers = [threading.Thread(target=worker, args=(requests_list[i::concurrency],)) for i in range(concurrency)]
+            start = time.perf_counter()
+            for thread in workers:
+                thread.start()
+            for thread in workers:
+                thread.join()
+            elapsed = time.perf_counter() - start
+
+            latencies.sort()
+            results.append({
+                "endpoint": endpoint,
+                "concurrency": concurrency,
+                "requests": len(latencies),
+                "errors": sum(errors),
+                "p50_ms": percentile(latencies, 0.50) * 1000,
+                "p95_ms": percentile(latencies, 0.95) * 1000,
+                "p99_ms": percentile(latencies, 0.99) * 1000,
+                "per_sec": len(latencies) / elapsed,
+                "peak_rss_mb": peak_rss_mb()
+            })
+    print(json.dumps(results))
+
+def bench_http(args):
+    data = generate_data(args.users, args.banks, args.accounts_per_user, args.transactions_per_account, args.seed)
+    print(f"{args.users} users, {args.users * args.accounts_per_user} accounts, "
+          f"{args.users * args.accounts_per_user * args.transactions_per_account} transactions, scrypt n={args.cost}")
+    print(f"{'engine':>8} {'target':>7} {'endpoint':>12} {'conc':>5} {'requests':>8} {'errors':>6} "
+          f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'req/s':>8} {'peak RSS MB':>12}")
+    for engine in args.engine:
+        for target in args.target:
+            # Every run starts from the same freshly written dataset
+            with tempfile.TemporaryDirectory() as directory:
+                dataset_path = write_dataset(data, directory)
+                data_file = dataset_path
+                if engine == "sqlite":
+                    data_file = os.path.join(directory, "bank.db")
+                    open_engine("sqlite", data, directory)
+                command = [sys.executable, __file__, "http-once", dataset_path, data_file, engine, target,
+                           "--cost", str(args.cost), "--seed", str(args.seed), "--sessions", str(args.sessions),
+                           "--requests", str(args.requests), "--concurrency", *map(str, args.concurrency),
+                           "--endpoints", *args.endpoints]
+                output = subprocess.run(command, capture_output=True, text=True, check=True, cwd=directory).stdout
+            for result in json.loads(output.splitlines()[-1]):
+                print(f"{engine:>8} {target:>7} {result['endpoint']:>12} {result['concurrency']:>5} {result['requests']:>8} "
+                      f"{result['errors']:>6} {result['p50_ms']:>8.2f} {result['p95_ms']:>8.2f} {result['p99_ms']:>8.2f} "
+                      f"{result['per_sec']:>8.0f} {result['peak_rss_mb']:>12.0f}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks for the bank backend")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    lookups_parser = subparsers.add_parser("lookups", help="DataEngine find_* cost as the dataset grows")
+    lookups_parser.add_argument("--users", type=int, nargs="+", default=[100, 1000, 10000, 50000])
+    lookups_parser.add_argument("--banks", type=int, default=10)
+    lookups_parser.add_argument("--accounts-per-user", type=int, default=2)
+    lookups_parser.add_argument("--calls", type=int, default=10000)
+    lookups_parser.set_defaults(func=bench_lookups)
+
+    stress_parser = subparsers.add_parser("stress", help="Concurrent transfers through TransferEngine, checking the money supply")
+    stress_parser.add_argument("--engine", choices=["json", "journal", "sqlite"], default="journal")
+    stress_parser.add_argument("--threads", type=int, nargs="+", default=[1, 2, 4, 8])
+    stress_parser.add_argument("--transfers", type=int, default=4000)
+    stress_parser.add_argument("--users", type=int, default=200)
+    stress_parser.add_argument("--banks", type=int, default=4)
+    stress_parser.add_argument("--accounts-per-user", type=int, default=2)
+    stress_parser.add_argument("--switch-interval", type=float, help="Thread switch interval in seconds (e.g. 1e-6) to make races likelier")
+    stress_parser.set_defaults(func=bench_stress)
+
+    currencies_parser = subparsers.add_parser("currencies", help="Transfers between accounts that each hold many currencies")
+    currencies_parser.add_argument("--engine", choices=["json", "journal", "sqlite"], default="journal")
+    currencies_parser.add_argument("--currencies", type=int, nargs="+", default=[1, 12, 48], help="Currencies held by every account")
+    currencies_parser.add_argument("--threads", type=int, default=4)
+    currencies_parser.add_argument("--transfers", type=int, default=4000)
+    currencies_parser.add_argument("--calls", type=int, default=20000, help="Validations timed on their own")
+    currencies_parser.add_argument("--users", type=int, default=200)
+    currencies_parser.add_argument("--banks", type=int, default=4)
+    currencies_parser.add_argument("--accounts-per-user", type=int, default=2)
+    currencies_parser.set_defaults(func=bench_currencies)
+
+    exchange_parser = subparsers.add_parser("exchange", help="Conversion table build time and the cost of a converted transfer's rate lookup")
+    exchange_parser.add_argument("--engine", choices=["json", "journal", "sqlite"], default="json")
+    exchange_parser.add_argument("--currencies", type=int, nargs="+", default=[2, 10, 50, 200])
+    exchange_parser.add_argument("--users", type=int, default=500)
+    exchange_parser.add_argument("--calls", type=int, default=5000)
+    exchange_parser.set_defaults(func=bench_exchange)
+
+    scheduler_parser = subparsers.add_parser("scheduler", help="Catching up on missed standing order runs with each batch size")
+    scheduler_parser.add_argument("--engine", choices=["json", "journal", "sqlite"], default="journal")
+    scheduler_parser.add_argument("--orders", type=int, nargs="+", default=[1000, 10000])
+    scheduler_parser.add_argument("--missed", type=int, default=3, help="Runs each order missed")
+    scheduler_parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 16, 256])
+    scheduler_parser.add_argument("--users", type=int, default=1000)
+    scheduler_parser.add_argument("--banks", type=int, default=10)
+    scheduler_parser.set_defaults(func=bench_scheduler)
+
+    reports_parser = subparsers.add_parser("reports", help="Bank report aggregation by object walk, plain Python and NumPy, cached and after a transfer")
+    reports_parser.add_argument("--engine", choices=["json", "journal", "sqlite"], nargs="+", default=["json", "sqlite"])
+    reports_parser.add_argument("--transactions", type=int, nargs="+", default=[100, 1000], help="Transactions per account")
+    reports_parser.add_argument("--users", type=int, default=1000)
+    reports_parser.add_argument("--calls", type=int, default=1000)
+    reports_parser.set_defaults(func=bench_reports)
+
+    group_commit_parser = subparsers.add_parser("group-commit", help="Transfer throughput with group commit off and with each window")
+    group_commit_parser.add_argument("--engine", choices=["json", "journal"], nargs="+", default=["json", "journal"])
+    group_commit_parser.add_argument("--windows", type=float, nargs="+", default=[0, 2], help="Group commit windows in ms")
+    group_commit_parser.add_argument("--max", type=int, default=256, help="Most commits per write")
+    group_commit_parser.add_argument("--threads", type=int, nargs="+", default=[1, 8, 32])
+    group_commit_parser.add_argument("--transfers", type=int, default=2000)
+    group_commit_parser.add_argument("--users", type=int, default=200)
+    group_commit_parser.add_argument("--banks", type=int, default=4)
+    group_commit_parser.add_argument("--accounts-per-user", type=int, default=2)
+    group_commit_parser.set_defaults(func=bench_group_commit)
+
+    search_parser = subparsers.add_parser("search", help="Indexed transaction search and totals against scanning every transaction")
+    search_parser.add_argument("--engine", choices=["json", "journal", "sqlite"], nargs="+", default=["json", "sqlite"])
+    search_parser.add_argument("--transactions", type=int, nargs="+", default=[1000, 10000, 50000], help="Transactions per account")
+    search_parser.add_argument("--users", type=int, default=20)
+    search_parser.add_argument("--accounts-per-user", type=int, default=1)
+    search_parser.add_argument("--calls", type=int, default=200)
+    search_parser.set_defaults(func=bench_search)
+
+    load_parser = subparsers.add_parser("load", help="Load time and peak memory of data.json with each loader")
+    load_parser.add_argument("--transactions", type=int, default=1000000)
+    load_parser.add_argument("--users", type=int, default=10000)
+    load_parser.add_argument("--banks", type=int, default=10)
+    load_parser.add_argument("--accounts-per-user", type=int, default=1)
+    load_parser.set_defaults(func=bench_load)
+
+    load_once_parser = subparsers.add_parser("load-once")
+    load_once_parser.add_argument("path")
+    load_once_parser.add_argument("mode", choices=["tree", "stream", "lazy"])
+    load_once_parser.set_defaults(func=bench_load_once)
+
+    snapshot_parser = subparsers.add_parser("snapshot", help="File size, save and load time of the JSON engine's snapshot layouts")
+    snapshot_parser.add_argument("--transactions", type=int, nargs="+", default=[10000, 100000, 1000000])
+    snapshot_parser.add_argument("--layouts", choices=list(SNAPSHOT_LAYOUTS), nargs="+", default=list(SNAPSHOT_LAYOUTS))
+    snapshot_parser.add_argument("--users", type=int, default=1000, help="One account each")
+    snapshot_parser.add_argument("--banks", type=int, default=10)
+    snapshot_parser.set_defaults(func=bench_snapshot)
+
+    snapshot_once_parser = subparsers.add_parser("snapshot-once")
+    snapshot_once_parser.add_argument("source")
+    snapshot_once_parser.add_argument("directory")
+    snapshot_once_parser.add_argument("layout", choices=list(SNAPSHOT_LAYOUTS))
+    snapshot_once_parser.set_defaults(func=bench_snapshot_once)
+
+    logins_parser = subparsers.add_parser("logins", help="Password verifications per second through the login worker pool")
+    logins_parser.add_argument("--cost", type=int, default=2 ** 14, help="scrypt n parameter")
+    logins_parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    logins_parser.add_argument("--clients", type=int, default=16)
+    logins_parser.add_argument("--seconds", type=float, default=3.0)
+    logins_parser.set_defaults(func=bench_logins)
+
+    http_parser = subparsers.add_parser("http", help="Latency percentiles, throughput and peak RSS per endpoint through the Flask app")
+    http_parser.add_argument("--engine", choices=["json", "journal", "sqlite"], nargs="+", default=["json", "journal", "sqlite"])
+    http_parser.add_argument("--target", choices=["client", "server"], nargs="+", default=["client", "server"],
+                             help="Flask's test client in-process, or a real local HTTP server")
+    http_parser.add_argument("--endpoints", choices=["login", "balance", "transaction", "messages"], nargs="+",
+                             default=["login", "balance", "transaction", "messages"])
+    http_parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16])
+    http_parser.add_argument("--requests", type=int, default=400, help="Requests per endpoint and concurrency level")
+    http_parser.add_argument("--sessions", type=int, default=100, help="Users logged in for the authenticated endpoints")
+    http_parser.add_argument("--cost", type=int, default=2 ** 14, help="scrypt n parameter")
+    http_parser.add_argument("--users", type=int, default=1000)
+    http_parser.add_argument("--banks", type=int, default=4)
+    http_parser.add_argument("--accounts-per-user", type=int, default=2)
+    http_parser.add_argument("--transactions-per-account", type=int, default=20)
+    http_parser.add_argument("--seed", type=int, default=0)
+    http_parser.set_defaults(func=bench_http)
+
+    http_once_parser = subparsers.add_parser("http-once")
+    http_once_parser.add_argument("path")
+    http_once_parser.add_argument("data_file")
+    http_once_parser.add_argument("engine", choices=["json", "journal", "sqlite"])
+    http_once_parser.add_argument("target", choices=["client", "server"])
+    http_once_parser.add_argument("--endpoints", nargs="+", required=True)
+    http_once_parser.add_argument("--concurrency", type=int, nargs="+", required=True)
+    http_once_parser.add_argument("--requests", type=int, required=True)
+    http_once_parser.add_argument("--sessions", type=int, required=True)
+    http_once_parser.add_argument("--cost", type=int, required=True)
+    http_once_parser.add_argument("--seed", type=int, required=True)
+    http_once_parser.set_defaults(func=bench_http_once)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -0,0 +1,165 @@
+import threading
+import time
+import uuid
+from collections import deque
+from money import format_amount
+from models import Conversion
+from storage import DataEngine, iter_records, transfer_sides
+from typing import Dict, List, Tuple
+
+class ChangeFeed:
+    # A user's buffer is dropped once they have not polled for this many seconds (and no request of theirs is waiting)
+    idle_ttl = 300.0
+
+    def __init__(self, data_engine: DataEngine, buffer_size: int = 1000):
+        self.data_engine = data_engine
+        self.buffer_size = buffer_size
+        self.condition = threading.Condition()
+        self.seq = 0
+        # Only users who have subscribed get a buffer; each holds their latest events as (id, event)
+        self.buffers: Dict[str, deque] = {}
+        # Highest event id dropped from each buffer, so a client that fell that far behind knows to reload
+        self.dropped: Dict[str, int] = {}
+        # When each subscriber last polled, and how many of their requests are waiting right now
+        self.last_seen: Dict[str, float] = {}
+        self.waiting: Dict[str, int] = {}
+        self.next_sweep = time.monotonic() + self.idle_ttl
+        # Event ids are "<epoch>-<n>": with several workers, or after a restart, an id from another feed
+        # cannot be resumed and makes the client reload instead
+        self.epoch = uuid.uuid4().hex[:8]
+        data_engine.add_listener(self.on_commit)
+
+    def position(self, seq: int) -> str:
+        return f"{self.epoch}-{seq}"
+
+    def parse_position(self, value: str) -> int | None:
+        epoch, _, seq = value.partition("-")
+        if epoch != self.epoch or not seq.isdigit():
+            return None
+        return int(seq)
+
+    def buffer(self, user_id: str) -> deque:
+        # Called under the condition
+        self.last_seen[user_id] = time.monotonic()
+        buffer = self.buffers.get(user_id)
+        if buffer is None:
+            buffer = self.buffers[user_id] = deque()
+            # Nothing before now was kept for this user, possibly because an idle buffer was dropped,
+            # so a client resuming from an earlier id has to reload
+            self.dropped[user_id] = self.seq
+        return buffer
+
+    def sweep(self):
+        # Called under the condition; drops the buffers of users who stopped polling
+        now = time.monotonic()
+        if now < self.next_sweep:
+            return
+        self.next_sweep = now + self.idle_ttl / 10
+        for user_id in [u for u, seen in self.last_seen.items() if now - seen > self.idle_ttl and u not in self.waiting]:
+            del self.buffers[user_id]
+            del self.last_seen[user_id]
+            self.dropped.pop(user_id, None)
+
+    def subscribe(self, user_id: str) -> str:
+        with self.condition:
+            self.buffer(user_id)
+            return self.position(self.seq)
+
+    def wait(self, user_id: str, after: str, timeout: float) -> Tuple[List[dict], str, bool]:
+        # Returns the user's events after the given id, waiting up to timeout for the first one.
+        # The flag is set when events the client has not seen were already dropped or the id is not ours.
+        deadline = time.monotonic() + timeout
+        after_seq = self.parse_position(after)
+        with self.condition:
+            buffer = self.buffer(user_id)
+            self.waiting[user_id] = self.waiting.get(user_id, 0) + 1
+            try:
+                while True:
+                    if after_seq is None or after_seq > self.seq or after_seq < self.dropped.get(user_id, 0):
+                        return [], self.position(self.seq), True
+                    events = [event for event_id, event in buffer if event_id > after_seq]
+                    remaining = deadline - time.monotonic()
+                    if events or remaining <= 0:
+                        return events, events[-1]["id"] if events else self.position(self.seq), False
+                    self.condition.wait(remaining)
+            finally:
+                self.waiting[user_id] -= 1
+                if not self.waiting[user_id]:
+                    del self.waiting[user_id]
+                self.last_seen[user_id] = time.monotonic()
+
+    def balance_event(self, account_id: str, currency_id: str) -> Tuple[str, dict] | None:
+        account = self.data_engine.find_account_by_id(account_id)
+        balance = account.balances.get(currency_id)
+        if balance is None:
+            return None
+        return account.owner.owner_id, {
+            "type": "balance",
+            "account_id": account_id,
+            "currency_id": currency_id,
+            "balance": format_amount(balance, self.data_engine.find_currency_by_id(currency_id).scale)
+        }
+
+    def record_events(self, record: dict) -> List[Tuple[str, dict]]:
+        op = record["op"]
+        events = []
+        if op == "transfer":
+            conversion = None
+            if "conversion" in record:
+                conversion = Conversion.from_json(record["conversion"])
+                conversion = conversion.display_json(self.data_engine.find_currency_by_id(conversion.from_currency_id).scale,
+                                                     self.data_engine.find_currency_by_id(conversion.to_currency_id).scale)
+            # Each side sees the transfer in its own currency: the recipient's amount is the converted one
+            for account_id, currency_id, delta in transfer_sides(record):
+                account = self.data_engine.find_account_by_id(account_id)
+                event = {
+                    "type": "transaction",
+                    "account_id": account_id,
+                    "from": record["from"],
+                    "to": record["to"],
+                    "when": record["when"],
+                    "currency_id": currency_id,
+                    "amount": format_amount(abs(delta), self.data_engine.find_currency_by_id(currency_id).scale)
+                }
+                if conversion is not None:
+                    event["conversion"] = conversion
+                events.append((account.owner.owner_id, event))
+                events.append(self.balance_event(account_id, currency_id))
+        elif op == "balance":
+            events.append(self.balance_event(record["account_id"], record["currency_id"]))
+        elif op == "message":
+            for account_id in record["accounts"]:
+                account = self.data_engine.find_account_by_id(account_id)
+                events.append((account.owner.owner_id, {
+                    "type": "message",
+                    "account_id": account_id,
+                    "owner": record["from"],
+                    "data": record["data"]
+                }))
+        return [event for event in events if event is not None]
+
+    def on_commit(self, records: list):
+        if not self.buffers:
+            return
+        if records[0]["op"] == "reload":
+            # Storage cannot say what changed, so every subscriber has to start over
+            with self.condition:
+                self.seq += 1
+                for user_id, buffer in self.buffers.items():
+                    buffer.clear()
+                    self.dropped[user_id] = self.seq
+                self.condition.notify_all()
+            return
+        events = [event for record in iter_records(records) for event in self.record_events(record)]
+        with self.condition:
+            for user_id, event in events:
+                buffer = self.buffers.get(user_id)
+                if buffer is None:
+                    continue
+                self.seq += 1
+                event["id"] = self.position(self.seq)
+                buffer.append((self.seq, event))
+                if len(buffer) > self.buffer_size:
+                    self.dropped[user_id] = buffer.popleft()[0]
+            self.sweep()
+            self.condition.notify_all()
@@ -0,0 +1,96 @@
+import threading
+from fractions import Fraction
+from models import Conversion, Currency
+from storage import DataEngine, iter_records
+from typing import Dict, Tuple
+
+class Quote:
+    __slots__ = ("rate", "numerator", "denominator", "via")
+
+    def __init__(self, rate: Fraction, via: Tuple[str, ...]):
+        self.rate = rate
+        # Kept as plain ints so converting is two multiplications and a floor division
+        self.numerator = rate.numerator
+        self.denominator = rate.denominator
+        self.via = via
+
+
+class ExchangeRates:
+    # Ops that change the published rates and so the conversion table
+    ops = ("rate", "reload")
+
+    def __init__(self, data_engine: DataEngine):
+        self.data_engine = data_engine
+        self.lock = threading.Lock()
+        # (from currency_id, to currency_id) -> Quote for every pair connected by published rates,
+        # rebuilt on the first lookup after a rate changes
+        self.table: Dict[Tuple[str, str], Quote] | None = None
+        # Bumped by every rate change, so a table built from rates read before the change is not kept
+        self.generation = 0
+        data_engine.add_listener(self.on_commit)
+
+    def build(self) -> Dict[Tuple[str, str], Quote]:
+        # A published rate is used in its own direction and, unless the other direction is published too,
+        # inverted for the way back
+        edges: Dict[str, Dict[str, Fraction]] = {}
+        rates = self.data_engine.find_exchange_rates()
+        for rate in rates:
+            edges.setdefault(rate.from_currency_id, {})[rate.to_currency_id] = Fraction(rate.rate)
+        for rate in rates:
+            edges.setdefault(rate.to_currency_id, {}).setdefault(rate.from_currency_id, 1 / Fraction(rate.rate))
+
+        # Breadth first from every currency, so each pair is quoted along the path with the fewest hops
+        table = {}
+        for source in edges:
+            reached = {source: (Fraction(1), ())}
+            frontier = [source]
+            while frontier:
+                next_frontier = []
+                for currency_id in frontier:
+                    rate, via = reached[currency_id]
+                    hop = via + (currency_id,) if currency_id != source else via
+                    for target, edge in edges[currency_id].items():
+                        if target not in reached:
+                            reached[target] = (rate * edge, hop)
+                            next_frontier.append(target)
+                frontier = next_frontier
+            for target, (rate, via) in reached.items():
+                if target != source:
+                    table[source, target] = Quote(rate, via)
+        return table
+
+    def quotes(self) -> Dict[Tuple[str, str], Quote]:
+        table = self.table
+        if table is None:
+            with self.lock:
+                table = self.table
+                if table is None:
+                    generation = self.generation
+                    table = self.build()
+                    if generation == self.generation:
+                        self.table = table
+        return table
+
+    def quote(self, from_currency_id: str, to_currency_id: str) -> Quote | None:
+        return self.quotes().get((from_currency_id, to_currency_id))
+
+    def convert(self, from_currency: Currency, to_currency: Currency, amount: int) -> Conversion | None:
+        # Converts minor units of one currency into minor units of another, rounding down; None without a rate
+        quote = self.quote(from_currency.currency_id, to_currency.currency_id)
+        if quote is None:
+            return None
+        numerator = amount * quote.numerator
+        denominator = quote.denominator
+        if to_currency.scale >= from_currency.scale:
+            numerator *= 10 ** (to_currency.scale - from_currency.scale)
+        else:
+            denominator *= 10 ** (from_currency.scale - to_currency.scale)
+        return Conversion(from_currency.currency_id, amount, to_currency.currency_id, numerator // denominator,
+                          str(quote.rate), list(quote.via))
+
+    def on_commit(self, records: list):
+        for record in iter_records(records):
+            if record["op"] in self.ops:
+                self.generation += 1
+                self.table = None
+                return
@@ -0,0 +1,192 @@
+import cProfile
+import functools
+import heapq
+import os
+import re
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Tuple
+
+# Upper bounds (seconds) of the latency histogram buckets
+DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{escape_label(value)}"' for key, value in labels.items()) + "}"
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.descriptions: Dict[str, Tuple[str, str]] = {}  # name -> (type, help)
+        self.histograms: Dict[str, Dict[tuple, Histogram]] = {}
+        self.counters: Dict[str, Dict[tuple, float]] = {}
+        # Called on every scrape for values owned elsewhere (e.g. cache sizes); yield (name, labels, value)
+        self.collectors: List[Callable[[], Iterable[Tuple[str, dict, float]]]] = []
+
+    def describe(self, name: str, kind: str, text: str):
+        self.descriptions[name] = (kind, text)
+
+    def histogram(self, name: str, **labels) -> Histogram:
+        key = tuple(labels.items())
+        with self.lock:
+            series = self.histograms.setdefault(name, {})
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = Histogram()
+            return histogram
+
+    def observe(self, name: str, value: float, **labels):
+        histogram = self.histogram(name, **labels)
+        with self.lock:
+            histogram.observe(value)
+
+    def increment(self, name: str, amount: float = 1, **labels):
+        key = tuple(labels.items())
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + amount
+
+    def add_collector(self, collector: Callable[[], Iterable[Tuple[str, dict, float]]]):
+        self.collectors.append(collector)
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def instrument(self, obj, method_names: Iterable[str], name: str, label: str = "op"):
+        # Replaces each bound method on this instance with a timed wrapper, so subclasses' overrides are covered too
+        lock = self.lock
+        perf_counter = time.perf_counter
+        for method_name in method_names:
+            method = getattr(obj, method_name, None)
+            if method is None:
+                continue
+
+            # Resolved once here, so a call costs two clock reads and one locked update
+            def wrapper(*args, method=method, histogram=self.histogram(name, **{label: method_name}), **kwargs):
+                start = perf_counter()
+                try:
+                    return method(*args, **kwargs)
+                finally:
+                    elapsed = perf_counter() - start
+                    with lock:
+                        histogram.observe(elapsed)
+
+            setattr(obj, method_name, functools.update_wrapper(wrapper, method))
+
+    def render(self) -> str:
+        # Prometheus text exposition format
+        with self.lock:
+            histograms = {name: {key: (h.buckets, list(h.counts), h.sum, h.count) for key, h in series.items()} for name, series in self.histograms.items()}
+            counters = {name: dict(series) for name, series in self.counters.items()}
+        gauges: Dict[str, List[Tuple[dict, float]]] = {}
+        for collector in self.collectors:
+            for name, labels, value in collector():
+                gauges.setdefault(name, []).append((labels, value))
+
+        lines = []
+        def header(name, default_kind):
+            kind, text = self.descriptions.get(name, (default_kind, ""))
+            if text:
+                lines.append(f"# HELP {name} {text}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        for name in sorted(histograms):
+            header(name, "histogram")
+            for key, (buckets, counts, total, count) in sorted(histograms[name].items()):
+                labels = dict(key)
+                cumulative = 0
+                for bound, bucket_count in zip(buckets, counts):
+                    cumulative += bucket_count
+                    lines.append(f"{name}_bucket{format_labels({**labels, 'le': repr(bound)})} {cumulative}")
+                lines.append(f"{name}_bucket{format_labels({**labels, 'le': '+Inf'})} {count}")
+                lines.append(f"{name}_sum{format_labels(labels)} {total}")
+                lines.append(f"{name}_count{format_labels(labels)} {count}")
+        for name in sorted(counters):
+            header(name, "counter")
+            for key, value in sorted(counters[name].items()):
+                lines.append(f"{name}{format_labels(dict(key))} {value}")
+        for name in sorted(gauges):
+            header(name, "gauge")
+            for labels, value in gauges[name]:
+                lines.append(f"{name}{format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+class SlowRequestProfiler:
+    def __init__(self, directory: str, keep: int):
+        self.directory = directory
+        self.keep = keep
+        # Only one request is profiled at a time; requests arriving meanwhile run unprofiled.
+        # That bounds the overhead and sidesteps interpreters that allow a single active profiler.
+        self.busy = threading.Lock()
+        self.lock = threading.Lock()
+        # Min-heap of (seconds, path) for the slowest profiles written so far
+        self.slowest: List[Tuple[float, str]] = []
+        self.sequence = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def start(self) -> cProfile.Profile | None:
+        if not self.busy.acquire(blocking=False):
+            return None
+        profile = cProfile.Profile()
+        profile.enable()
+        return profile
+
+    def finish(self, profile: cProfile.Profile, seconds: float, route: str):
+        profile.disable()
+        self.busy.release()
+        with self.lock:
+            if len(self.slowest) >= self.keep and seconds <= self.slowest[0][0]:
+                return
+            self.sequence += 1
+            name = re.sub(r"[^A-Za-z0-9]+", "_", route).strip("_") or "root"
+            path = os.path.join(self.directory, f"{seconds * 1000:09.1f}ms-{name}-{self.sequence}.prof")
+            profile.dump_stats(path)
+            heapq.heappush(self.slowest, (seconds, path))
+            if len(self.slowest) > self.keep:
+                _, evicted = heapq.heappop(self.slowest)
+                os.remove(evicted)
+
+
+# Shared by app.py and the storage engines; one registry per worker process
+registry = MetricsRegistry()
+registry.describe("bank_request_seconds", "histogram", "Time spent handling each request, by route and method")
+registry.describe("bank_requests_total", "counter", "Requests answered, by route, method and status")
+registry.describe("bank_storage_op_seconds", "histogram", "Time spent in each storage engine operation")
+registry.describe("bank_storage_saves_total", "counter", "Durable writes: snapshots, journal appends and SQLite commits")
+registry.describe("bank_storage_commits_total", "counter", "Commits made durable; compared with saves it shows how well group commit coalesces")
+registry.describe("bank_storage_bytes_written_total", "counter", "Bytes written to the snapshot, journal and history files")
+registry.describe("bank_token_seconds", "histogram", "Time spent verifying bearer tokens, cache hits and JWT decodes alike")
+registry.describe("bank_password_seconds", "histogram", "Time spent checking and hashing passwords, including the wait for a pool worker")
+registry.describe("bank_token_cache_entries", "gauge", "Verified tokens currently cached")
+registry.describe("bank_token_cache_hits_total", "counter", "Token verifications answered from the cache")
+registry.describe("bank_token_cache_misses_total", "counter", "Token verifications that needed a JWT decode")
+registry.describe("bank_token_cache_revoked", "gauge", "Revoked tokens not yet expired")
+registry.describe("bank_standing_order_runs_total", "counter", "Standing order runs made, by whether their transfer was applied or failed")
@@ -1,7 +1,29 @@
-from typing import List, Union
+import calendar
+import json
+import re
+import sys
+import threading
+from array import array
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, Iterable, List, Tuple, Union
+from money import DEFAULT_SCALE, format_amount, parse_legacy_amount
+
+# Marks files whose money fields are integer minor units rather than legacy floats
+MONEY_FORMAT = "minor_units"
+
+# Serializes first access to lazily stored account histories so an account is never loaded twice
+history_load_lock = threading.Lock()
+
+# Serializes building and extending transaction search indexes against concurrent appends
+transaction_index_lock = threading.Lock()
+
+# DataModel.to_json puts the marker first, so current files can be recognised before parsing them
+CURRENT_FORMAT_PREFIX = re.compile(r'\s*\{\s*"money_format"\s*:\s*"' + MONEY_FORMAT + '"')
 
 class Balance:
-    def __init__(self, currency_id: str, balance: float):
+    __slots__ = ("currency_id", "balance")
+
+    def __init__(self, currency_id: str, balance: int):
         self.currency_id = currency_id
         self.balance = balance
 
@@ -17,6 +39,8 @@ class Balance:
     
 
 class OwnerType:
+    __slots__ = ("type", "owner_id")
+
     def __init__(self, owner_type: str, owner_id: str):
         self.type = owner_type
         self.owner_id = owner_id
@@ -33,6 +57,8 @@ class OwnerType:
 
 
 class Message:
+    __slots__ = ("owner", "data")
+
     def __init__(self, owner: OwnerType, data: str):
         self.owner = owner
         self.data = data
@@ -43,12 +69,14 @@ class Message:
 
     def to_json(self):
         return {
-            "owner": self.owner.to_json(),
+            "from": self.owner.to_json(),
             "data": self.data
         }
 
 
 class Authentication:
+    __slots__ = ("type", "data")
+
     def __init__(self, auth_type: str, data: Union[int, dict, None] = None):
         self.type = auth_type
         self.data = data
@@ -65,17 +93,20 @@ class Authentication:
 
 
 class Currency:
-    def __init__(self, currency_id: str, name: str, code: str, symbol: str, bank_id: str, created_at: str):
+    __slots__ = ("currency_id", "name", "code", "symbol", "bank_id", "created_at", "scale")
+
+    def __init__(self, currency_id: str, name: str, code: str, symbol: str, bank_id: str, created_at: str, scale: int = DEFAULT_SCALE):
         self.currency_id = currency_id
         self.name = name
         self.code = code
         self.symbol = symbol
         self.bank_id = bank_id
         self.created_at = created_at
+        self.scale = scale
 
     @classmethod
     def from_json(cls, data):
-        return cls(data["currency_id"], data["name"], data["code"], data["symbol"], data["bank_id"], data["created_at"])
+        return cls(data["currency_id"], data["name"], data["code"], data["symbol"], data["bank_id"], data["created_at"], data.get("scale", DEFAULT_SCALE))
 
     def to_json(self):
         return {
@@ -84,18 +115,79 @@ class Currency:
             "code": self.code,
             "symbol": self.symbol,
             "bank_id": self.bank_id,
-            "created_at": self.created_at
+            "created_at": self.created_at,
+            "scale": self.scale
+        }
+
+
+class ExchangeRate:
+    __slots__ = ("bank_id", "from_currency_id", "to_currency_id", "rate", "updated_at")
+
+    def __init__(self, bank_id: str, from_currency_id: str, to_currency_id: str, rate: str, updated_at: str):
+        self.bank_id = bank_id
+        self.from_currency_id = from_currency_id
+        self.to_currency_id = to_currency_id
+        # Units of to_currency one unit of from_currency buys, as a decimal string so no precision is lost
+        self.rate = rate
+        self.updated_at = updated_at
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(data["bank_id"], data["from"], data["to"], data["rate"], data.get("updated_at", ""))
+
+    def to_json(self):
+        return {
+            "bank_id": self.bank_id,
+            "from": self.from_currency_id,
+            "to": self.to_currency_id,
+            "rate": self.rate,
+            "updated_at": self.updated_at
         }
 
 
+class Conversion:
+    # The exchange behind a cross-currency transfer, stored with the transactions on both sides.
+    # rate is the exact rate applied ("n" or "n/d"); via lists the currencies a multi-hop rate went through.
+    __slots__ = ("from_currency_id", "from_amount", "to_currency_id", "to_amount", "rate", "via")
+
+    def __init__(self, from_currency_id: str, from_amount: int, to_currency_id: str, to_amount: int, rate: str, via: List[str]):
+        self.from_currency_id = from_currency_id
+        self.from_amount = from_amount
+        self.to_currency_id = to_currency_id
+        self.to_amount = to_amount
+        self.rate = rate
+        self.via = via
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(data["from_currency_id"], data["from_amount"], data["to_currency_id"], data["to_amount"], data["rate"], data.get("via", []))
+
+    def to_json(self):
+        return {
+            "from_currency_id": self.from_currency_id,
+            "from_amount": self.from_amount,
+            "to_currency_id": self.to_currency_id,
+            "to_amount": self.to_amount,
+            "rate": self.rate,
+            "via": self.via
+        }
+
+    def display_json(self, from_scale: int, to_scale: int):
+        # As served over the API, with both amounts formatted in their own currency's scale
+        return {**self.to_json(), "from_amount": format_amount(self.from_amount, from_scale), "to_amount": format_amount(self.to_amount, to_scale)}
+
+
 class Transaction:
-    def __init__(self, from_id: str, to_id: str, when: str, currency_id: str, previous_balance: float, new_balance: float):
+    __slots__ = ("from_id", "to_id", "when", "currency_id", "previous_balance", "new_balance", "conversion")
+
+    def __init__(self, from_id: str, to_id: str, when: str, currency_id: str, previous_balance: int, new_balance: int, conversion: Conversion | None = None):
         self.from_id = from_id
         self.to_id = to_id
         self.when = when
         self.currency_id = currency_id
         self.previous_balance = previous_balance
         self.new_balance = new_balance
+        self.conversion = conversion
 
     @classmethod
     def from_json(cls, data):
@@ -103,10 +195,11 @@ class Transaction:
         currency_id = currency_data.get("currency_id", "")
         previous_balance = currency_data.get("previous_balance", 0)
         new_balance = currency_data.get("new_balance", 0)
-        return cls(data.get("from", ""), data.get("to", ""), data.get("when", ""), currency_id, previous_balance, new_balance)
+        conversion = Conversion.from_json(data["conversion"]) if data.get("conversion") else None
+        return cls(data.get("from", ""), data.get("to", ""), data.get("when", ""), currency_id, previous_balance, new_balance, conversion)
 
     def to_json(self):
-        return {
+        data = {
             "from": self.from_id,
             "to": self.to_id,
             "when": self.when,
@@ -116,9 +209,220 @@ class Transaction:
                 "new_balance": self.new_balance
             }
         }
+        if self.conversion is not None:
+            data["conversion"] = self.conversion.to_json()
+        return data
+
+
+def parse_when(when: str) -> float:
+    # Transaction.when as POSIX seconds (the stored times carry no zone and are read as UTC); 0 if unparsable
+    try:
+        return datetime.fromisoformat(when).replace(tzinfo=timezone.utc).timestamp()
+    except ValueError:
+        return 0.0
+
+
+class TransactionIndex:
+    # Secondary indexes over one TransactionHistory: the rows each account appears in (on either side), the rows
+    # in each currency, and every row's parsed timestamp. Histories are appended in time order, so each row list
+    # is sorted by time as well and a time range is two binary searches over times.
+    __slots__ = ("by_account", "by_currency", "times")
+
+    def __init__(self):
+        self.by_account: Dict[str, array] = {}
+        self.by_currency: Dict[str, array] = {}
+        self.times = array("d")
+
+    def catch_up(self, history: "TransactionHistory"):
+        # Indexes the rows added since the last call; new_balances is the column append_row fills last
+        for row in range(len(self.times), len(history.new_balances)):
+            self.add(row, history.from_ids[row], history.to_ids[row], history.whens[row], history.currency_ids[row])
+
+    def add(self, row: int, from_id: str, to_id: str, when: str, currency_id: str):
+        self.by_account.setdefault(from_id, array("q")).append(row)
+        if to_id != from_id:
+            self.by_account.setdefault(to_id, array("q")).append(row)
+        self.by_currency.setdefault(currency_id, array("q")).append(row)
+        # A clock stepping backwards is recorded at the previous time so the column stays sorted
+        time = parse_when(when)
+        self.times.append(max(time, self.times[-1]) if self.times else time)
+
+
+class TransactionHistory:
+    # Column-per-field storage for an account's transactions. Ids are interned so the many repeats share one
+    # string, and money columns are packed 64-bit integers. Transaction objects are only built on access.
+    __slots__ = ("from_ids", "to_ids", "whens", "currency_ids", "previous_balances", "new_balances", "conversions", "index")
+
+    def __init__(self, transactions: Iterable[Transaction] = ()):
+        self.from_ids: List[str] = []
+        self.to_ids: List[str] = []
+        self.whens: List[str] = []
+        self.currency_ids: List[str] = []
+        self.previous_balances = array("q")
+        self.new_balances = array("q")
+        # Few transactions convert currency, so their conversions are kept by row number instead of as a column
+        self.conversions: Dict[int, Conversion] = {}
+        # Built on the first search and kept up to date by append_row from then on
+        self.index: TransactionIndex | None = None
+        for transaction in transactions:
+            self.append(transaction)
+
+    def append_row(self, from_id: str, to_id: str, when: str, currency_id: str, previous_balance: int, new_balance: int,
+                   conversion: Conversion | None = None):
+        if conversion is not None:
+            self.conversions[len(self.whens)] = conversion
+        self.from_ids.append(sys.intern(from_id))
+        self.to_ids.append(sys.intern(to_id))
+        self.whens.append(when)
+        self.currency_ids.append(sys.intern(currency_id))
+        self.previous_balances.append(previous_balance)
+        self.new_balances.append(new_balance)
+        if self.index is not None:
+            with transaction_index_lock:
+                self.index.catch_up(self)
+
+    def append(self, transaction: Transaction):
+        self.append_row(transaction.from_id, transaction.to_id, transaction.when, transaction.currency_id,
+                        transaction.previous_balance, transaction.new_balance, transaction.conversion)
+
+    def __len__(self):
+        return len(self.whens)
+
+    def search_index(self) -> TransactionIndex:
+        if self.index is None:
+            with transaction_index_lock:
+                if self.index is None:
+                    index = TransactionIndex()
+                    index.catch_up(self)
+                    self.index = index
+                    # A row appended before the index was published skipped it in append_row; pick it up here
+                    index.catch_up(self)
+        return self.index
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self.whens)
+        return Transaction(self.from_ids[index], self.to_ids[index], self.whens[index], self.currency_ids[index],
+                           self.previous_balances[index], self.new_balances[index], self.conversions.get(index))
+
+    def __iter__(self):
+        return map(Transaction, self.from_ids, self.to_ids, self.whens, self.currency_ids, self.previous_balances, self.new_balances,
+                   map(self.conversions.get, range(len(self.whens))))
+
+    @classmethod
+    def from_json(cls, data):
+        history = cls()
+        for t in data:
+            currency_data = t.get("currency", {})
+            history.append_row(t.get("from", ""), t.get("to", ""), t.get("when", ""), currency_data.get("currency_id", ""),
+                               currency_data.get("previous_balance", 0), currency_data.get("new_balance", 0),
+                               Conversion.from_json(t["conversion"]) if t.get("conversion") else None)
+        return history
+
+    @classmethod
+    def from_columns(cls, from_ids: List[str], to_ids: List[str], whens: List[str], currency_ids: List[str],
+                     previous_balances: array, new_balances: array, conversions: Dict[int, Conversion]):
+        # Takes ownership of ready-made columns, as read from a binary history segment; ids must already be interned
+        history = cls()
+        history.from_ids = from_ids
+        history.to_ids = to_ids
+        history.whens = whens
+        history.currency_ids = currency_ids
+        history.previous_balances = previous_balances
+        history.new_balances = new_balances
+        history.conversions = conversions
+        return history
+
+    def to_json(self):
+        return [t.to_json() for t in self]
+
+
+# Timestamps as stored throughout the data file
+WHEN_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+
+# Units a standing order can repeat in
+ORDER_INTERVALS = ("day", "week", "month")
+
+def add_months(moment: datetime, months: int) -> datetime:
+    # Same day of the month, or the month's last day when it is shorter (a payment on the 31st moves to the 30th)
+    month_index = moment.month - 1 + months
+    year, month = moment.year + month_index // 12, month_index % 12 + 1
+    return moment.replace(year=year, month=month, day=min(moment.day, calendar.monthrange(year, month)[1]))
+
+
+class StandingOrder:
+    # A transfer repeated every `every` intervals from `start`. Run n is always due at start + n intervals,
+    # so a month with fewer days never shifts later runs, and runs counts the ones done (applied or failed).
+    __slots__ = ("order_id", "account_id", "to_id", "currency_id", "to_currency_id", "amount", "interval", "every",
+                 "start", "runs", "created_at", "last_run", "last_status")
+
+    def __init__(self, order_id: str, account_id: str, to_id: str, currency_id: str, to_currency_id: str | None, amount: int,
+                 interval: str, every: int, start: str, runs: int, created_at: str, last_run: str | None = None,
+                 last_status: str | None = None):
+        self.order_id = order_id
+        self.account_id = account_id
+        self.to_id = to_id
+        self.currency_id = currency_id
+        # Credited in another currency when set, converted at the rate of the day
+        self.to_currency_id = to_currency_id
+        self.amount = amount
+        self.interval = interval
+        self.every = every
+        self.start = start
+        self.runs = runs
+        self.created_at = created_at
+        self.last_run = last_run
+        # "applied", or why the last run was not
+        self.last_status = last_status
+
+    def run_time(self, run: int) -> str:
+        start = datetime.fromisoformat(self.start)
+        if self.interval == "month":
+            moment = add_months(start, run * self.every)
+        else:
+            moment = start + timedelta(days=run * self.every * (7 if self.interval == "week" else 1))
+        return moment.strftime(WHEN_FORMAT)
+
+    @property
+    def next_run(self) -> str:
+        return self.run_time(self.runs)
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(data["order_id"], data["account_id"], data["to"], data["currency_id"], data.get("to_currency_id"), data["amount"],
+                   data["interval"], data.get("every", 1), data["start"], data.get("runs", 0), data.get("created_at", ""),
+                   data.get("last_run"), data.get("last_status"))
+
+    def to_json(self):
+        return {
+            "order_id": self.order_id,
+            "account_id": self.account_id,
+            "to": self.to_id,
+            "currency_id": self.currency_id,
+            "to_currency_id": self.to_currency_id,
+            "amount": self.amount,
+            "interval": self.interval,
+            "every": self.every,
+            "start": self.start,
+            "runs": self.runs,
+            # Derived from start and runs; stored so the file shows when the order runs next
+            "next_run": self.next_run,
+            "created_at": self.created_at,
+            "last_run": self.last_run,
+            "last_status": self.last_status
+        }
+
+    def display_json(self, scale: int = DEFAULT_SCALE):
+        data = self.to_json()
+        data["amount"] = format_amount(self.amount, scale)
+        return data
 
 
 class User:
+    __slots__ = ("user_id", "name", "email", "password", "created_at")
+
     def __init__(self, user_id: str, name: str, email: str, password: str, created_at: str):
         self.user_id = user_id
         self.name = name
@@ -141,10 +445,15 @@ class User:
 
 
 class BankAdminAuthentication:
+    __slots__ = ("user_id", "permissions")
+
     def __init__(self, user_id: str, permissions: List[str]):
         self.user_id = user_id
         self.permissions = permissions
 
+    def allows(self, permission: str) -> bool:
+        return "*" in self.permissions or permission in self.permissions
+
     @classmethod
     def from_json(cls, data):
         return cls(data.get("user_id", ""), data.get("permissions", []))
@@ -157,16 +466,60 @@ class BankAdminAuthentication:
 
 
 class Account:
-    def __init__(self, account_id: str, bank_id: str, type_id: str, owner: OwnerType, created_at: str, balance: List[Balance], messages: List[Message], transactions: List[Transaction], authentication: List[Authentication]):
+    __slots__ = ("account_id", "bank_id", "type_id", "owner", "created_at", "balances", "loaded_messages", "loaded_transactions",
+                 "authentication", "standing_orders", "history_loader", "history_segment", "history_dirty")
+
+    def __init__(self, account_id: str, bank_id: str, type_id: str, owner: OwnerType, created_at: str, balances: Dict[str, int], messages: List[Message] | None, transactions: Iterable[Transaction] | None, authentication: List[Authentication], history_loader: Callable | None = None, history_segment: dict | None = None, standing_orders: List[StandingOrder] | None = None):
         self.account_id = account_id
         self.bank_id = bank_id
         self.type_id = type_id
         self.owner = owner
         self.created_at = created_at
-        self.balance = balance
-        self.messages = messages
-        self.transactions = transactions
+        # currency_id -> balance in minor units; an account may hold any number of currencies
+        self.balances = balances
+        # Messages and transactions of None are read on first access through history_loader
+        self.loaded_messages = messages
+        self.loaded_transactions = None if transactions is None else transactions if isinstance(transactions, TransactionHistory) else TransactionHistory(transactions)
         self.authentication = authentication
+        # Kept with the account header rather than its history, as the scheduler needs them all at startup
+        self.standing_orders = standing_orders if standing_orders is not None else []
+        self.history_loader = history_loader
+        # Where the history is stored outside the snapshot, and whether it changed since it was stored there
+        self.history_segment = history_segment
+        self.history_dirty = False
+
+    @property
+    def history_loaded(self) -> bool:
+        return self.loaded_transactions is not None
+
+    def load_history(self):
+        with history_load_lock:
+            if self.loaded_transactions is None:
+                self.loaded_messages, self.loaded_transactions = self.history_loader(self)
+
+    @property
+    def messages(self) -> List[Message]:
+        if self.loaded_transactions is None:
+            self.load_history()
+        return self.loaded_messages
+
+    @messages.setter
+    def messages(self, messages: List[Message]):
+        if self.loaded_transactions is None:
+            self.load_history()
+        self.loaded_messages = messages
+
+    @property
+    def transactions(self) -> TransactionHistory:
+        if self.loaded_transactions is None:
+            self.load_history()
+        return self.loaded_transactions
+
+    @transactions.setter
+    def transactions(self, transactions: Iterable[Transaction]):
+        if self.loaded_transactions is None:
+            self.load_history()
+        self.loaded_transactions = transactions if isinstance(transactions, TransactionHistory) else TransactionHistory(transactions)
 
     @classmethod
     def from_json(cls, data):
@@ -178,33 +531,52 @@ class Account:
         if authentication_data == None:
             authentication_data = []
 
+        # Accounts saved with a history segment only carry their header in the snapshot
+        history_segment = data.get("history")
+        lazy = history_segment is not None and "transactions" not in data
+
         return cls(
             data.get("account_id", ""),
             data.get("bank_id", ""),
             data.get("type_id", ""),
             OwnerType.from_json(data.get("owner", {})),
             data.get("created_at", ""),
-            [Balance.from_json(b) for b in balance_data],
-            [Message.from_json(m) for m in messages_data],
-            [Transaction.from_json(t) for t in transactions_data],
-            [Authentication.from_json(a) for a in authentication_data]
+            {b["currency_id"]: b["balance"] for b in balance_data},
+            None if lazy else [Message.from_json(m) for m in messages_data],
+            None if lazy else TransactionHistory.from_json(transactions_data),
+            [Authentication.from_json(a) for a in authentication_data],
+            history_segment=history_segment if lazy else None,
+            standing_orders=[StandingOrder.from_json(o) for o in data.get("standing_orders", [])]
         )
 
-    def to_json(self):
+    def history_json(self):
         return {
+            "messages": [m.to_json() for m in self.messages],
+            "transactions": self.transactions.to_json()
+        }
+
+    def to_json(self, include_history: bool = True):
+        data = {
             "account_id": self.account_id,
             "bank_id": self.bank_id,
             "type_id": self.type_id,
             "owner": self.owner.to_json(),
             "created_at": self.created_at,
-            "balance": [b.to_json() for b in self.balance],
-            "messages": [m.to_json() for m in self.messages],
-            "transactions": [t.to_json() for t in self.transactions],
-            "authentication": [a.to_json() for a in self.authentication]
+            # Still a list of Balance objects on disk and over the API, as before the map
+            "balance": [Balance(currency_id, balance).to_json() for currency_id, balance in self.balances.items()]
         }
+        if include_history:
+            data.update(self.history_json())
+        else:
+            data["history"] = self.history_segment
+        data["authentication"] = [a.to_json() for a in self.authentication]
+        data["standing_orders"] = [o.to_json() for o in self.standing_orders]
+        return data
 
 
 class AccountType:
+    __slots__ = ("type_id", "name", "description")
+
     def __init__(self, type_id: str, name: str, description: str):
         self.type_id = type_id
         self.name = name
@@ -223,6 +595,8 @@ class AccountType:
 
 
 class Bank:
+    __slots__ = ("bank_id", "name", "bank_type", "created_at", "account_types", "admin_authentication", "accounts")
+
     def __init__(self, bank_id: str, name: str, bank_type: str, created_at: str, account_types: List[AccountType], admin_authentication: List[BankAdminAuthentication], accounts: List[Account]):
         self.bank_id = bank_id
         self.name = name
@@ -248,7 +622,7 @@ class Bank:
             [Account.from_json(a) for a in accounts_data]
         )
 
-    def to_json(self):
+    def to_json(self, include_history: bool = True):
         return {
             "bank_id": self.bank_id,
             "name": self.name,
@@ -256,18 +630,52 @@ class Bank:
             "created_at": self.created_at,
             "account_types": [a.to_json() for a in self.account_types],
             "admin_authentication": [a.to_json() for a in self.admin_authentication],
-            "accounts": [a.to_json() for a in self.accounts]
+            "accounts": [a.to_json(include_history) for a in self.accounts]
+        }
+
+    def info_json(self):
+        # Public reference data only: no accounts and no admin list
+        return {
+            "bank_id": self.bank_id,
+            "name": self.name,
+            "bank_type": self.bank_type,
+            "created_at": self.created_at,
+            "account_types": [a.to_json() for a in self.account_types]
         }
 
 
 class DataModel:
-    def __init__(self, currencies: List[Currency], users: List[User], banks: List[Bank]):
+    __slots__ = ("currencies", "users", "banks", "exchange_rates", "revoked_tokens")
+
+    def __init__(self, currencies: List[Currency], users: List[User], banks: List[Bank], exchange_rates: List[ExchangeRate] | None = None,
+                 revoked_tokens: Dict[str, float] | None = None):
         self.currencies = currencies
         self.users = users
         self.banks = banks
+        self.exchange_rates = exchange_rates if exchange_rates is not None else []
+        # Hex digest of each logged-out token -> its expiry, kept until it would have expired anyway
+        self.revoked_tokens = revoked_tokens if revoked_tokens is not None else {}
+
+    @staticmethod
+    def upgrade_money(data: dict):
+        # Rewrites legacy float balances in place as integer minor units using each currency's scale
+        if data.get("money_format") == MONEY_FORMAT:
+            return
+        scales: Dict[str, int] = {c["currency_id"]: c.get("scale", DEFAULT_SCALE) for c in data.get("currencies", [])}
+        for bank in data.get("banks", []):
+            for account in bank.get("accounts", []):
+                for balance in account.get("balance", []):
+                    balance["balance"] = parse_legacy_amount(balance["balance"], scales.get(balance["currency_id"], DEFAULT_SCALE))
+                for transaction in account.get("transactions", []):
+                    currency = transaction.get("currency", {})
+                    scale = scales.get(currency.get("currency_id"), DEFAULT_SCALE)
+                    currency["previous_balance"] = parse_legacy_amount(currency.get("previous_balance", 0), scale)
+                    currency["new_balance"] = parse_legacy_amount(currency.get("new_balance", 0), scale)
+        data["money_format"] = MONEY_FORMAT
 
     @classmethod
     def from_json(cls, data):
+        cls.upgrade_money(data)
         currencies_data = data.get("currencies", [])
         users_data = data.get("users", [])
         banks_data = data.get("banks", [])
@@ -275,12 +683,63 @@ class DataModel:
         return cls(
             [Currency.from_json(c) for c in currencies_data],
             [User.from_json(u) for u in users_data],
-            [Bank.from_json(b) for b in banks_data]
+            [Bank.from_json(b) for b in banks_data],
+            [ExchangeRate.from_json(r) for r in data.get("exchange_rates", [])],
+            dict(data.get("revoked_tokens", {}))
         )
 
-    def to_json(self):
+    @classmethod
+    def loads(cls, text: str) -> Tuple["DataModel", dict]:
+        # Returns the model and any other top-level fields of the file (such as the journal sequence).
+        # Current files are turned into model objects while they are parsed, so the dict tree for the whole
+        # file never exists alongside the model. Legacy files still need the full tree to upgrade their money.
+        if not CURRENT_FORMAT_PREFIX.match(text):
+            data = json.loads(text)
+            model = cls.from_json(data)
+        else:
+            data = json.loads(text, object_pairs_hook=model_object_hook)
+            model = cls(
+                [Currency.from_json(c) for c in data.get("currencies", [])],
+                [User.from_json(u) for u in data.get("users", [])],
+                data.get("banks", []),
+                [ExchangeRate.from_json(r) for r in data.get("exchange_rates", [])],
+                dict(data.get("revoked_tokens", {}))
+            )
+        return model, {key: value for key, value in data.items()
+                       if key not in ("currencies", "users", "banks", "exchange_rates", "revoked_tokens")}
+
+    def to_json(self, include_history: bool = True):
         return {
+            "money_format": MONEY_FORMAT,
             "currencies": [c.to_json() for c in self.currencies],
             "users": [u.to_json() for u in self.users],
-            "banks": [b.to_json() for b in self.banks]
+            "banks": [b.to_json(include_history) for b in self.banks],
+            "exchange_rates": [r.to_json() for r in self.exchange_rates],
+            "revoked_tokens": dict(self.revoked_tokens)
         }
+
+
+def model_object_hook(pairs):
+    # Called by the JSON parser for every object, innermost first
+    data = dict(pairs)
+    if "when" in data and "to" in data and "currency" in data:
+        currency_data = data["currency"]
+        return (data.get("from", ""), data["to"], data["when"], currency_data.get("currency_id", ""),
+                currency_data.get("previous_balance", 0), currency_data.get("new_balance", 0),
+                Conversion.from_json(data["conversion"]) if data.get("conversion") else None)
+    if "account_id" in data and "owner" in data:
+        rows = data.pop("transactions", None)
+        if rows is not None:
+            data["transactions"] = []
+        account = Account.from_json(data)
+        if rows:
+            transactions = account.transactions
+            for row in rows:
+                transactions.append_row(*row)
+        return account
+    if "bank_id" in data and "accounts" in data:
+        accounts = data.pop("accounts")
+        bank = Bank.from_json(data)
+        bank.accounts = accounts
+        return bank
+    return data
@@ -0,0 +1,75 @@
+from decimal import ROUND_HALF_EVEN, Decimal, DecimalException, InvalidOperation
+
+# Number of decimal places used when a currency does not specify its own
+DEFAULT_SCALE = 2
+
+# Largest amount or balance in minor units: transaction histories store money as signed 64-bit integers
+MAX_MINOR_UNITS = 2 ** 63 - 1
+
+# Published exchange rates are kept within this range (each one's inverse is too) and to this many significant digits
+MIN_RATE = Decimal("1e-9")
+MAX_RATE = Decimal("1e9")
+MAX_RATE_DIGITS = 18
+
+def decimal_amount(value) -> Decimal:
+    # A number or decimal string as an exact Decimal; floats are read from their shortest repr
+    if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+        raise ValueError(f"Invalid amount: {value!r}")
+    try:
+        amount = Decimal(repr(value) if isinstance(value, float) else str(value).strip())
+    except InvalidOperation:
+        raise ValueError(f"Invalid amount: {value!r}")
+    if not amount.is_finite():
+        raise ValueError(f"Invalid amount: {value!r}")
+    return amount
+
+def minor_units(amount: Decimal, value) -> int:
+    # An integral Decimal amount as an int, refused when the history could not store it
+    if abs(amount) > MAX_MINOR_UNITS:
+        raise ValueError(f"Amount {value!r} is too large")
+    return int(amount)
+
+def parse_amount(value, scale: int = DEFAULT_SCALE) -> int:
+    # Converts an API value (number or decimal string) into integer minor units
+    try:
+        minor = decimal_amount(value).scaleb(scale)
+        exact = minor == minor.to_integral_value()
+    except DecimalException:
+        # Exponents too large for the decimal context, e.g. "1e999999999"
+        raise ValueError(f"Invalid amount: {value!r}")
+    if not exact:
+        raise ValueError(f"Amount {value!r} has more than {scale} decimal places")
+    return minor_units(minor, value)
+
+def parse_legacy_amount(value, scale: int = DEFAULT_SCALE) -> int:
+    # Converts a balance stored as a float by older versions. Float arithmetic left values such as
+    # 100.0 - 99.9 = 0.09999999999999432, so they are rounded half to even to the currency's scale.
+    try:
+        minor = decimal_amount(value).scaleb(scale).quantize(Decimal(1), rounding=ROUND_HALF_EVEN)
+    except DecimalException:
+        raise ValueError(f"Invalid amount: {value!r}")
+    return minor_units(minor, value)
+
+def format_amount(minor: int, scale: int = DEFAULT_SCALE) -> str:
+    # Exact decimal string for integer minor units, e.g. 123456 at scale 2 -> "1234.56"
+    sign = "-" if minor < 0 else ""
+    whole, fraction = divmod(abs(minor), 10 ** scale)
+    if scale == 0:
+        return f"{sign}{whole}"
+    return f"{sign}{whole}.{fraction:0{scale}d}"
+
+def parse_rate(value) -> str:
+    # Validates an exchange rate (number or decimal string) and returns it as an exact decimal string
+    if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+        raise ValueError(f"Invalid rate: {value!r}")
+    try:
+        rate = Decimal(repr(value) if isinstance(value, float) else str(value).strip())
+    except InvalidOperation:
+        raise ValueError(f"Invalid rate: {value!r}")
+    if not rate.is_finite() or rate <= 0:
+        raise ValueError(f"Invalid rate: {value!r}")
+    if not MIN_RATE <= rate <= MAX_RATE:
+        raise ValueError(f"Rate {value!r} is outside {MIN_RATE} to {MAX_RATE}")
+    if len(rate.normalize().as_tuple().digits) > MAX_RATE_DIGITS:
+        raise ValueError(f"Rate {value!r} has more than {MAX_RATE_DIGITS} significant digits")
+    return str(rate)
@@ -0,0 +1,66 @@
+import base64
+import hashlib
+import hmac
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Stored hashes look like "scrypt$<n>$<r>$<p>$<salt>$<hash>"; anything else is a legacy plaintext password
+SCHEME = "scrypt"
+SALT_BYTES = 16
+HASH_BYTES = 32
+
+class PasswordPoolBusy(Exception):
+    pass
+
+
+def scrypt(password: str, salt: bytes, n: int, r: int, p: int) -> bytes:
+    return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p, maxmem=256 * n * r + (1 << 20), dklen=HASH_BYTES)
+
+def hash_password(password: str, n: int, r: int = 8, p: int = 1) -> str:
+    salt = os.urandom(SALT_BYTES)
+    digest = scrypt(password, salt, n, r, p)
+    return "$".join([SCHEME, str(n), str(r), str(p), base64.b64encode(salt).decode(), base64.b64encode(digest).decode()])
+
+def verify_password(password: str, stored: str) -> bool:
+    if not stored.startswith(SCHEME + "$"):
+        return hmac.compare_digest(password.encode(), stored.encode())
+    _, n, r, p, salt, digest = stored.split("$")
+    return hmac.compare_digest(scrypt(password, base64.b64decode(salt), int(n), int(r), int(p)), base64.b64decode(digest))
+
+
+class PasswordHasher:
+    def __init__(self, n: int = 2 ** 14, r: int = 8, p: int = 1, workers: int | None = None, max_pending: int = 64):
+        self.n = n
+        self.r = r
+        self.p = p
+        # hashlib.scrypt releases the GIL, so a thread pool spreads hashing across cores
+        self.pool = ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1, thread_name_prefix="password")
+        # Caps queued work so a login storm is turned away instead of piling up behind the pool
+        self.slots = threading.BoundedSemaphore(max_pending)
+        # Verified against when the user does not exist, so unknown emails take as long as wrong passwords
+        self.dummy_hash = hash_password("", n, r, p)
+
+    def run(self, func, *args):
+        if not self.slots.acquire(blocking=False):
+            raise PasswordPoolBusy("Too many password checks in progress")
+        try:
+            return self.pool.submit(func, *args).result()
+        finally:
+            self.slots.release()
+
+    def hash(self, password: str) -> str:
+        return self.run(hash_password, password, self.n, self.r, self.p)
+
+    def verify(self, password: str, stored: str | None) -> bool:
+        if stored is None:
+            self.run(verify_password, password, self.dummy_hash)
+            return False
+        return self.run(verify_password, password, stored)
+
+    def needs_rehash(self, stored: str) -> bool:
+        # Plaintext records and hashes made with weaker parameters are upgraded on the next successful login
+        if not stored.startswith(SCHEME + "$"):
+            return True
+        _, n, r, p, _, _ = stored.split("$")
+        return (int(n), int(r), int(p)) != (self.n, self.r, self.p)
@@ -0,0 +1,47 @@
+import hashlib
+import json
+import threading
+from storage import DataEngine, iter_records
+from typing import Dict, Tuple
+
+class ReferenceData:
+    # Ops that change what the /info endpoints return; new accounts and transfers do not
+    ops = {"currency": ("currencies",), "bank": ("banks",), "rate": ("exchange_rates",), "reload": ("banks", "currencies", "exchange_rates")}
+
+    def __init__(self, data_engine: DataEngine):
+        self.data_engine = data_engine
+        self.lock = threading.Lock()
+        # name -> (serialized body, ETag), rebuilt on the first request after a change
+        self.responses: Dict[str, Tuple[bytes, str]] = {}
+        # Bumped by every change, so a response rendered from data read before the change is not kept
+        self.generation = 0
+        data_engine.add_listener(self.on_commit)
+
+    def render(self, name: str) -> dict:
+        if name == "banks":
+            return {"banks": [bank.info_json() for bank in self.data_engine.find_banks()]}
+        if name == "exchange_rates":
+            return {"exchange_rates": [rate.to_json() for rate in self.data_engine.find_exchange_rates()]}
+        return {"currencies": [currency.to_json() for currency in self.data_engine.find_currencies()]}
+
+    def get(self, name: str) -> Tuple[bytes, str]:
+        response = self.responses.get(name)
+        if response is None:
+            with self.lock:
+                response = self.responses.get(name)
+                if response is None:
+                    generation = self.generation
+                    body = json.dumps(self.render(name)).encode()
+                    # Derived from the content, so every worker and every restart hands out the same ETag
+                    response = body, hashlib.sha256(body).hexdigest()[:32]
+                    if generation == self.generation:
+                        self.responses[name] = response
+        return response
+
+    def on_commit(self, records: list):
+        for record in iter_records(records):
+            names = self.ops.get(record["op"], ())
+            if names:
+                self.generation += 1
+            for name in names:
+                self.responses.pop(name, None)
@@ -0,0 +1,235 @@
+import heapq
+import threading
+from array import array
+from datetime import datetime, timedelta
+from models import WHEN_FORMAT, add_months
+from storage import PERIOD_PREFIX, DataEngine, iter_records, transfer_sides
+from typing import Dict, List, Set, Tuple
+
+try:
+    import numpy
+except ImportError:
+    numpy = None  # The same columns are aggregated in plain Python instead
+
+# Longest top accounts list kept for each currency
+MAX_TOP_ACCOUNTS = 100
+
+# Format of each period's key, the first PERIOD_PREFIX characters of Transaction.when
+PERIOD_FORMATS = {"day": "%Y-%m-%d", "month": "%Y-%m", "year": "%Y"}
+
+# Length of every timestamp written in WHEN_FORMAT
+WHEN_LENGTH = len(datetime(2000, 1, 1).strftime(WHEN_FORMAT))
+
+# currency_id -> {"total": sum of balances, "accounts": accounts holding it, "top": [(account_id, balance), ...]}
+BalanceReport = Dict[str, dict]
+# Period key -> currency_id -> [money in, money out, rows]
+VolumeReport = Dict[str, Dict[str, List[int]]]
+
+def period_bounds(period: str, key: str) -> Tuple[str, str]:
+    # The first and last timestamp within one period, e.g. the month "2026-10"
+    start = datetime.strptime(key, PERIOD_FORMATS[period])
+    if period == "day":
+        end = start + timedelta(days=1)
+    elif period == "month":
+        end = add_months(start, 1)
+    else:
+        end = start.replace(year=start.year + 1)
+    return start.strftime(WHEN_FORMAT), (end - timedelta(microseconds=1)).strftime(WHEN_FORMAT)
+
+def balance_report(account_ids: List[str], currency_ids: List[str], balances: array) -> BalanceReport:
+    rows: Dict[str, List[int]] = {}
+    for row, currency_id in enumerate(currency_ids):
+        rows.setdefault(currency_id, []).append(row)
+    report = {}
+    for currency_id in sorted(rows):
+        currency_rows = rows[currency_id]
+        top = heapq.nlargest(MAX_TOP_ACCOUNTS, currency_rows, key=balances.__getitem__)
+        report[currency_id] = {
+            "total": sum(map(balances.__getitem__, currency_rows)),
+            "accounts": len(currency_rows),
+            "top": [(account_ids[row], balances[row]) for row in top]
+        }
+    return report
+
+def volume_report(prefix: int, whens: List[str], currency_ids: List[str], previous_balances: array, new_balances: array) -> VolumeReport:
+    report: VolumeReport = {}
+    for when, currency_id, previous_balance, new_balance in zip(whens, currency_ids, previous_balances, new_balances):
+        totals = report.setdefault(when[:prefix], {}).get(currency_id)
+        if totals is None:
+            totals = report[when[:prefix]][currency_id] = [0, 0, 0]
+        delta = new_balance - previous_balance
+        if delta >= 0:
+            totals[0] += delta
+        else:
+            totals[1] -= delta
+        totals[2] += 1
+    return report
+
+def factorize(values: List[str]) -> Tuple[List[str], "numpy.ndarray"]:
+    # The distinct values in order and each row's position among them. Ids repeat a lot, so mapping through a
+    # dict (C calls only) is cheaper than building a fixed-width string array for numpy.unique.
+    distinct = sorted(set(values))
+    codes = {value: code for code, value in enumerate(distinct)}
+    return distinct, numpy.fromiter(map(codes.__getitem__, values), numpy.int64, len(values))
+
+def period_codes(prefix: int, whens: List[str]) -> "numpy.ndarray":
+    # A number per row that is equal for rows in the same period. Stored timestamps are all WHEN_LENGTH ASCII
+    # characters, so their bytes are read as a matrix and the period's digits summed into e.g. 20261018 for a day;
+    # other timestamps fall back to sorting their prefixes as strings.
+    raw = numpy.frombuffer(("\n".join(whens) + "\n").encode(), numpy.uint8)
+    if len(raw) != len(whens) * (WHEN_LENGTH + 1):
+        return numpy.unique(numpy.array(whens, dtype=f"U{prefix}"), return_inverse=True)[1]
+    digits = raw.reshape(len(whens), WHEN_LENGTH + 1)[:, [i for i in range(prefix) if i not in (4, 7)]].astype(numpy.int64) - ord("0")
+    return digits @ 10 ** numpy.arange(digits.shape[1] - 1, -1, -1)
+
+def numpy_balance_report(account_ids: List[str], currency_ids: List[str], balances: array) -> BalanceReport:
+    if not balances:
+        return {}
+    currencies, groups = factorize(currency_ids)
+    amounts = numpy.frombuffer(balances, numpy.int64)
+    # By currency, then highest balance first; lexsort is stable and sorts by its last key first
+    order = numpy.lexsort((-amounts, groups))
+    starts = numpy.searchsorted(groups[order], numpy.arange(len(currencies)))
+    ends = numpy.append(starts[1:], len(order))
+    totals = numpy.add.reduceat(amounts[order], starts)
+    report = {}
+    for code, currency_id in enumerate(currencies):
+        top = order[starts[code]:min(ends[code], starts[code] + MAX_TOP_ACCOUNTS)].tolist()
+        report[currency_id] = {
+            "total": int(totals[code]),
+            "accounts": int(ends[code] - starts[code]),
+            "top": [(account_ids[row], balances[row]) for row in top]
+        }
+    return report
+
+def numpy_volume_report(prefix: int, whens: List[str], currency_ids: List[str], previous_balances: array, new_balances: array) -> VolumeReport:
+    if not whens:
+        return {}
+    currencies, groups = factorize(currency_ids)
+    # One sort by (period, currency) puts each cell's rows together; sums are taken with add.reduceat over them
+    # because bincount would add int64 money as floats
+    cells = period_codes(prefix, whens) * len(currencies) + groups
+    order = numpy.argsort(cells, kind="stable")
+    cells = cells[order]
+    starts = numpy.flatnonzero(numpy.diff(cells, prepend=-1))
+    deltas = (numpy.frombuffer(new_balances, numpy.int64) - numpy.frombuffer(previous_balances, numpy.int64))[order]
+    money_in = numpy.add.reduceat(numpy.maximum(deltas, 0), starts).tolist()
+    money_out = numpy.add.reduceat(numpy.maximum(-deltas, 0), starts).tolist()
+    counts = numpy.diff(numpy.append(starts, len(order))).tolist()
+    report: VolumeReport = {}
+    # Each cell's key is read back from its first row
+    for row, cell, cell_in, cell_out, count in zip(order[starts].tolist(), cells[starts].tolist(), money_in, money_out, counts):
+        report.setdefault(whens[row][:prefix], {})[currencies[cell % len(currencies)]] = [cell_in, cell_out, count]
+    return report
+
+
+class BankReportCache:
+    __slots__ = ("lock", "balances", "balances_version", "volumes", "stale")
+
+    def __init__(self):
+        # Held while a report is computed, so concurrent dashboard loads wait for one computation and share it
+        self.lock = threading.Lock()
+        # Deposits and top accounts from one read of the balance columns; None once a balance changes
+        self.balances: BalanceReport | None = None
+        self.balances_version = 0
+        # Volume for each kind of period computed so far. Each period key's totals are kept until a commit lands in
+        # that period, so past days are read once and only the current one is recomputed.
+        self.volumes: Dict[str, VolumeReport] = {}
+        # Kinds of period being tracked, with the keys commits have touched since they were last computed
+        self.stale: Dict[str, Set[str]] = {}
+
+
+class BankReports:
+    def __init__(self, data_engine: DataEngine, use_numpy: bool = numpy is not None):
+        self.data_engine = data_engine
+        self.use_numpy = use_numpy
+        self.lock = threading.Lock()
+        self.banks: Dict[str, BankReportCache] = {}
+        data_engine.add_listener(self.on_commit)
+
+    def bank_cache(self, bank_id: str) -> BankReportCache:
+        with self.lock:
+            return self.banks.setdefault(bank_id, BankReportCache())
+
+    def balances(self, bank_id: str) -> BalanceReport:
+        cache = self.bank_cache(bank_id)
+        with cache.lock:
+            with self.lock:
+                report, version = cache.balances, cache.balances_version
+            if report is None:
+                columns = self.data_engine.bank_balance_columns(bank_id)
+                report = numpy_balance_report(*columns) if self.use_numpy else balance_report(*columns)
+                with self.lock:
+                    # Kept only if no balance changed while the columns were read
+                    if cache.balances_version == version:
+                        cache.balances = report
+            return report
+
+    def volume(self, bank_id: str, period: str) -> VolumeReport:
+        prefix = PERIOD_PREFIX[period]
+        aggregate = numpy_volume_report if self.use_numpy else volume_report
+        cache = self.bank_cache(bank_id)
+        with cache.lock:
+            with self.lock:
+                report = cache.volumes.get(period)
+                # Tracked before anything is read, so a commit landing during the read is recomputed next time
+                stale = cache.stale.get(period, set())
+                cache.stale[period] = set()
+            try:
+                if report is None:
+                    report = aggregate(prefix, *self.data_engine.bank_history_columns(bank_id))
+                elif stale:
+                    # Replaced rather than updated, as earlier callers may still be reading it
+                    report = dict(report)
+                    for key in stale:
+                        since, until = period_bounds(period, key)
+                        totals = aggregate(prefix, *self.data_engine.bank_history_columns(bank_id, since, until)).get(key)
+                        if totals is not None:
+                            report[key] = totals
+            except BaseException:
+                with self.lock:
+                    cache.stale[period] |= stale
+                raise
+            with self.lock:
+                cache.volumes[period] = report
+            return report
+
+    def on_commit(self, records: list):
+        if not self.banks:
+            return
+        if records[0]["op"] == "reload":
+            with self.lock:
+                self.banks.clear()  # Storage cannot say what changed, so every report is computed again
+            return
+        # (account_id, when of the new history row or None) for each change to a balance
+        changed: List[Tuple[str, str | None]] = []
+        dropped: List[str] = []
+        for record in iter_records(records):
+            op = record["op"]
+            if op == "transfer":
+                changed.extend((account_id, record["when"]) for account_id, _, _ in transfer_sides(record))
+            elif op == "balance":
+                changed.append((record["account_id"], None))
+            elif op == "account":
+                dropped.append(record["account"]["bank_id"])
+            elif op == "bank":
+                dropped.append(record["bank"]["bank_id"])
+        # Accounts are looked up outside the lock, which report requests take too
+        touched = []
+        for account_id, when in changed:
+            account = self.data_engine.find_account_by_id(account_id)
+            if account is not None:
+                touched.append((account.bank_id, when))
+
+        with self.lock:
+            for bank_id in dropped:
+                self.banks.pop(bank_id, None)
+            for bank_id, when in touched:
+                cache = self.banks.get(bank_id)
+                if cache is None:
+                    continue
+                cache.balances = None
+                cache.balances_version += 1
+                if when is not None:
+                    for period, keys in cache.stale.items():
+                        keys.add(when[:PERIOD_PREFIX[period]])
@@ -0,0 +1,254 @@
+import heapq
+import logging
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from metrics import registry
+from models import ORDER_INTERVALS, WHEN_FORMAT, StandingOrder
+from money import format_amount, parse_amount
+from storage import DataEngine, iter_records
+from transfers import TransferEngine, TransferError
+from typing import Dict, List, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Bounds on new orders, so every run an order will plausibly make falls well inside the calendar
+MAX_EVERY = 1000
+MAX_START_AHEAD = timedelta(days=3660)
+
+def seconds_until(when: str) -> float:
+    return (datetime.fromisoformat(when) - datetime.now()).total_seconds()
+
+
+class PaymentScheduler:
+    # Longest single wait, so a wall clock set forward is noticed within this many seconds
+    max_wait = 3600.0
+    # Wait before trying again after a run failed on a storage error
+    retry_interval = 5.0
+
+    def __init__(self, data_engine: DataEngine, transfer_engine: TransferEngine, batch_size: int = 256):
+        self.data_engine = data_engine
+        self.transfer_engine = transfer_engine
+        # Most runs made in one commit
+        self.batch_size = batch_size
+        self.condition = threading.Condition()
+        # Min-heap of (next run, order_id, runs done). An entry goes stale once its order runs or is cancelled;
+        # it is dropped when it reaches the top rather than searched for. The thread only wakes for the top entry.
+        self.heap: List[Tuple[str, str, int]] = []
+        self.running = False
+        self.thread = None
+        data_engine.add_listener(self.on_commit)
+
+    def load(self):
+        # Every order's next run; only needed at startup and when storage cannot say what changed
+        entries = []
+        for order in self.data_engine.find_standing_orders():
+            try:
+                entries.append((order.next_run, order.order_id, order.runs))
+            except ValueError:
+                logger.exception("Standing order %s has no valid next run and is not scheduled", order.order_id)
+        heapq.heapify(entries)
+        with self.condition:
+            self.heap = entries
+            self.condition.notify_all()
+
+    def start(self):
+        self.load()
+        self.running = True
+        self.thread = threading.Thread(target=self.run_forever, daemon=True, name="payment-scheduler")
+        self.thread.start()
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+
+    def on_commit(self, records: list):
+        if records[0]["op"] == "reload":
+            self.load()
+            return
+        # New orders and orders that just ran, from this worker or (with SQLite) any other
+        entries = [(record["order"]["next_run"], record["order"]["order_id"], record["order"]["runs"])
+                   for record in iter_records(records) if record["op"] == "order"]
+        if entries:
+            with self.condition:
+                for entry in entries:
+                    heapq.heappush(self.heap, entry)
+                self.condition.notify_all()
+
+    def run_forever(self):
+        while True:
+            with self.condition:
+                while self.running and (not self.heap or seconds_until(self.heap[0][0]) > 0):
+                    self.condition.wait(min(seconds_until(self.heap[0][0]), self.max_wait) if self.heap else None)
+                if not self.running:
+                    return
+            try:
+                self.run_due()
+            except Exception:
+                logger.exception("Standing orders failed")
+                time.sleep(self.retry_interval)
+
+    def run_due(self, now: str | None = None) -> int:
+        # Runs every order due by now, catching up on each missed run in turn; returns the number of runs made
+        now = now or datetime.now().strftime(WHEN_FORMAT)
+        done = 0
+        while True:
+            with self.condition:
+                due = []
+                while self.heap and self.heap[0][0] <= now and len(due) < self.batch_size:
+                    due.append(heapq.heappop(self.heap))
+            if not due:
+                return done
+            try:
+                done += self.run_batch(due, now)
+            except BaseException:
+                with self.condition:
+                    for entry in due:
+                        heapq.heappush(self.heap, entry)
+                raise
+
+    def run_batch(self, due: List[Tuple[str, str, int]], now: str) -> int:
+        queued: Dict[str, Set[int]] = {}
+        for _, order_id, runs in due:
+            queued.setdefault(order_id, set()).add(runs)
+        orders = [self.data_engine.find_standing_order(order_id) for order_id in queued]
+        account_ids = [account_id for order in orders if order is not None for account_id in (order.account_id, order.to_id)]
+
+        # The same locks and write transaction as a transfer batch, so runs and API transfers see each other's balances
+        with self.transfer_engine.lock_accounts(*account_ids), self.data_engine.write_transaction():
+            pending: Dict[Tuple[str, str], int] = {}
+            runs = []
+            deferred = []
+            broken = []
+            for order_id, queued_runs in queued.items():
+                # Read again under the locks: skipped if cancelled, or already run (by another worker, or by an
+                # earlier batch) since it was queued
+                order = self.data_engine.find_standing_order(order_id)
+                if order is None or order.runs not in queued_runs:
+                    continue
+                if len(runs) >= self.batch_size:
+                    # Earlier orders' missed runs filled this commit; the order waits for the next one
+                    deferred.append((order.next_run, order.order_id, order.runs))
+                    continue
+                # Run against a copy of pending, so an order that turns out to be broken leaves no trace in it
+                order_pending = dict(pending)
+                order_runs = []
+                try:
+                    ran = order
+                    while ran.next_run <= now and len(runs) + len(order_runs) < self.batch_size:
+                        # Storing a run needs the time of the one after it, so that has to be computable first
+                        ran.run_time(ran.runs + 1)
+                        ran, transfer = self.run_order(ran, order_pending)
+                        order_runs.append((ran, transfer))
+                except (ValueError, OverflowError):
+                    # E.g. runs past the year 9999: the order is cancelled rather than failing every order in the batch
+                    logger.exception("Standing order %s cannot be run and is cancelled", order_id)
+                    broken.append(order)
+                    continue
+                pending = order_pending
+                runs.extend(order_runs)
+            if runs:
+                self.data_engine.record_order_runs(runs)
+            for order in broken:
+                self.data_engine.cancel_standing_order(order)
+        if deferred:
+            with self.condition:
+                for entry in deferred:
+                    heapq.heappush(self.heap, entry)
+
+        applied = sum(1 for _, transfer in runs if transfer is not None)
+        registry.increment("bank_standing_order_runs_total", applied, status="applied")
+        registry.increment("bank_standing_order_runs_total", len(runs) - applied, status="failed")
+        return len(runs)
+
+    def run_order(self, order: StandingOrder, pending: Dict[Tuple[str, str], int]) -> Tuple[StandingOrder, tuple | None]:
+        # Validated exactly like a transfer made through the API; a failed run is recorded and the order moves on
+        transfer = None
+        sender_account = self.data_engine.find_account_by_id(order.account_id)
+        currency_info = self.data_engine.find_currency_by_id(order.currency_id)
+        if sender_account is None or currency_info is None:
+            status = "Invalid sender account or currency"
+        else:
+            data = {"from": order.account_id, "to": order.to_id, "currency": order.currency_id,
+                    "amount": format_amount(order.amount, currency_info.scale)}
+            if order.to_currency_id is not None:
+                data["to_currency"] = order.to_currency_id
+            try:
+                transfer = self.transfer_engine.validate(sender_account.owner.owner_id, data, pending)
+                self.transfer_engine.add_pending(pending, *transfer)
+                status = "applied"
+            except TransferError as e:
+                status = e.message
+
+        ran = StandingOrder.from_json(order.to_json())
+        ran.last_run = order.next_run
+        ran.last_status = status
+        ran.runs += 1
+        return ran, transfer
+
+    def create(self, user_id: str, data: dict) -> StandingOrder:
+        sender_account = self.data_engine.find_account_by_id(data.get("from"))
+        recipient_account = self.data_engine.find_account_by_id(data.get("to"))
+        if not sender_account or not recipient_account:
+            raise TransferError("Invalid sender or recipient account")
+        if sender_account.owner.owner_id != user_id:
+            raise TransferError("User does not own the specified sender account", 401)
+
+        currency = data.get("currency")
+        currency_info = self.data_engine.find_currency_by_id(currency)
+        to_currency = data.get("to_currency", currency)
+        if not currency_info or currency not in sender_account.balances or to_currency not in recipient_account.balances:
+            raise TransferError("Invalid currency for sender or recipient account")
+        try:
+            amount = parse_amount(data.get("amount"), currency_info.scale)
+        except ValueError:
+            raise TransferError("Invalid amount")
+        if amount <= 0:
+            raise TransferError("Invalid amount")
+
+        interval = data.get("interval")
+        if interval not in ORDER_INTERVALS:
+            raise TransferError(f"interval must be one of {', '.join(ORDER_INTERVALS)}")
+        every = data.get("every", 1)
+        if not isinstance(every, int) or isinstance(every, bool) or not 1 <= every <= MAX_EVERY:
+            raise TransferError(f"every must be a whole number from 1 to {MAX_EVERY}")
+
+        # The first run is due at start, or straight away without one
+        now = datetime.now()
+        start = now
+        if data.get("start") is not None:
+            try:
+                start = datetime.fromisoformat(data["start"])
+            except (TypeError, ValueError):
+                raise TransferError("Invalid start time")
+            if start.tzinfo is not None:
+                # Stored times carry no zone and are read as UTC
+                start = start.astimezone(timezone.utc).replace(tzinfo=None)
+            if start < now:
+                raise TransferError("start must not be in the past")
+            if start > now + MAX_START_AHEAD:
+                raise TransferError(f"start must be within {MAX_START_AHEAD.days} days")
+
+        order = StandingOrder(str(uuid.uuid4()), sender_account.account_id, recipient_account.account_id, currency,
+                              to_currency if to_currency != currency else None, amount, interval, every,
+                              start.strftime(WHEN_FORMAT), 0, now.strftime(WHEN_FORMAT))
+        with self.transfer_engine.lock_accounts(order.account_id), self.data_engine.write_transaction():
+            self.data_engine.add_standing_order(order)
+        return order
+
+    def cancel(self, user_id: str, order_id: str) -> bool:
+        # False when the user has no such order
+        order = self.data_engine.find_standing_order(order_id)
+        if order is None:
+            return False
+        sender_account = self.data_engine.find_account_by_id(order.account_id)
+        if sender_account is None or sender_account.owner.owner_id != user_id:
+            return False
+        # Under the sender's lock a run in progress finishes first, so it cannot bring the order back
+        with self.transfer_engine.lock_accounts(order.account_id), self.data_engine.write_transaction():
+            if self.data_engine.find_standing_order(order_id) is None:
+                return False
+            self.data_engine.cancel_standing_order(order)
+        return True
@@ -1,10 +1,148 @@
+import heapq
 import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from concurrent.futures import Future
+from contextlib import contextmanager
+from datetime import datetime
+from itertools import repeat
+from metrics import registry
 from models import *
-from typing import List
+from money import MAX_MINOR_UNITS
+from snapshots import decode_history, decode_snapshot, encode_history, encode_snapshot
+from typing import Callable, Dict, List, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # No advisory file locks on this platform (Windows)
+
+def iter_records(records: List[dict]):
+    # Flattens batch records into the individual mutations they contain
+    for record in records:
+        if record["op"] == "batch":
+            yield from iter_records(record["records"])
+        else:
+            yield record
+
+def transfer_sides(record: dict):
+    # (account_id, currency_id, balance change) for the sender and the recipient of a transfer record
+    conversion = record.get("conversion")
+    yield record["from"], record["currency_id"], -record["amount"]
+    if conversion is None:
+        yield record["to"], record["currency_id"], record["amount"]
+    else:
+        yield record["to"], conversion["to_currency_id"], conversion["to_amount"]
+
+def transfer_balances(record: dict, balance_of: Callable[[str, str], int]) -> List[Tuple[str, str, int, int]]:
+    # (account_id, currency_id, previous balance, new balance) for each side of a transfer record. Worked out before
+    # anything changes, so a transfer leaving a balance that cannot be stored is refused whole rather than half-applied.
+    balances = {}
+    sides = []
+    for account_id, currency_id, delta in transfer_sides(record):
+        key = (account_id, currency_id)
+        previous_balance = balances[key] if key in balances else balance_of(account_id, currency_id)
+        new_balance = previous_balance + delta
+        if abs(new_balance) > MAX_MINOR_UNITS:
+            raise ValueError(f"Balance of account {account_id} in {currency_id} would be out of range")
+        balances[key] = new_balance
+        sides.append((account_id, currency_id, previous_balance, new_balance))
+    return sides
+
+def page_newest_first(histories: Dict[str, Tuple[list, int]], limit: int, matches: Callable, key: Callable) -> Tuple[List[tuple], Dict[str, int] | None]:
+    # Walks each (history, end) backwards from end and merges them newest first without copying the histories.
+    # Returns up to limit (account_id, item) pairs and the end positions to resume from, or None when exhausted.
+    def walk(account_id, history, end):
+        for index in range(end - 1, -1, -1):
+            item = history[index]
+            yield key(item), account_id, index, item
+
+    positions = {account_id: end for account_id, (history, end) in histories.items()}
+    merged = heapq.merge(*(walk(account_id, history, end) for account_id, (history, end) in histories.items()), key=lambda entry: entry[0], reverse=True)
+    page = []
+    for _, account_id, index, item in merged:
+        positions[account_id] = index
+        if matches(item):
+            page.append((account_id, item))
+            if len(page) == limit:
+                return page, positions
+    return page, None
+
+
+# Length of the Transaction.when prefix each summary period groups by
+PERIOD_PREFIX = {"day": 10, "month": 7, "year": 4}
+
+def indexed_rows(history: TransactionHistory, end: int, since: str | None, until: str | None, currency_id: str | None,
+                 counterparty: str | None) -> Tuple[Sequence[int], int, int]:
+    # Looks rows up in the history's search index: the counterparty's or the currency's rows (the shorter list when
+    # both are given, every row when neither is), narrowed to rows before end whose time lies within [since, until].
+    # Returns the row list and the [lo, hi) slice of it; callers still check whichever filter was not looked up.
+    index = history.search_index()
+    times = index.times
+    candidates = [lookup.get(value, ()) for lookup, value in ((index.by_account, counterparty), (index.by_currency, currency_id)) if value is not None]
+    rows = min(candidates, key=len) if candidates else range(len(times))
+    lo = bisect_left(rows, parse_when(since), key=times.__getitem__) if since is not None else 0
+    hi = bisect_left(rows, min(end, len(times)), lo)
+    if until is not None:
+        hi = bisect_right(rows, parse_when(until), lo, hi, key=times.__getitem__)
+    return rows, lo, max(lo, hi)
+
+class IndexedRows:
+    # The [lo, hi) slice of a row list read as transactions, so page_newest_first can walk index matches directly
+    __slots__ = ("history", "rows", "lo")
+
+    def __init__(self, history: TransactionHistory, rows: Sequence[int], lo: int):
+        self.history = history
+        self.rows = rows
+        self.lo = lo
+
+    def __getitem__(self, index: int) -> Transaction:
+        return self.history[self.rows[self.lo + index]]
+
 
 class DataEngine:
+    # Operations timed into the bank_storage_op_seconds histogram; ones an engine does not have are skipped
+    timed_ops = ("load_data", "save_data", "commit", "write_commits", "wait_durable", "mutate_many", "sync", "read_history",
+                 "find_user", "find_user_accounts", "find_account_by_id", "find_accounts_by_currency",
+                 "find_currency_by_id", "find_currencies", "find_bank_by_id", "find_banks", "find_exchange_rates",
+                 "find_standing_order", "find_standing_orders",
+                 "get_messages", "find_transactions", "transaction_totals", "find_messages",
+                 "bank_balance_columns", "bank_history_columns")
+
     def __init__(self):
         self.data_model: DataModel = None
+        self.users_by_email: Dict[str, User] = {}
+        self.accounts_by_id: Dict[str, Account] = {}
+        self.accounts_by_owner: Dict[str, List[Account]] = {}
+        self.currencies_by_id: Dict[str, Currency] = {}
+        self.banks_by_id: Dict[str, Bank] = {}
+        self.orders_by_id: Dict[str, StandingOrder] = {}
+        # Called with the records of every commit once they are durable
+        self.listeners: List[Callable[[List[dict]], None]] = []
+        registry.instrument(self, self.timed_ops, "bank_storage_op_seconds")
+
+    def add_listener(self, listener: Callable[[List[dict]], None]):
+        self.listeners.append(listener)
+
+    def notify(self, records: List[dict]):
+        for listener in self.listeners:
+            listener(records)
+
+    def sync(self):
+        pass  # Only engines shared between processes have other workers' commits to pick up
+
+    @contextmanager
+    def write_transaction(self):
+        # Reads made inside see the latest data and nothing else commits until the block ends.
+        # Single-process engines rely on the callers' own locks, so this is a no-op for them.
+        yield
 
     def load_data(self):
         raise NotImplementedError("load_data method must be implemented in the subclass")
@@ -12,61 +150,260 @@ class DataEngine:
     def save_data(self):
         raise NotImplementedError("save_data method must be implemented in the subclass")
 
-    def find_user(self, email: str) -> User | None:
-        for user in self.data_model.users:
-            if user.email == email:
-                return user
-        return None
+    def build_indexes(self):
+        self.users_by_email = {}
+        self.accounts_by_id = {}
+        self.accounts_by_owner = {}
+        self.currencies_by_id = {}
+        self.banks_by_id = {}
+        self.orders_by_id = {}
 
-    def find_user_accounts(self, user_id: str) -> List[Account]:
-        user_accounts = []
+        for user in self.data_model.users:
+            self.users_by_email[user.email] = user
+        for currency in self.data_model.currencies:
+            self.currencies_by_id[currency.currency_id] = currency
         for bank in self.data_model.banks:
+            self.banks_by_id[bank.bank_id] = bank
             for account in bank.accounts:
-                if account.owner.owner_id == user_id:
-                    user_accounts.append(account)
-        return user_accounts
+                self.index_account(account)
+
+    def index_account(self, account: Account):
+        self.accounts_by_id[account.account_id] = account
+        self.accounts_by_owner.setdefault(account.owner.owner_id, []).append(account)
+        for order in account.standing_orders:
+            self.orders_by_id[order.order_id] = order
+
+    def commit(self, records: List[dict]):
+        self.save_data()
+
+    def apply_record(self, record: dict):
+        handlers = {
+            "user": self.apply_user,
+            "currency": self.apply_currency,
+            "bank": self.apply_bank,
+            "account": self.apply_account,
+            "transfer": self.apply_transfer,
+            "balance": self.apply_balance,
+            "password": self.apply_password,
+            "message": self.apply_message,
+            "rate": self.apply_rate,
+            "order": self.apply_order,
+            "order_cancel": self.apply_order_cancel,
+            "revoke": self.apply_revoke,
+            "batch": self.apply_batch
+        }
+        handlers[record["op"]](record)
+
+    def mutate(self, record: dict):
+        self.mutate_many([record])
+
+    def mutate_many(self, records: List[dict]):
+        # Apply every record in memory, then persist them all with a single commit
+        for record in records:
+            self.apply_record(record)
+        self.commit(records)
+        self.notify(records)
+
+    def apply_batch(self, record: dict):
+        for sub_record in record["records"]:
+            self.apply_record(sub_record)
+
+    def apply_user(self, record: dict):
+        user = User.from_json(record["user"])
+        self.data_model.users.append(user)
+        self.users_by_email[user.email] = user
+
+    def apply_currency(self, record: dict):
+        currency = Currency.from_json(record["currency"])
+        self.data_model.currencies.append(currency)
+        self.currencies_by_id[currency.currency_id] = currency
+
+    def apply_bank(self, record: dict):
+        bank = Bank.from_json(record["bank"])
+        self.data_model.banks.append(bank)
+        self.banks_by_id[bank.bank_id] = bank
+        for account in bank.accounts:
+            self.index_account(account)
+
+    def apply_account(self, record: dict):
+        account = Account.from_json(record["account"])
+        self.banks_by_id[account.bank_id].accounts.append(account)
+        self.index_account(account)
+
+    def apply_transfer(self, record: dict):
+        conversion = Conversion.from_json(record["conversion"]) if "conversion" in record else None
+        sides = transfer_balances(record, lambda account_id, currency_id: self.accounts_by_id[account_id].balances[currency_id])
+        for account_id, currency_id, previous_balance, new_balance in sides:
+            account = self.accounts_by_id[account_id]
+            account.balances[currency_id] = new_balance
+            account.transactions.append(Transaction(
+                from_id=record["from"],
+                to_id=record["to"],
+                when=record["when"],
+                currency_id=currency_id,
+                previous_balance=previous_balance,
+                new_balance=new_balance,
+                conversion=conversion
+            ))
+            account.history_dirty = True
+
+    def apply_balance(self, record: dict):
+        # Adds the currency to the account if it does not hold it yet
+        self.accounts_by_id[record["account_id"]].balances[record["currency_id"]] = record["balance"]
+
+    def apply_password(self, record: dict):
+        self.users_by_email[record["email"]].password = record["password"]
+
+    def apply_rate(self, record: dict):
+        rate = ExchangeRate.from_json(record["rate"])
+        rates = self.data_model.exchange_rates
+        # One rate per direction: a newly published one replaces the old
+        for index, existing in enumerate(rates):
+            if (existing.from_currency_id, existing.to_currency_id) == (rate.from_currency_id, rate.to_currency_id):
+                rates[index] = rate
+                return
+        rates.append(rate)
+
+    def apply_message(self, record: dict):
+        owner = OwnerType.from_json(record["from"])
+        for account_id in record["accounts"]:
+            account = self.accounts_by_id[account_id]
+            account.messages.append(Message(owner=owner, data=record["data"]))
+            account.history_dirty = True
+
+    def apply_order(self, record: dict):
+        # Adds a standing order, or replaces it with the same order after a run
+        order = StandingOrder.from_json(record["order"])
+        orders = self.accounts_by_id[order.account_id].standing_orders
+        for index, existing in enumerate(orders):
+            if existing.order_id == order.order_id:
+                orders[index] = order
+                break
+        else:
+            orders.append(order)
+        self.orders_by_id[order.order_id] = order
+
+    def apply_order_cancel(self, record: dict):
+        orders = self.accounts_by_id[record["account_id"]].standing_orders
+        orders[:] = [order for order in orders if order.order_id != record["order_id"]]
+        self.orders_by_id.pop(record["order_id"], None)
+
+    def apply_revoke(self, record: dict):
+        # Tokens past their expiry are rejected anyway, so their revocations are dropped as new ones come in
+        now = time.time()
+        revoked = self.data_model.revoked_tokens
+        for digest in [digest for digest, exp in revoked.items() if exp <= now]:
+            del revoked[digest]
+        revoked[record["digest"]] = record["exp"]
+
+    def add_user(self, user: User):
+        self.mutate({"op": "user", "user": user.to_json()})
+
+    def add_currency(self, currency: Currency):
+        self.mutate({"op": "currency", "currency": currency.to_json()})
+
+    def add_bank(self, bank: Bank):
+        self.mutate({"op": "bank", "bank": bank.to_json()})
+
+    def add_account(self, account: Account):
+        self.mutate({"op": "account", "account": account.to_json()})
+
+    def transfer_record(self, sender: Account, recipient: Account, currency_id: str, amount: int, conversion: Conversion | None = None) -> dict:
+        record = {
+            "op": "transfer",
+            "from": sender.account_id,
+            "to": recipient.account_id,
+            "currency_id": currency_id,
+            "amount": amount,
+            "when": datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
+        }
+        if conversion is not None:
+            # The sender pays amount in currency_id; the recipient is credited the converted amount
+            record["conversion"] = conversion.to_json()
+        return record
+
+    def transfer(self, sender: Account, recipient: Account, currency_id: str, amount: int, conversion: Conversion | None = None):
+        self.mutate(self.transfer_record(sender, recipient, currency_id, amount, conversion))
+
+    def transfer_many(self, transfers: List[tuple]):
+        self.mutate_many([self.transfer_record(*transfer) for transfer in transfers])
+
+    def set_balance(self, account: Account, currency_id: str, balance: int):
+        self.mutate({"op": "balance", "account_id": account.account_id, "currency_id": currency_id, "balance": balance})
+
+    def set_exchange_rate(self, rate: ExchangeRate):
+        self.mutate({"op": "rate", "rate": rate.to_json()})
+
+    def add_standing_order(self, order: StandingOrder):
+        self.mutate({"op": "order", "order": order.to_json()})
+
+    def cancel_standing_order(self, order: StandingOrder):
+        self.mutate({"op": "order_cancel", "account_id": order.account_id, "order_id": order.order_id})
+
+    def record_order_runs(self, runs: List[Tuple[StandingOrder, tuple | None]]):
+        # Each order as it stands after its run, with the transfer it made (None if it failed), all in one commit:
+        # a run is never stored without its transfer or the other way round, so replaying or retrying repeats neither
+        records = []
+        for order, transfer in runs:
+            if transfer is not None:
+                records.append(self.transfer_record(*transfer))
+            records.append({"op": "order", "order": order.to_json()})
+        self.mutate_many(records)
+
+    def set_password(self, user: User, password: str):
+        self.mutate({"op": "password", "email": user.email, "password": password})
+
+    def find_user(self, email: str) -> User | None:
+        return self.users_by_email.get(email)
+
+    def find_user_accounts(self, user_id: str) -> List[Account]:
+        return list(self.accounts_by_owner.get(user_id, []))
 
     def find_account_by_id(self, account_id: str) -> Account | None:
-        for bank in self.data_model.banks:
-            for account in bank.accounts:
-                if account.account_id == account_id:
-                    return account
-        return None
+        return self.accounts_by_id.get(account_id)
 
     def find_accounts_by_currency(self, user_id: str, currency_id: str) -> List[Account]:
         user_accounts = self.find_user_accounts(user_id)
-        return [account for account in user_accounts if any(balance.currency_id == currency_id for balance in account.balance)]
+        return [account for account in user_accounts if currency_id in account.balances]
 
     def find_currency_by_id(self, currency_id: str) -> Currency | None:
-        for currency in self.data_model.currencies:
-            if currency.currency_id == currency_id:
-                return currency
-        return None
+        return self.currencies_by_id.get(currency_id)
 
     def find_currencies(self) -> List[Currency]:
-        currencies = []
-        for currency in self.data_model.currencies:
-            currencies.append(currency)
-        return currencies
+        return list(self.data_model.currencies)
 
     def find_bank_by_id(self, bank_id: str) -> Bank | None:
-        for bank in self.data_model.banks:
-            if bank.bank_id == bank_id:
-                return bank
-        return None
+        return self.banks_by_id.get(bank_id)
 
     def find_banks(self) -> List[Bank]:
-        banks = []
-        for bank in self.data_model.banks:
-            banks.append(bank)
-        return banks
+        return list(self.data_model.banks)
+
+    def find_exchange_rates(self) -> List[ExchangeRate]:
+        return list(self.data_model.exchange_rates)
+
+    def find_revoked_tokens(self) -> Dict[str, float]:
+        # Hex digest -> expiry of every logged-out token that has not expired yet
+        now = time.time()
+        return {digest: exp for digest, exp in self.data_model.revoked_tokens.items() if exp > now}
+
+    def find_standing_order(self, order_id: str) -> StandingOrder | None:
+        return self.orders_by_id.get(order_id)
+
+    def find_standing_orders(self, user_id: str | None = None) -> List[StandingOrder]:
+        # Every order of the user's accounts, or every order there is
+        if user_id is None:
+            return list(self.orders_by_id.values())
+        return [order for account in self.accounts_by_owner.get(user_id, []) for order in account.standing_orders]
 
     def add_message(self, user_id: str, message_data: str):
         user_accounts = self.find_user_accounts(user_id)
         if user_accounts:
-            for account in user_accounts:
-                account.messages.append(Message(from_id=OwnerType("user", user_id), data=message_data))
-            self.save_data()
+            self.mutate({
+                "op": "message",
+                "from": OwnerType("user", user_id).to_json(),
+                "accounts": [account.account_id for account in user_accounts],
+                "data": message_data
+            })
 
     def get_messages(self, user_id: str) -> List[Message] | None:
         user_accounts = self.find_user_accounts(user_id)
@@ -77,18 +414,1128 @@ class DataEngine:
             return messages
         return None
 
+    def history_accounts(self, user_id: str, account_id: str | None) -> List[Account]:
+        user_accounts = self.accounts_by_owner.get(user_id, [])
+        if account_id is not None:
+            return [account for account in user_accounts if account.account_id == account_id]
+        return user_accounts
+
+    def find_transactions(self, user_id: str, limit: int, cursor: dict | None = None, account_id: str | None = None,
+                          since: str | None = None, until: str | None = None, currency_id: str | None = None,
+                          counterparty: str | None = None) -> Tuple[List[Tuple[str, Transaction]], dict | None]:
+        # Cursor positions are row numbers in each account's history: the next page is read from the rows before them
+        positions = (cursor or {}).get("positions", {})
+        histories = {}
+        slices = {}
+        for account in self.history_accounts(user_id, account_id):
+            transactions = account.transactions
+            end = min(positions.get(account.account_id, len(transactions)), len(transactions))
+            rows, lo, hi = indexed_rows(transactions, end, since, until, currency_id, counterparty)
+            histories[account.account_id] = (IndexedRows(transactions, rows, lo), hi - lo)
+            slices[account.account_id] = (rows, lo, hi, end)
+
+        def matches(transaction: Transaction) -> bool:
+            if currency_id is not None and transaction.currency_id != currency_id:
+                return False
+            if counterparty is not None and transaction.from_id != counterparty and transaction.to_id != counterparty:
+                return False
+            return True
+
+        page, next_positions = page_newest_first(histories, limit, matches, key=lambda t: t.when)
+        if next_positions is None:
+            return page, None
+        for account_id, position in next_positions.items():
+            rows, lo, hi, end = slices[account_id]
+            next_positions[account_id] = rows[lo + position] if lo + position < hi else end
+        return page, {"positions": next_positions}
+
+    def transaction_totals(self, user_id: str, period: str, account_id: str | None = None, since: str | None = None,
+                           until: str | None = None, currency_id: str | None = None,
+                           counterparty: str | None = None) -> List[dict]:
+        # Money in and out per (period, currency) over the user's matching transactions, summed straight from the
+        # history columns; the balance change of each row is its amount, signed by direction
+        prefix = PERIOD_PREFIX[period]
+        totals: Dict[Tuple[str, str], List[int]] = {}
+        for account in self.history_accounts(user_id, account_id):
+            history = account.transactions
+            rows, lo, hi = indexed_rows(history, len(history), since, until, currency_id, counterparty)
+            from_ids, to_ids, whens, currency_ids = history.from_ids, history.to_ids, history.whens, history.currency_ids
+            previous_balances, new_balances = history.previous_balances, history.new_balances
+            for row in rows[lo:hi]:
+                if currency_id is not None and currency_ids[row] != currency_id:
+                    continue
+                if counterparty is not None and from_ids[row] != counterparty and to_ids[row] != counterparty:
+                    continue
+                total = totals.get((whens[row][:prefix], currency_ids[row]))
+                if total is None:
+                    total = totals[whens[row][:prefix], currency_ids[row]] = [0, 0, 0]
+                delta = new_balances[row] - previous_balances[row]
+                if delta >= 0:
+                    total[0] += delta
+                else:
+                    total[1] -= delta
+                total[2] += 1
+        return [{"period": key[0], "currency_id": key[1], "in": total[0], "out": total[1], "count": total[2]}
+                for key, total in sorted(totals.items())]
+
+    def check_cursor(self, cursor: dict):
+        # Cursors come back from clients: raises ValueError unless this one has the shape find_transactions and
+        # find_messages hand out, a non-negative row position for each account
+        positions = cursor.get("positions")
+        if set(cursor) != {"positions"} or not isinstance(positions, dict) or not all(
+                type(position) is int and position >= 0 for position in positions.values()):
+            raise ValueError("malformed cursor")
+
+    def find_messages(self, user_id: str, limit: int, cursor: dict | None = None, account_id: str | None = None,
+                      counterparty: str | None = None) -> Tuple[List[Tuple[str, Message]], dict | None]:
+        positions = (cursor or {}).get("positions", {})
+        histories = {}
+        for account in self.history_accounts(user_id, account_id):
+            messages = account.messages
+            histories[account.account_id] = (messages, min(positions.get(account.account_id, len(messages)), len(messages)))
+
+        # Messages carry no timestamp, so each account is read newest first in account order
+        matches = (lambda m: m.owner.owner_id == counterparty) if counterparty is not None else (lambda m: True)
+        page, next_positions = page_newest_first(histories, limit, matches, key=lambda m: 0)
+        return page, {"positions": next_positions} if next_positions is not None else None
+
+    def bank_balance_columns(self, bank_id: str) -> Tuple[List[str], List[str], array]:
+        # Every balance held at the bank as three columns (account, currency, amount), for the bank reports
+        account_ids, currency_ids, balances = [], [], array("q")
+        for account in self.banks_by_id[bank_id].accounts:
+            held = account.balances.copy()  # A balance op may add a currency while the columns are read
+            account_ids.extend(repeat(account.account_id, len(held)))
+            currency_ids.extend(held)
+            balances.extend(held.values())
+        return account_ids, currency_ids, balances
+
+    def bank_history_columns(self, bank_id: str, since: str | None = None,
+                             until: str | None = None) -> Tuple[List[str], List[str], array, array]:
+        # The when, currency and balance columns of the bank's history rows within [since, until], copied a slice
+        # per account rather than a row at a time
+        whens, currency_ids, previous_balances, new_balances = [], [], array("q"), array("q")
+        for account in self.banks_by_id[bank_id].accounts:
+            history = account.transactions
+            end = len(history.new_balances)  # The column append_row fills last
+            # Histories are appended in time order, so the range is bisected on the stored timestamps themselves;
+            # building every account's search index would cost more than the rows read
+            lo = bisect_left(history.whens, since, 0, end) if since is not None else 0
+            hi = bisect_right(history.whens, until, lo, end) if until is not None else end
+            whens.extend(history.whens[lo:hi])
+            currency_ids.extend(history.currency_ids[lo:hi])
+            previous_balances.extend(history.previous_balances[lo:hi])
+            new_balances.extend(history.new_balances[lo:hi])
+        return whens, currency_ids, previous_balances, new_balances
+
 
 class JsonDataEngine(DataEngine):
-    def __init__(self, file_path):
+    # The history file is only rewritten once at least this much of it is taken up by superseded segments
+    history_compact_min_bytes = 1 << 20
+
+    def __init__(self, file_path, history_segments=False, group_commit=True, group_commit_window=0.0, group_commit_max=256,
+                 snapshot_format="json"):
         super().__init__()
         self.file_path = file_path
+        # "json" writes a readable snapshot and JSON history segments; "binary" writes a compressed snapshot and
+        # columnar history segments (see snapshots.py). Either format is read whatever this is set to.
+        self.snapshot_format = snapshot_format
+        self.write_lock = threading.RLock()
+        # With group commit, commits queue up and one write makes everything queued durable. While a write is in
+        # progress the next batch collects, so batches grow with load on their own; a window additionally holds
+        # each batch open that many seconds (or until group_commit_max commits are queued)
+        self.group_commit = group_commit
+        self.group_commit_window = group_commit_window
+        self.group_commit_max = group_commit_max
+        self.apply_lock = threading.RLock()
+        self.commit_condition = threading.Condition()
+        self.pending_commits: List[Tuple[List[dict], Future]] = []
+        self.flushing = False
+        # With history segments each account's messages and transactions live in a separate history file
+        # and are only read when first accessed; the snapshot holds the account headers and segment offsets.
+        # Off by default so the snapshot stays a self-contained file; a segmented one is unreadable without its history file.
+        self.history_segments = history_segments
+        self.history_lock = threading.Lock()
+        self.history_name = None
+        self.history_fd = None
+        self.history_size = 0
+        self.history_live = 0
+        self.obsolete_history = []
+        self.lock_file = None
+
+    def lock_data_file(self):
+        # Every process would keep its own copy of the data and overwrite the others' saves,
+        # so a second process opening the same file is refused
+        if fcntl is None or self.lock_file is not None:
+            return
+        self.lock_file = open(self.file_path + ".lock", "a")
+        try:
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self.lock_file.close()
+            self.lock_file = None
+            raise RuntimeError(f"{self.file_path} is in use by another process; run multiple workers on the sqlite engine")
+
+    def read_snapshot(self) -> Tuple[DataModel, dict]:
+        with open(self.file_path, "rb") as file:
+            return DataModel.loads(decode_snapshot(file.read()))
+
+    def load_snapshot(self) -> dict:
+        self.lock_data_file()
+        self.data_model, metadata = self.read_snapshot()
+        self.history_name = metadata.get("history_file")
+        if self.history_name:
+            self.history_fd = os.open(self.history_path(self.history_name), os.O_RDWR)
+            self.history_size = os.fstat(self.history_fd).st_size
+        self.build_indexes()
+        self.history_live = sum(account.history_segment["length"] for account in self.accounts_by_id.values() if account.history_segment)
+        return metadata
 
     def load_data(self):
-        with open(self.file_path, "r") as file:
-            data = json.load(file)
-            self.data_model = DataModel.from_json(data)
+        self.load_snapshot()
+
+    def index_account(self, account: Account):
+        super().index_account(account)
+        if not account.history_loaded:
+            account.history_loader = self.read_history
+
+    def history_path(self, name: str) -> str:
+        return os.path.join(os.path.dirname(os.path.abspath(self.file_path)), name)
+
+    def read_history(self, account: Account) -> Tuple[List[Message], TransactionHistory]:
+        with self.history_lock:
+            segment = account.history_segment
+            raw = os.pread(self.history_fd, segment["length"], segment["offset"])
+        return decode_history(raw)
+
+    def encode_history(self, account: Account) -> bytes:
+        # Cleared before encoding so a transfer applied meanwhile marks the account dirty again for the next save
+        account.history_dirty = False
+        if self.snapshot_format == "binary":
+            return encode_history(account.messages, account.transactions)
+        return json.dumps(account.history_json(), separators=(",", ":")).encode() + b"\n"
+
+    def append_histories(self):
+        # Only new and changed histories are written; every other account keeps its existing segment
+        chunks = []
+        offset = self.history_size
+        for account in self.accounts_by_id.values():
+            if account.history_segment is not None and not account.history_dirty:
+                continue
+            chunk = self.encode_history(account)
+            if account.history_segment is not None:
+                self.history_live -= account.history_segment["length"]
+            account.history_segment = {"offset": offset, "length": len(chunk)}
+            self.history_live += len(chunk)
+            offset += len(chunk)
+            chunks.append(chunk)
+        if chunks:
+            written = os.pwrite(self.history_fd, b"".join(chunks), self.history_size)
+            os.fsync(self.history_fd)
+            registry.increment("bank_storage_bytes_written_total", written, kind="history")
+            self.history_size = offset
+
+    def rewrite_history(self):
+        # Copies every live segment into a new generation of the history file, dropping superseded ones.
+        # The old file stays until a snapshot pointing at the new one is on disk.
+        generation = int(self.history_name.rsplit(".", 1)[1]) + 1 if self.history_name else 1
+        name = f"{os.path.basename(self.file_path)}.history.{generation}"
+        fd = os.open(self.history_path(name), os.O_RDWR | os.O_CREAT | os.O_TRUNC)
+        chunks = []
+        offset = 0
+        for account in self.accounts_by_id.values():
+            if account.history_segment is None or account.history_dirty:
+                chunk = self.encode_history(account)
+            else:
+                chunk = os.pread(self.history_fd, account.history_segment["length"], account.history_segment["offset"])
+            account.history_segment = {"offset": offset, "length": len(chunk)}
+            offset += len(chunk)
+            chunks.append(chunk)
+        written = os.pwrite(fd, b"".join(chunks), 0)
+        os.fsync(fd)
+        registry.increment("bank_storage_bytes_written_total", written, kind="history")
+
+        if self.history_fd is not None:
+            os.close(self.history_fd)
+            self.obsolete_history.append(self.history_name)
+        self.history_name = name
+        self.history_fd = fd
+        self.history_size = offset
+        self.history_live = offset
+
+    def snapshot_json(self) -> dict:
+        if not self.history_segments:
+            return self.data_model.to_json()
+        with self.history_lock:
+            if self.history_fd is None or self.history_size - self.history_live > max(self.history_live, self.history_compact_min_bytes):
+                self.rewrite_history()
+            else:
+                self.append_histories()
+        data = self.data_model.to_json(include_history=False)
+        data["history_file"] = self.history_name
+        return data
+
+    def mutate_many(self, records: List[dict]):
+        # Records are applied and queued in one step, so queue order is apply order and a snapshot taken
+        # under apply_lock holds exactly the records queued so far
+        with self.apply_lock:
+            for record in records:
+                self.apply_record(record)
+            future = self.queue_commit(records)
+        # The caller is only acknowledged once the batch holding its records is durable
+        self.wait_durable(future)
+        self.notify(records)
+
+    def commit(self, records: List[dict]):
+        self.wait_durable(self.queue_commit(records))
+
+    def queue_commit(self, records: List[dict]) -> Future:
+        future = Future()
+        if not self.group_commit:
+            self.write_commits([records])
+            future.set_result(None)
+            return future
+        with self.commit_condition:
+            self.pending_commits.append((records, future))
+            self.commit_condition.notify_all()
+        return future
+
+    def wait_durable(self, future: Future):
+        # Leader/follower group commit: the first waiter to find no write in progress writes everything queued,
+        # the others wait for it. A lone writer therefore never hands off to another thread.
+        while True:
+            with self.commit_condition:
+                while not future.done() and self.flushing:
+                    self.commit_condition.wait()
+                if future.done():
+                    break
+                self.flushing = True
+            try:
+                self.flush_commits(future)
+            finally:
+                with self.commit_condition:
+                    self.flushing = False
+                    self.commit_condition.notify_all()
+        future.result()
+
+    def flush_commits(self, own: Future):
+        # Writes batches until the leader's own commit is durable; whatever is queued after that goes to the next leader
+        while not own.done():
+            with self.commit_condition:
+                if self.group_commit_window:
+                    deadline = time.monotonic() + self.group_commit_window
+                    while len(self.pending_commits) < self.group_commit_max:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        self.commit_condition.wait(remaining)
+                batch = self.pending_commits[:self.group_commit_max]
+                del self.pending_commits[:self.group_commit_max]
+
+            try:
+                self.write_commits([records for records, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+            else:
+                for _, future in batch:
+                    future.set_result(None)
+            with self.commit_condition:
+                self.commit_condition.notify_all()
+
+    def write_commits(self, commits: List[List[dict]]):
+        # Every commit's records are already applied in memory, so one snapshot covers the whole batch
+        registry.increment("bank_storage_commits_total", len(commits))
+        self.save_data()
+
+    def remove_obsolete_history(self):
+        for name in self.obsolete_history:
+            os.remove(self.history_path(name))
+        self.obsolete_history = []
+
+    def write_snapshot(self, data: dict):
+        # Write to a temporary file and rename it over the old one so a crash never leaves a half-written file
+        temp_path = self.file_path + ".tmp"
+        with open(temp_path, "wb" if self.snapshot_format == "binary" else "w") as file:
+            if self.snapshot_format == "binary":
+                file.write(encode_snapshot(data))
+            else:
+                json.dump(data, file, indent=4)
+            file.flush()
+            os.fsync(file.fileno())
+            written = file.tell()
+        os.replace(temp_path, self.file_path)
+        registry.increment("bank_storage_saves_total", kind="snapshot")
+        registry.increment("bank_storage_bytes_written_total", written, kind="snapshot")
 
     def save_data(self):
-        with open(self.file_path, "w") as file:
-            json.dump(self.data_model.to_json(), file, indent=4)
-            print("Data saved")
+        with self.write_lock:
+            # Mutations wait while the snapshot is taken, so it never holds a transfer with only one side applied
+            with self.apply_lock:
+                data = self.snapshot_json()
+            self.write_snapshot(data)
+            self.remove_obsolete_history()
+        logger.info("Data saved")
+
+    def close(self):
+        # Lets go of the files this engine holds open, including its lock; the engine is not used afterwards
+        if self.history_fd is not None:
+            os.close(self.history_fd)
+            self.history_fd = None
+        if self.lock_file is not None:
+            self.lock_file.close()
+            self.lock_file = None
+
+
+class JournaledJsonDataEngine(JsonDataEngine):
+    def __init__(self, file_path, journal_path=None, compact_every=1000, history_segments=False, **group_commit_options):
+        super().__init__(file_path, history_segments, **group_commit_options)
+        self.journal_path = journal_path or file_path + ".journal"
+        self.compact_every = compact_every
+        self.journal_seq = 0
+        self.journal_records = 0
+        self.journal_file = None
+
+    def load_data(self):
+        metadata = self.load_snapshot()
+        self.journal_seq = metadata.get("journal_seq", 0)
+        self.journal_records = 0
+
+        if os.path.exists(self.journal_path) and os.path.getsize(self.journal_path) > 0:
+            with open(self.journal_path, "r") as file:
+                for line in file:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        break  # Torn write at the end of the journal
+                    # Records at or below the snapshot sequence were already folded in by a compaction
+                    if record["seq"] <= self.journal_seq:
+                        continue
+                    self.apply_record(record)
+                    self.journal_seq = record["seq"]
+                    self.journal_records += 1
+
+            # Fold the replayed records into a new snapshot so a torn tail is never followed by new records
+            self.save_data()
+
+    def queue_commit(self, records: List[dict]) -> Future:
+        # A multi-record commit is written as one line so a torn write can never replay half of it.
+        # Sequence numbers are taken here, under apply_lock, so they follow apply order.
+        record = records[0] if len(records) == 1 else {"op": "batch", "records": records}
+        self.journal_seq += 1
+        record["seq"] = self.journal_seq
+        return super().queue_commit([record])
+
+    def write_commits(self, commits: List[List[dict]]):
+        with self.write_lock:
+            # A group of commits goes out in a single write and fsync
+            data = "".join(json.dumps(record, separators=(",", ":")) + "\n" for [record] in commits)
+            self.journal_records += sum(1 for _ in iter_records([record for [record] in commits]))
+            if self.journal_file is None:
+                self.journal_file = open(self.journal_path, "a")
+            self.journal_file.write(data)
+            self.journal_file.flush()
+            os.fsync(self.journal_file.fileno())
+            registry.increment("bank_storage_saves_total", kind="journal")
+            registry.increment("bank_storage_commits_total", len(commits))
+            registry.increment("bank_storage_bytes_written_total", len(data.encode()), kind="journal")
+
+            if self.journal_records >= self.compact_every:
+                self.save_data()
+
+    def save_data(self):
+        with self.write_lock:
+            # Mutations wait while the snapshot is taken, so it holds exactly the records up to journal_seq.
+            # Ones still queued are written to the new journal with lower sequence numbers and skipped on replay.
+            with self.apply_lock:
+                data = self.snapshot_json()
+                data["journal_seq"] = self.journal_seq
+            self.write_snapshot(data)
+            self.remove_obsolete_history()
+
+            if self.journal_file is not None:
+                self.journal_file.close()
+            self.journal_file = open(self.journal_path, "w")
+            self.journal_records = 0
+        logger.info("Data compacted")
+
+    def close(self):
+        if self.journal_file is not None:
+            self.journal_file.close()
+            self.journal_file = None
+        super().close()
+
+
+def conversion_column(conversion: Conversion | None) -> str | None:
+    return json.dumps(conversion.to_json()) if conversion is not None else None
+
+def conversion_from_column(value: str | None) -> Conversion | None:
+    return Conversion.from_json(json.loads(value)) if value else None
+
+
+class SqliteDataEngine(DataEngine):
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS currencies (
+            currency_id TEXT PRIMARY KEY,
+            name TEXT NOT NULL,
+            code TEXT NOT NULL,
+            symbol TEXT NOT NULL,
+            bank_id TEXT NOT NULL,
+            created_at TEXT NOT NULL,
+            scale INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS users (
+            user_id TEXT PRIMARY KEY,
+            name TEXT NOT NULL,
+            email TEXT NOT NULL,
+            password TEXT NOT NULL,
+            created_at TEXT NOT NULL
+        );
+        CREATE UNIQUE INDEX IF NOT EXISTS users_email ON users (email);
+        CREATE TABLE IF NOT EXISTS banks (
+            bank_id TEXT PRIMARY KEY,
+            name TEXT NOT NULL,
+            bank_type TEXT NOT NULL,
+            created_at TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS account_types (
+            bank_id TEXT NOT NULL REFERENCES banks (bank_id),
+            type_id TEXT NOT NULL,
+            name TEXT NOT NULL,
+            description TEXT NOT NULL,
+            PRIMARY KEY (bank_id, type_id)
+        );
+        CREATE TABLE IF NOT EXISTS bank_admins (
+            bank_id TEXT NOT NULL REFERENCES banks (bank_id),
+            user_id TEXT NOT NULL,
+            permissions TEXT NOT NULL,
+            PRIMARY KEY (bank_id, user_id)
+        );
+        CREATE TABLE IF NOT EXISTS accounts (
+            account_id TEXT PRIMARY KEY,
+            bank_id TEXT NOT NULL REFERENCES banks (bank_id),
+            type_id TEXT NOT NULL,
+            owner_type TEXT NOT NULL,
+            owner_id TEXT NOT NULL,
+            created_at TEXT NOT NULL,
+            authentication TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS accounts_owner_id ON accounts (owner_id);
+        CREATE INDEX IF NOT EXISTS accounts_bank_id ON accounts (bank_id);
+        CREATE TABLE IF NOT EXISTS balances (
+            account_id TEXT NOT NULL REFERENCES accounts (account_id),
+            currency_id TEXT NOT NULL,
+            balance INTEGER NOT NULL,
+            PRIMARY KEY (account_id, currency_id)
+        );
+        CREATE TABLE IF NOT EXISTS transactions (
+            id INTEGER PRIMARY KEY,
+            account_id TEXT NOT NULL REFERENCES accounts (account_id),
+            from_id TEXT NOT NULL,
+            to_id TEXT NOT NULL,
+            "when" TEXT NOT NULL,
+            currency_id TEXT NOT NULL,
+            previous_balance INTEGER NOT NULL,
+            new_balance INTEGER NOT NULL,
+            conversion TEXT
+        );
+        CREATE INDEX IF NOT EXISTS transactions_account_id ON transactions (account_id);
+        CREATE INDEX IF NOT EXISTS transactions_account_when ON transactions (account_id, "when");
+        CREATE INDEX IF NOT EXISTS transactions_account_counterparty ON transactions (account_id, (CASE WHEN from_id = account_id THEN to_id ELSE from_id END));
+        CREATE INDEX IF NOT EXISTS transactions_account_currency ON transactions (account_id, currency_id);
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY,
+            account_id TEXT NOT NULL REFERENCES accounts (account_id),
+            owner_type TEXT NOT NULL,
+            owner_id TEXT NOT NULL,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS messages_account_id ON messages (account_id);
+        CREATE TABLE IF NOT EXISTS exchange_rates (
+            from_id TEXT NOT NULL,
+            to_id TEXT NOT NULL,
+            bank_id TEXT NOT NULL REFERENCES banks (bank_id),
+            rate TEXT NOT NULL,
+            updated_at TEXT NOT NULL,
+            PRIMARY KEY (from_id, to_id)
+        );
+        CREATE TABLE IF NOT EXISTS standing_orders (
+            order_id TEXT PRIMARY KEY,
+            account_id TEXT NOT NULL REFERENCES accounts (account_id),
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS standing_orders_account_id ON standing_orders (account_id);
+        CREATE TABLE IF NOT EXISTS revoked_tokens (
+            digest TEXT PRIMARY KEY,
+            exp REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            records TEXT NOT NULL
+        );
+    """
+
+    # A transaction row is stored for each side of a transfer; this is the account on the other side,
+    # written exactly as in the transactions_account_counterparty index so queries can use it
+    COUNTERPARTY = "CASE WHEN transactions.from_id = transactions.account_id THEN transactions.to_id ELSE transactions.from_id END"
+
+    # Committed records are kept in the changes table this long (in commits) for workers to catch up
+    changes_kept = 100000
+
+    def __init__(self, database_path, sync_interval=0.25):
+        super().__init__()
+        self.database_path = database_path
+        self.local = threading.local()
+        self.pid = os.getpid()
+        # Every worker process tails the changes table and replays it to its own listeners,
+        # so in-memory caches see commits made by other workers as well as their own
+        self.sync_interval = sync_interval
+        self.sync_lock = threading.Lock()
+        self.sync_thread = None
+        self.change_seq = 0
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        if self.pid != os.getpid():
+            # Forked after the connections were opened (e.g. gunicorn --preload); they must not be shared
+            self.local = threading.local()
+            self.pid = os.getpid()
+            self.sync_thread = None
+        # sqlite3 connections cannot be shared between threads, so each request thread gets its own
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.database_path, isolation_level=None, timeout=30)
+            connection.row_factory = sqlite3.Row
+            connection.execute("PRAGMA journal_mode = WAL")
+            connection.execute("PRAGMA synchronous = NORMAL")
+            self.local.connection = connection
+        return connection
+
+    @contextmanager
+    def transaction(self):
+        connection = self.connection
+        if connection.in_transaction:
+            yield connection
+            return
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield connection
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+        registry.increment("bank_storage_saves_total", kind="sqlite")
+        self.sync()
+
+    def write_transaction(self):
+        # BEGIN IMMEDIATE takes the database write lock, so validation and the write it guards are serializable
+        # across every worker process
+        return self.transaction()
+
+    def load_data(self):
+        connection = self.connection
+        connection.executescript(self.SCHEMA)
+        # Databases created before cross-currency transfers have no conversion column yet
+        if "conversion" not in [column["name"] for column in connection.execute("PRAGMA table_info(transactions)")]:
+            try:
+                connection.execute("ALTER TABLE transactions ADD COLUMN conversion TEXT")
+            except sqlite3.OperationalError:
+                pass  # Another worker added it first
+        # Listeners start out empty and load what they need from the database, so only later changes matter
+        self.change_seq = connection.execute("SELECT COALESCE(MAX(seq), 0) FROM changes").fetchone()[0]
+
+    def append_changes(self, records: List[dict]):
+        connection = self.connection
+        seq = connection.execute("INSERT INTO changes (records) VALUES (?)", (json.dumps(records, separators=(",", ":")),)).lastrowid
+        if seq % 1000 == 0:
+            connection.execute("DELETE FROM changes WHERE seq <= ?", (seq - self.changes_kept,))
+
+    def sync(self):
+        # Replays committed records newer than the last ones seen to the listeners, in commit order
+        if self.connection.in_transaction:
+            return  # Called again once the outer transaction commits
+        with self.sync_lock:
+            if self.sync_thread is None and self.sync_interval:
+                self.sync_thread = threading.Thread(target=self.sync_forever, daemon=True, name="storage-sync")
+                self.sync_thread.start()
+            rows = self.connection.execute("SELECT seq, records FROM changes WHERE seq > ? ORDER BY seq", (self.change_seq,)).fetchall()
+            if rows and rows[0]["seq"] != self.change_seq + 1:
+                # Fell behind by more than the changes kept: listeners have to drop everything they hold
+                self.notify([{"op": "reload"}])
+            for row in rows:
+                self.change_seq = row["seq"]
+                self.notify(json.loads(row["records"]))
+
+    def sync_forever(self):
+        # Keeps idle workers current (e.g. for /user/events subscribers) when no request triggers a sync
+        while True:
+            time.sleep(self.sync_interval)
+            try:
+                self.sync()
+            except sqlite3.Error:
+                logger.exception("Storage sync failed")
+
+    def save_data(self):
+        pass  # Every mutation is committed by its own SQL transaction
+
+    def build_indexes(self):
+        pass  # SQLite maintains its own indexes
+
+    def mutate_many(self, records: List[dict]):
+        # Listeners are notified through sync() once the transaction commits
+        with self.transaction():
+            for record in records:
+                self.apply_record(record)
+            self.append_changes(records)
+
+    def import_json(self, data: dict):
+        DataModel.upgrade_money(data)
+        with self.transaction():
+            for currency in data.get("currencies", []):
+                self.apply_currency({"op": "currency", "currency": currency})
+            for user in data.get("users", []):
+                self.apply_user({"op": "user", "user": user})
+            for bank in data.get("banks", []):
+                self.apply_bank({"op": "bank", "bank": bank})
+            for rate in data.get("exchange_rates", []):
+                self.apply_rate({"op": "rate", "rate": rate})
+            for digest, exp in data.get("revoked_tokens", {}).items():
+                self.apply_revoke({"op": "revoke", "digest": digest, "exp": exp})
+
+    def insert_account(self, account: Account):
+        connection = self.connection
+        connection.execute(
+            "INSERT INTO accounts VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (account.account_id, account.bank_id, account.type_id, account.owner.type, account.owner.owner_id,
+             account.created_at, json.dumps([a.to_json() for a in account.authentication]))
+        )
+        connection.executemany(
+            "INSERT INTO balances VALUES (?, ?, ?)",
+            [(account.account_id, currency_id, balance) for currency_id, balance in account.balances.items()]
+        )
+        connection.executemany(
+            "INSERT INTO transactions (account_id, from_id, to_id, \"when\", currency_id, previous_balance, new_balance, conversion) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            [(account.account_id, t.from_id, t.to_id, t.when, t.currency_id, t.previous_balance, t.new_balance, conversion_column(t.conversion))
+             for t in account.transactions]
+        )
+        connection.executemany(
+            "INSERT INTO messages (account_id, owner_type, owner_id, data) VALUES (?, ?, ?, ?)",
+            [(account.account_id, m.owner.type, m.owner.owner_id, m.data) for m in account.messages]
+        )
+        connection.executemany(
+            "INSERT INTO standing_orders VALUES (?, ?, ?)",
+            [(order.order_id, account.account_id, json.dumps(order.to_json())) for order in account.standing_orders]
+        )
+
+    def apply_batch(self, record: dict):
+        for sub_record in record["records"]:
+            self.apply_record(sub_record)
+
+    def apply_user(self, record: dict):
+        user = User.from_json(record["user"])
+        self.connection.execute(
+            "INSERT INTO users VALUES (?, ?, ?, ?, ?)",
+            (user.user_id, user.name, user.email, user.password, user.created_at)
+        )
+
+    def apply_currency(self, record: dict):
+        currency = Currency.from_json(record["currency"])
+        self.connection.execute(
+            "INSERT INTO currencies VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (currency.currency_id, currency.name, currency.code, currency.symbol, currency.bank_id, currency.created_at, currency.scale)
+        )
+
+    def apply_bank(self, record: dict):
+        bank = Bank.from_json(record["bank"])
+        connection = self.connection
+        connection.execute(
+            "INSERT INTO banks VALUES (?, ?, ?, ?)",
+            (bank.bank_id, bank.name, bank.bank_type, bank.created_at)
+        )
+        connection.executemany(
+            "INSERT INTO account_types VALUES (?, ?, ?, ?)",
+            [(bank.bank_id, t.type_id, t.name, t.description) for t in bank.account_types]
+        )
+        connection.executemany(
+            "INSERT INTO bank_admins VALUES (?, ?, ?)",
+            [(bank.bank_id, a.user_id, json.dumps(a.permissions)) for a in bank.admin_authentication]
+        )
+        for account in bank.accounts:
+            self.insert_account(account)
+
+    def apply_account(self, record: dict):
+        self.insert_account(Account.from_json(record["account"]))
+
+    def apply_transfer(self, record: dict):
+        connection = self.connection
+        conversion = json.dumps(record["conversion"]) if "conversion" in record else None
+
+        def balance_of(account_id: str, currency_id: str) -> int:
+            return connection.execute(
+                "SELECT balance FROM balances WHERE account_id = ? AND currency_id = ?",
+                (account_id, currency_id)
+            ).fetchone()["balance"]
+
+        for account_id, currency_id, previous_balance, new_balance in transfer_balances(record, balance_of):
+            connection.execute(
+                "UPDATE balances SET balance = ? WHERE account_id = ? AND currency_id = ?",
+                (new_balance, account_id, currency_id)
+            )
+            connection.execute(
+                "INSERT INTO transactions (account_id, from_id, to_id, \"when\", currency_id, previous_balance, new_balance, conversion) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (account_id, record["from"], record["to"], record["when"], currency_id, previous_balance, new_balance, conversion)
+            )
+
+    def apply_balance(self, record: dict):
+        self.connection.execute(
+            "INSERT INTO balances VALUES (?, ?, ?) ON CONFLICT (account_id, currency_id) DO UPDATE SET balance = excluded.balance",
+            (record["account_id"], record["currency_id"], record["balance"])
+        )
+
+    def apply_password(self, record: dict):
+        self.connection.execute("UPDATE users SET password = ? WHERE email = ?", (record["password"], record["email"]))
+
+    def apply_rate(self, record: dict):
+        rate = record["rate"]
+        self.connection.execute(
+            "INSERT INTO exchange_rates VALUES (?, ?, ?, ?, ?) ON CONFLICT (from_id, to_id) DO UPDATE SET "
+            "bank_id = excluded.bank_id, rate = excluded.rate, updated_at = excluded.updated_at",
+            (rate["from"], rate["to"], rate["bank_id"], rate["rate"], rate.get("updated_at", ""))
+        )
+
+    def apply_message(self, record: dict):
+        owner = record["from"]
+        self.connection.executemany(
+            "INSERT INTO messages (account_id, owner_type, owner_id, data) VALUES (?, ?, ?, ?)",
+            [(account_id, owner.get("type", ""), owner.get("owner_id", ""), record["data"]) for account_id in record["accounts"]]
+        )
+
+    def apply_order(self, record: dict):
+        order = record["order"]
+        self.connection.execute(
+            "INSERT INTO standing_orders VALUES (?, ?, ?) ON CONFLICT (order_id) DO UPDATE SET data = excluded.data",
+            (order["order_id"], order["account_id"], json.dumps(order))
+        )
+
+    def apply_order_cancel(self, record: dict):
+        self.connection.execute("DELETE FROM standing_orders WHERE order_id = ?", (record["order_id"],))
+
+    def apply_revoke(self, record: dict):
+        connection = self.connection
+        connection.execute("DELETE FROM revoked_tokens WHERE exp <= ?", (time.time(),))
+        connection.execute("INSERT OR REPLACE INTO revoked_tokens VALUES (?, ?)", (record["digest"], record["exp"]))
+
+    def account_from_row(self, row: sqlite3.Row) -> Account:
+        account_id = row["account_id"]
+        balances = self.connection.execute(
+            "SELECT currency_id, balance FROM balances WHERE account_id = ?", (account_id,)
+        ).fetchall()
+        # Messages and transactions are only queried if the caller actually reads them.
+        # Standing orders are not attached; look them up with find_standing_orders
+        return Account(
+            account_id,
+            row["bank_id"],
+            row["type_id"],
+            OwnerType(row["owner_type"], row["owner_id"]),
+            row["created_at"],
+            {b["currency_id"]: b["balance"] for b in balances},
+            None,
+            None,
+            [Authentication.from_json(a) for a in json.loads(row["authentication"])],
+            history_loader=self.read_history
+        )
+
+    def read_history(self, account: Account) -> Tuple[List[Message], TransactionHistory]:
+        connection = self.connection
+        messages = connection.execute(
+            "SELECT owner_type, owner_id, data FROM messages WHERE account_id = ? ORDER BY id", (account.account_id,)
+        ).fetchall()
+        transactions = connection.execute(
+            "SELECT from_id, to_id, \"when\", currency_id, previous_balance, new_balance, conversion FROM transactions WHERE account_id = ? ORDER BY id",
+            (account.account_id,)
+        ).fetchall()
+        history = TransactionHistory()
+        for t in transactions:
+            history.append_row(*t[:6], conversion_from_column(t[6]))
+        return [Message(OwnerType(m["owner_type"], m["owner_id"]), m["data"]) for m in messages], history
+
+    def bank_from_row(self, row: sqlite3.Row) -> Bank:
+        connection = self.connection
+        account_types = connection.execute(
+            "SELECT type_id, name, description FROM account_types WHERE bank_id = ?", (row["bank_id"],)
+        ).fetchall()
+        admins = connection.execute(
+            "SELECT user_id, permissions FROM bank_admins WHERE bank_id = ?", (row["bank_id"],)
+        ).fetchall()
+        # Accounts are not attached; look them up with find_account_by_id or find_user_accounts
+        return Bank(
+            row["bank_id"],
+            row["name"],
+            row["bank_type"],
+            row["created_at"],
+            [AccountType(t["type_id"], t["name"], t["description"]) for t in account_types],
+            [BankAdminAuthentication(a["user_id"], json.loads(a["permissions"])) for a in admins],
+            []
+        )
+
+    def find_user(self, email: str) -> User | None:
+        row = self.connection.execute(
+            "SELECT user_id, name, email, password, created_at FROM users WHERE email = ?", (email,)
+        ).fetchone()
+        return User(*row) if row else None
+
+    def find_user_accounts(self, user_id: str) -> List[Account]:
+        rows = self.connection.execute("SELECT * FROM accounts WHERE owner_id = ?", (user_id,)).fetchall()
+        return [self.account_from_row(row) for row in rows]
+
+    def find_account_by_id(self, account_id: str) -> Account | None:
+        row = self.connection.execute("SELECT * FROM accounts WHERE account_id = ?", (account_id,)).fetchone()
+        return self.account_from_row(row) if row else None
+
+    def find_accounts_by_currency(self, user_id: str, currency_id: str) -> List[Account]:
+        rows = self.connection.execute(
+            "SELECT accounts.* FROM accounts JOIN balances ON balances.account_id = accounts.account_id "
+            "WHERE accounts.owner_id = ? AND balances.currency_id = ?",
+            (user_id, currency_id)
+        ).fetchall()
+        return [self.account_from_row(row) for row in rows]
+
+    def find_currency_by_id(self, currency_id: str) -> Currency | None:
+        row = self.connection.execute(
+            "SELECT currency_id, name, code, symbol, bank_id, created_at, scale FROM currencies WHERE currency_id = ?", (currency_id,)
+        ).fetchone()
+        return Currency(*row) if row else None
+
+    def find_currencies(self) -> List[Currency]:
+        rows = self.connection.execute("SELECT currency_id, name, code, symbol, bank_id, created_at, scale FROM currencies").fetchall()
+        return [Currency(*row) for row in rows]
+
+    def find_bank_by_id(self, bank_id: str) -> Bank | None:
+        row = self.connection.execute("SELECT * FROM banks WHERE bank_id = ?", (bank_id,)).fetchone()
+        return self.bank_from_row(row) if row else None
+
+    def find_banks(self) -> List[Bank]:
+        rows = self.connection.execute("SELECT * FROM banks").fetchall()
+        return [self.bank_from_row(row) for row in rows]
+
+    def find_exchange_rates(self) -> List[ExchangeRate]:
+        rows = self.connection.execute("SELECT * FROM exchange_rates").fetchall()
+        return [ExchangeRate(row["bank_id"], row["from_id"], row["to_id"], row["rate"], row["updated_at"]) for row in rows]
+
+    def find_revoked_tokens(self) -> Dict[str, float]:
+        rows = self.connection.execute("SELECT digest, exp FROM revoked_tokens WHERE exp > ?", (time.time(),)).fetchall()
+        return {row["digest"]: row["exp"] for row in rows}
+
+    def find_standing_order(self, order_id: str) -> StandingOrder | None:
+        row = self.connection.execute("SELECT data FROM standing_orders WHERE order_id = ?", (order_id,)).fetchone()
+        return StandingOrder.from_json(json.loads(row["data"])) if row else None
+
+    def find_standing_orders(self, user_id: str | None = None) -> List[StandingOrder]:
+        if user_id is None:
+            rows = self.connection.execute("SELECT data FROM standing_orders").fetchall()
+        else:
+            rows = self.connection.execute(
+                "SELECT standing_orders.data FROM standing_orders JOIN accounts ON accounts.account_id = standing_orders.account_id "
+                "WHERE accounts.owner_id = ? ORDER BY standing_orders.rowid",
+                (user_id,)
+            ).fetchall()
+        return [StandingOrder.from_json(json.loads(row["data"])) for row in rows]
+
+    def add_message(self, user_id: str, message_data: str):
+        rows = self.connection.execute("SELECT account_id FROM accounts WHERE owner_id = ?", (user_id,)).fetchall()
+        if rows:
+            self.mutate({
+                "op": "message",
+                "from": OwnerType("user", user_id).to_json(),
+                "accounts": [row["account_id"] for row in rows],
+                "data": message_data
+            })
+
+    def get_messages(self, user_id: str) -> List[Message] | None:
+        connection = self.connection
+        if not connection.execute("SELECT 1 FROM accounts WHERE owner_id = ? LIMIT 1", (user_id,)).fetchone():
+            return None
+        rows = connection.execute(
+            "SELECT messages.owner_type, messages.owner_id, messages.data FROM messages "
+            "JOIN accounts ON accounts.account_id = messages.account_id "
+            "WHERE accounts.owner_id = ? ORDER BY messages.id",
+            (user_id,)
+        ).fetchall()
+        return [{"owner": {"type": row["owner_type"], "owner_id": row["owner_id"]}, "data": row["data"]} for row in rows]
+
+    def find_transactions(self, user_id: str, limit: int, cursor: dict | None = None, account_id: str | None = None,
+                          since: str | None = None, until: str | None = None, currency_id: str | None = None,
+                          counterparty: str | None = None) -> Tuple[List[Tuple[str, Transaction]], dict | None]:
+        # Row ids grow with every insert, so they double as a newest-first keyset cursor
+        conditions = ["accounts.owner_id = ?"]
+        parameters = [user_id]
+        for condition, value in (
+            ("transactions.account_id = ?", account_id),
+            ("transactions.id < ?", (cursor or {}).get("id")),
+            ("transactions.\"when\" >= ?", since),
+            ("transactions.\"when\" <= ?", until),
+            ("transactions.currency_id = ?", currency_id)
+        ):
+            if value is not None:
+                conditions.append(condition)
+                parameters.append(value)
+        if counterparty is not None:
+            condition, values = self.counterparty_condition(user_id, counterparty)
+            conditions.append(condition)
+            parameters.extend(values)
+
+        rows = self.connection.execute(
+            "SELECT transactions.* FROM transactions JOIN accounts ON accounts.account_id = transactions.account_id "
+            f"WHERE {' AND '.join(conditions)} ORDER BY transactions.id DESC LIMIT ?",
+            parameters + [limit]
+        ).fetchall()
+        page = [(row["account_id"], Transaction(row["from_id"], row["to_id"], row["when"], row["currency_id"], row["previous_balance"], row["new_balance"],
+                                                conversion_from_column(row["conversion"]))) for row in rows]
+        return page, {"id": rows[-1]["id"]} if len(rows) == limit else None
+
+    def transaction_totals(self, user_id: str, period: str, account_id: str | None = None, since: str | None = None,
+                           until: str | None = None, currency_id: str | None = None,
+                           counterparty: str | None = None) -> List[dict]:
+        conditions = ["accounts.owner_id = ?"]
+        parameters = [PERIOD_PREFIX[period], user_id]
+        for condition, value in (
+            ("transactions.account_id = ?", account_id),
+            ("transactions.\"when\" >= ?", since),
+            ("transactions.\"when\" <= ?", until),
+            ("transactions.currency_id = ?", currency_id)
+        ):
+            if value is not None:
+                conditions.append(condition)
+                parameters.append(value)
+        if counterparty is not None:
+            condition, values = self.counterparty_condition(user_id, counterparty)
+            conditions.append(condition)
+            parameters.extend(values)
+
+        rows = self.connection.execute(
+            "SELECT substr(transactions.\"when\", 1, ?) AS period, transactions.currency_id, "
+            "SUM(MAX(new_balance - previous_balance, 0)) AS amount_in, SUM(MAX(previous_balance - new_balance, 0)) AS amount_out, "
+            "COUNT(*) AS count FROM transactions JOIN accounts ON accounts.account_id = transactions.account_id "
+            f"WHERE {' AND '.join(conditions)} GROUP BY period, transactions.currency_id ORDER BY period, transactions.currency_id",
+            parameters
+        ).fetchall()
+        return [{"period": row["period"], "currency_id": row["currency_id"], "in": row["amount_in"], "out": row["amount_out"], "count": row["count"]}
+                for row in rows]
+
+    def counterparty_condition(self, user_id: str, counterparty: str) -> Tuple[str, list]:
+        # Every row of the counterparty account itself involves it, which the indexed expression does not cover;
+        # that case only arises when the counterparty is one of the user's own accounts
+        own = self.connection.execute("SELECT 1 FROM accounts WHERE account_id = ? AND owner_id = ?", (counterparty, user_id)).fetchone()
+        if own:
+            return f"({self.COUNTERPARTY} = ? OR transactions.account_id = ?)", [counterparty, counterparty]
+        return f"{self.COUNTERPARTY} = ?", [counterparty]
+
+    def check_cursor(self, cursor: dict):
+        # Cursors here are the id of the last row handed out
+        if set(cursor) != {"id"} or type(cursor["id"]) is not int or cursor["id"] < 0:
+            raise ValueError("malformed cursor")
+
+    def find_messages(self, user_id: str, limit: int, cursor: dict | None = None, account_id: str | None = None,
+                      counterparty: str | None = None) -> Tuple[List[Tuple[str, Message]], dict | None]:
+        conditions = ["accounts.owner_id = ?"]
+        parameters = [user_id]
+        for condition, value in (
+            ("messages.account_id = ?", account_id),
+            ("messages.id < ?", (cursor or {}).get("id")),
+            ("messages.owner_id = ?", counterparty)
+        ):
+            if value is not None:
+                conditions.append(condition)
+                parameters.append(value)
+
+        rows = self.connection.execute(
+            "SELECT messages.* FROM messages JOIN accounts ON accounts.account_id = messages.account_id "
+            f"WHERE {' AND '.join(conditions)} ORDER BY messages.id DESC LIMIT ?",
+            parameters + [limit]
+        ).fetchall()
+        page = [(row["account_id"], Message(OwnerType(row["owner_type"], row["owner_id"]), row["data"])) for row in rows]
+        return page, {"id": rows[-1]["id"]} if len(rows) == limit else None
+
+    def bank_balance_columns(self, bank_id: str) -> Tuple[List[str], List[str], array]:
+        rows = self.connection.execute(
+            "SELECT balances.account_id, balances.currency_id, balances.balance FROM balances "
+            "JOIN accounts ON accounts.account_id = balances.account_id WHERE accounts.bank_id = ?", (bank_id,)
+        ).fetchall()
+        account_ids, currency_ids, balances = zip(*rows) if rows else ((), (), ())
+        return list(account_ids), list(currency_ids), array("q", balances)
+
+    def bank_history_columns(self, bank_id: str, since: str | None = None,
+                             until: str | None = None) -> Tuple[List[str], List[str], array, array]:
+        conditions = ["accounts.bank_id = ?"]
+        parameters = [bank_id]
+        for condition, value in (("transactions.\"when\" >= ?", since), ("transactions.\"when\" <= ?", until)):
+            if value is not None:
+                conditions.append(condition)
+                parameters.append(value)
+        rows = self.connection.execute(
+            "SELECT transactions.\"when\", transactions.currency_id, transactions.previous_balance, transactions.new_balance "
+            f"FROM transactions JOIN accounts ON accounts.account_id = transactions.account_id WHERE {' AND '.join(conditions)}",
+            parameters
+        ).fetchall()
+        whens, currency_ids, previous_balances, new_balances = zip(*rows) if rows else ((), (), (), ())
+        return list(whens), list(currency_ids), array("q", previous_balances), array("q", new_balances)
+
+
+def create_data_engine(engine_type: str, file_path: str, **options) -> DataEngine:
+    # Group commit options (group_commit, group_commit_window, group_commit_max), history_segments and snapshot_format
+    # apply to the JSON engines; SQLite commits in WAL mode without an fsync per transaction already
+    if engine_type == "sqlite":
+        return SqliteDataEngine(database_path=file_path)
+    if engine_type == "journal":
+        return JournaledJsonDataEngine(file_path=file_path, **options)
+    return JsonDataEngine(file_path=file_path, **options)
+
+def convert_snapshot(source_path: str, target_path: str, snapshot_format: str):
+    # Writes the data of a JSON engine's files (snapshot, history segments and any journal) as a new snapshot in the
+    # given format: binary with a columnar history file beside it, json as one self-contained file.
+    # The source is only changed by folding its journal in, as on startup.
+    if os.path.exists(source_path + ".journal"):
+        source = JournaledJsonDataEngine(file_path=source_path)
+    else:
+        source = JsonDataEngine(file_path=source_path)
+    source.load_data()
+    for account in source.accounts_by_id.values():
+        account.load_history()
+        account.history_dirty = True
+
+    target = JsonDataEngine(file_path=target_path, history_segments=snapshot_format == "binary", snapshot_format=snapshot_format)
+    target.lock_data_file()
+    target.data_model = source.data_model
+    target.build_indexes()
+    target.save_data()
+    source.close()
+    target.close()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Storage maintenance for the bank backend")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    import_parser = subparsers.add_parser("import-json", help="Import a data.json file into a new SQLite database")
+    import_parser.add_argument("json_path")
+    import_parser.add_argument("database_path")
+
+    convert_parser = subparsers.add_parser("convert", help="Rewrite a JSON engine's data in the binary or the JSON snapshot format")
+    convert_parser.add_argument("source_path")
+    convert_parser.add_argument("target_path")
+    convert_parser.add_argument("--format", choices=["binary", "json"], required=True)
+
+    args = parser.parse_args()
+    if args.command == "import-json":
+        with open(args.json_path, "r") as file:
+            data = json.load(file)
+        engine = SqliteDataEngine(database_path=args.database_path)
+        engine.load_data()
+        engine.import_json(data)
+        print(f"Imported {args.json_path} into {args.database_path}")
+    elif args.command == "convert":
+        if os.path.abspath(args.source_path) == os.path.abspath(args.target_path):
+            parser.error("the converted data must be written to a new path")
+        convert_snapshot(args.source_path, args.target_path, args.format)
+        print(f"Converted {args.source_path} to {args.target_path} ({args.format})")
@@ -0,0 +1,94 @@
+import json
+import threading
+import uuid
+from money import format_amount
+from storage import DataEngine, iter_records, transfer_sides
+from typing import Dict, Tuple
+
+class BalanceSummary:
+    __slots__ = ("version", "balances", "body", "etag")
+
+    def __init__(self, version: int, balances: Dict[Tuple[str, str], int]):
+        self.version = version
+        self.balances = balances
+        self.body: bytes | None = None
+        self.etag: str | None = None
+
+
+class BalanceSummaries:
+    def __init__(self, data_engine: DataEngine):
+        self.data_engine = data_engine
+        self.lock = threading.Lock()
+        self.summaries: Dict[str, BalanceSummary] = {}
+        # Versions are never reset, so a rebuilt summary can never reuse an ETag a client already holds
+        self.versions: Dict[str, int] = {}
+        # Distinguishes ETags handed out before a restart from the ones issued now
+        self.epoch = uuid.uuid4().hex[:8]
+        data_engine.add_listener(self.on_commit)
+
+    def next_version(self, user_id: str) -> int:
+        version = self.versions.get(user_id, 0) + 1
+        self.versions[user_id] = version
+        return version
+
+    def get(self, user_id: str) -> Tuple[bytes, str] | None:
+        # Returns the serialized {"balances": [...]} body and its ETag, or None when the user has no accounts
+        with self.lock:
+            summary = self.summaries.get(user_id)
+            if summary is None:
+                accounts = self.data_engine.find_user_accounts(user_id)
+                if not accounts:
+                    return None
+                balances = {(account.account_id, currency_id): balance for account in accounts for currency_id, balance in account.balances.items()}
+                summary = BalanceSummary(self.next_version(user_id), balances)
+                self.summaries[user_id] = summary
+            if summary.body is None:
+                self.render(summary)
+            return summary.body, summary.etag
+
+    def render(self, summary: BalanceSummary):
+        balances = [{
+            "account_id": account_id,
+            "currency_id": currency_id,
+            "balance": format_amount(balance, self.data_engine.find_currency_by_id(currency_id).scale)
+        } for (account_id, currency_id), balance in summary.balances.items()]
+        summary.body = json.dumps({"balances": balances}).encode()
+        summary.etag = f"{self.epoch}-{summary.version}"
+
+    def refresh(self, account_id: str, currency_id: str):
+        # Reads the account's current balance rather than applying a delta, so refreshing twice is harmless
+        account = self.data_engine.find_account_by_id(account_id)
+        if account is None:
+            return
+        owner_id = account.owner.owner_id
+        summary = self.summaries.get(owner_id)
+        if summary is None:
+            return
+        balance = account.balances.get(currency_id)
+        key = (account_id, currency_id)
+        if balance is None or summary.balances.get(key) == balance:
+            return
+        summary.balances[key] = balance
+        summary.version = self.next_version(owner_id)
+        summary.body = None
+
+    def invalidate(self, owner_id: str):
+        self.summaries.pop(owner_id, None)
+
+    def on_commit(self, records: list):
+        with self.lock:
+            if records[0]["op"] == "reload":
+                self.summaries.clear()  # Storage cannot say what changed, so every summary is rebuilt on demand
+                return
+            for record in iter_records(records):
+                op = record["op"]
+                if op == "transfer":
+                    for account_id, currency_id, _ in transfer_sides(record):
+                        self.refresh(account_id, currency_id)
+                elif op == "balance":
+                    self.refresh(record["account_id"], record["currency_id"])
+                elif op == "account":
+                    self.invalidate(record["account"]["owner"]["owner_id"])
+                elif op == "bank":
+                    for account in record["bank"]["accounts"]:
+                        self.invalidate(account["owner"]["owner_id"])
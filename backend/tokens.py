@@ -0,0 +1,98 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Tuple
+import jwt
+
+class TokenCache:
+    def __init__(self, secret_key: str, find_revoked: Callable[[], Dict[str, float]], max_size: int = 10000):
+        self.secret_key = secret_key
+        # Reads the stored revocations (hex digest -> expiry), on startup and whenever commits may have been missed
+        self.find_revoked = find_revoked
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        # token digest -> (user_id, exp), least recently used first
+        self.entries: "OrderedDict[bytes, Tuple[str, float]]" = OrderedDict()
+        # Revoked token digests until they expire anyway
+        self.revoked: Dict[bytes, float] = {}
+        self.hits = 0
+        self.misses = 0
+        self.load_revocations()
+
+    @staticmethod
+    def digest(token: str) -> bytes:
+        return hashlib.sha256(token.encode()).digest()
+
+    def verify(self, token: str) -> str | None:
+        digest = self.digest(token)
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(digest)
+            if entry is not None:
+                user_id, exp = entry
+                if exp > now and digest not in self.revoked:
+                    self.entries.move_to_end(digest)
+                    self.hits += 1
+                    return user_id
+                del self.entries[digest]
+            self.misses += 1
+
+        # The signature check runs outside the lock so a miss never blocks cached lookups
+        try:
+            payload = jwt.decode(token, self.secret_key, algorithms=["HS256"])
+        except jwt.ExpiredSignatureError:
+            return None  # Token has expired
+        except jwt.InvalidTokenError:
+            return None  # Invalid token
+
+        user_id = payload["user_id"]
+        with self.lock:
+            if digest in self.revoked:
+                return None
+            self.entries[digest] = (user_id, payload["exp"])
+            if len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        return user_id
+
+    def revocation(self, token: str) -> dict | None:
+        # Stored on logout so every worker process, and every later restart, rejects the token until its own expiry
+        try:
+            exp = jwt.decode(token, self.secret_key, algorithms=["HS256"], options={"verify_exp": False})["exp"]
+        except jwt.InvalidTokenError:
+            return None
+        return {"op": "revoke", "digest": self.digest(token).hex(), "exp": exp}
+
+    def apply_revocation(self, digest: bytes, exp: float):
+        now = time.time()
+        with self.lock:
+            self.entries.pop(digest, None)
+            self.revoked = {d: e for d, e in self.revoked.items() if e > now}
+            self.revoked[digest] = exp
+
+    def load_revocations(self):
+        revoked = {bytes.fromhex(digest): exp for digest, exp in self.find_revoked().items()}
+        with self.lock:
+            for digest in revoked:
+                self.entries.pop(digest, None)
+            self.revoked = revoked
+
+    def on_commit(self, records: list):
+        if records[0]["op"] == "reload":
+            self.load_revocations()
+            return
+        for record in records:
+            if record["op"] == "revoke":
+                self.apply_revocation(bytes.fromhex(record["digest"]), record["exp"])
+
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self.entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+                "revoked": len(self.revoked)
+            }
@@ -0,0 +1,150 @@
+import threading
+from contextlib import contextmanager
+from models import *
+from money import MAX_MINOR_UNITS, parse_amount
+from exchange import ExchangeRates
+from storage import DataEngine
+from typing import Dict, List, Tuple
+
+class TransferError(Exception):
+    def __init__(self, message: str, status: int = 400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+class TransferEngine:
+    def __init__(self, data_engine: DataEngine, exchange_rates: ExchangeRates | None = None):
+        self.data_engine = data_engine
+        # Without exchange rates only same-currency transfers are accepted
+        self.exchange_rates = exchange_rates
+        self.account_locks: Dict[str, threading.Lock] = {}
+        self.account_locks_guard = threading.Lock()
+
+    def account_lock(self, account_id: str) -> threading.Lock:
+        lock = self.account_locks.get(account_id)
+        if lock is None:
+            with self.account_locks_guard:
+                lock = self.account_locks.setdefault(account_id, threading.Lock())
+        return lock
+
+    @contextmanager
+    def lock_accounts(self, *account_ids: str):
+        # Always acquire in sorted order so two opposing transfers can never deadlock
+        locks = [self.account_lock(account_id) for account_id in sorted(set(account_ids))]
+        for lock in locks:
+            lock.acquire()
+        try:
+            yield
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+
+    def validate(self, user_id: str, data: dict, pending: Dict[Tuple[str, str], int] | None = None) -> Tuple[Account, Account, str, int, Conversion | None]:
+        # Validate sender and recipient accounts
+        sender_account = self.data_engine.find_account_by_id(data.get("from"))
+        recipient_account = self.data_engine.find_account_by_id(data.get("to"))
+
+        if not sender_account or not recipient_account:
+            raise TransferError("Invalid sender or recipient account")
+
+        # Validate ownership of the sender account
+        if sender_account.owner.owner_id != user_id:
+            raise TransferError("User does not own the specified sender account", 401)
+
+        # Validate specified currency in sender and recipient accounts
+        currency = data.get("currency")
+
+        currency_info = self.data_engine.find_currency_by_id(currency)
+        if not currency_info:
+            raise TransferError("Invalid or missing currency")
+
+        # The recipient is credited in to_currency when one is given, converted at the current exchange rate
+        to_currency = data.get("to_currency", currency)
+        to_currency_info = currency_info if to_currency == currency else self.data_engine.find_currency_by_id(to_currency)
+        if not to_currency_info:
+            raise TransferError("Invalid target currency")
+
+        # Validate if both accounts can have the chosen currencies
+        if currency not in sender_account.balances or to_currency not in recipient_account.balances:
+            raise TransferError("Invalid currency for sender or recipient account")
+
+        # Validate the amount itself and convert it to the currency's minor units
+        try:
+            amount = parse_amount(data.get("amount"), currency_info.scale)
+        except ValueError:
+            raise TransferError("Invalid amount")
+        if amount <= 0:
+            raise TransferError("Invalid amount")
+
+        # Validate if the user has enough balance in the sender account
+        sender_balance = sender_account.balances[currency]
+        if pending:
+            # Earlier transfers in the same batch that have not been applied yet
+            sender_balance += pending.get((sender_account.account_id, currency), 0)
+        if sender_balance < amount:
+            raise TransferError("Insufficient balance in the sender account")
+
+        conversion = None
+        if to_currency != currency:
+            conversion = self.exchange_rates.convert(currency_info, to_currency_info, amount) if self.exchange_rates else None
+            if conversion is None:
+                raise TransferError("No exchange rate between the chosen currencies")
+            if conversion.to_amount <= 0:
+                raise TransferError("Amount is too small to convert")
+            if conversion.to_amount > MAX_MINOR_UNITS:
+                raise TransferError("Converted amount is too large")
+
+        # Validate that the recipient's balance stays within what can be stored
+        to_amount = conversion.to_amount if conversion else amount
+        recipient_balance = recipient_account.balances[to_currency]
+        if pending:
+            recipient_balance += pending.get((recipient_account.account_id, to_currency), 0)
+        if recipient_account is sender_account and to_currency == currency:
+            recipient_balance -= amount
+        if recipient_balance + to_amount > MAX_MINOR_UNITS:
+            raise TransferError("Recipient balance would exceed the largest amount that can be held")
+
+        return sender_account, recipient_account, currency, amount, conversion
+
+    @staticmethod
+    def add_pending(pending: Dict[Tuple[str, str], int], sender_account: Account, recipient_account: Account, currency: str,
+                    amount: int, conversion: Conversion | None):
+        # Counts a validated transfer that is not applied yet against the balances the next validate sees
+        to_currency, to_amount = (conversion.to_currency_id, conversion.to_amount) if conversion else (currency, amount)
+        pending[(sender_account.account_id, currency)] = pending.get((sender_account.account_id, currency), 0) - amount
+        pending[(recipient_account.account_id, to_currency)] = pending.get((recipient_account.account_id, to_currency), 0) + to_amount
+
+    def transfer(self, user_id: str, data: dict):
+        # Balances are read and written under the locks of just the two accounts involved.
+        # The storage write transaction extends that to other worker processes sharing the database.
+        with self.lock_accounts(str(data.get("from")), str(data.get("to"))), self.data_engine.write_transaction():
+            sender_account, recipient_account, currency, amount, conversion = self.validate(user_id, data)
+            self.data_engine.transfer(sender_account, recipient_account, currency, amount, conversion)
+
+    def transfer_batch(self, user_id: str, transfers: List[dict], atomic: bool = True) -> List[dict]:
+        account_ids = [str(data.get(key)) for data in transfers for key in ("from", "to")]
+        with self.lock_accounts(*account_ids), self.data_engine.write_transaction():
+            pending: Dict[Tuple[str, str], int] = {}
+            accepted = []
+            results = []
+            for index, data in enumerate(transfers):
+                try:
+                    sender_account, recipient_account, currency, amount, conversion = self.validate(user_id, data, pending)
+                except TransferError as e:
+                    results.append({"index": index, "status": "failed", "error": e.message})
+                    continue
+                self.add_pending(pending, sender_account, recipient_account, currency, amount, conversion)
+                accepted.append((sender_account, recipient_account, currency, amount, conversion))
+                results.append({"index": index, "status": "applied"})
+
+            if atomic and len(accepted) != len(transfers):
+                # One invalid transfer rejects the whole batch
+                for result in results:
+                    if result["status"] == "applied":
+                        result["status"] = "not_applied"
+                return results
+
+            if accepted:
+                self.data_engine.transfer_many(accepted)
+            return results
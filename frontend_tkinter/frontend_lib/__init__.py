@@ -1 +1,2 @@
+from .client import ApiClient
 from .frames import *
\ No newline at end of file
@@ -0,0 +1,103 @@
+import logging
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+from .config import *
+
+logger = logging.getLogger(__name__)
+
+def response_json(response) -> dict:
+    # The response body as a dict; error pages from proxies or a crashed server are not JSON and read as empty
+    try:
+        body = response.json()
+    except ValueError:
+        return {}
+    return body if isinstance(body, dict) else {}
+
+
+class ApiClient:
+    def __init__(self, root, base_url: str = BASE_URL, workers: int = CLIENT_WORKERS, timeout: float = REQUEST_TIMEOUT):
+        self.root = root
+        self.base_url = base_url
+        self.timeout = timeout
+        self.token = None
+
+        # One keep-alive connection pool shared by every request instead of a new TCP connection per call.
+        # The extra connection is for the change feed's long-poll, which runs on its own thread.
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers + 1)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="api")
+
+        # Identical GETs already in flight share one request: (path, params, headers) -> callbacks waiting on it
+        self.in_flight = {}
+        self.in_flight_lock = threading.Lock()
+
+        # Finished work is handed to the Tk thread through this queue, drained from an after() loop
+        self.results = queue.SimpleQueue()
+        self.root.after(CLIENT_POLL_MS, self.pump)
+
+    def headers(self) -> dict:
+        return {"Authorization": f"Bearer {self.token}"} if self.token else {}
+
+    def call_soon(self, callback, *args):
+        # Safe from any thread; the callback runs on the Tk thread
+        self.results.put((callback, args))
+
+    def pump(self):
+        try:
+            while True:
+                try:
+                    callback, args = self.results.get_nowait()
+                except queue.Empty:
+                    break
+                try:
+                    callback(*args)
+                except Exception:
+                    # One broken handler must not drop the results queued behind it
+                    logger.exception("API callback %r failed", callback)
+        finally:
+            # Rescheduled whatever happened, or no later result would ever reach the UI
+            self.root.after(CLIENT_POLL_MS, self.pump)
+
+    def get(self, path: str, on_success, on_error=None, params: dict | None = None, headers: dict | None = None):
+        # Requests with different headers (another token, or a conditional one) may get different answers
+        headers = {**self.headers(), **(headers or {})}
+        key = (path, tuple(sorted((params or {}).items())), tuple(sorted(headers.items())))
+        with self.in_flight_lock:
+            waiting = self.in_flight.get(key)
+            if waiting is not None:
+                waiting.append((on_success, on_error))
+                return
+            self.in_flight[key] = [(on_success, on_error)]
+        self.pool.submit(self.send, key, "GET", path, params=params, headers=headers)
+
+    def post(self, path: str, on_success, on_error=None, json: dict | None = None, headers: dict | None = None):
+        # Writes are never coalesced
+        self.pool.submit(self.send, [(on_success, on_error)], "POST", path, json=json, headers={**self.headers(), **(headers or {})})
+
+    def send(self, key, method: str, path: str, headers: dict, **kwargs):
+        try:
+            response = self.session.request(method, f"{self.base_url}{path}", headers=headers, timeout=self.timeout, **kwargs)
+            error = None
+        except requests.RequestException as e:
+            response, error = None, e
+        finally:
+            # Released even if the request raised something else, or every later identical GET would join it forever
+            if isinstance(key, list):
+                callbacks = key
+            else:
+                with self.in_flight_lock:
+                    callbacks = self.in_flight.pop(key)
+        for on_success, on_error in callbacks:
+            if error is None:
+                self.call_soon(on_success, response)
+            elif on_error is not None:
+                self.call_soon(on_error, error)
+
+    def close(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
+        self.session.close()
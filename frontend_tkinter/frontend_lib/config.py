@@ -1 +1,10 @@
-BASE_URL = "http://127.0.0.1:5000"
\ No newline at end of file
+BASE_URL = "http://127.0.0.1:5000"
+
+# Seconds the server may hold an /user/events long-poll open, and the pause before retrying after an error
+EVENTS_WAIT = 25
+EVENTS_RETRY = 5
+
+# Background threads used for API calls, seconds before a call is given up, and how often results are handed to Tk (ms)
+CLIENT_WORKERS = 4
+REQUEST_TIMEOUT = 10
+CLIENT_POLL_MS = 20
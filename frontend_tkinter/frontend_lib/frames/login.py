@@ -1,14 +1,13 @@
 import tkinter as tk
 from tkinter import ttk
-import requests
+from ..client import ApiClient, response_json
 from ..config import *
 from .main import MainFrame
 
 class LoginFrame(ttk.Frame):
-    jwt_token = None  # Class variable to store JWT token
-
-    def __init__(self, container):
+    def __init__(self, container, client: ApiClient):
         super().__init__(container)
+        self.client = client
         self.email_var = tk.StringVar()
         self.password_var = tk.StringVar()
         self.error_var = tk.StringVar()
@@ -29,7 +28,8 @@ class LoginFrame(ttk.Frame):
         ttk.Label(login_frame, text="Password:").grid(row=2, column=1, padx=5, pady=5)
         ttk.Entry(login_frame, textvariable=self.password_var, show="*").grid(row=2, column=2, padx=5, pady=5)
 
-        ttk.Button(login_frame, text="Login", command=self.login).grid(row=3, column=1, columnspan=3, pady=10)
+        self.login_button = ttk.Button(login_frame, text="Login", command=self.login)
+        self.login_button.grid(row=3, column=1, columnspan=3, pady=10)
         ttk.Label(login_frame, textvariable=self.error_var).grid(row=4, column=1, columnspan=3, pady=10)
         login_frame.pack(fill="both", expand=1, anchor=tk.CENTER)
 
@@ -38,16 +38,25 @@ class LoginFrame(ttk.Frame):
         password = self.password_var.get()
         data = {"email": email, "password": password}
 
-        response = requests.post(f"{BASE_URL}/user/login", json=data)
+        # The request runs in the background; the button stays disabled until it answers
+        self.login_button.state(["disabled"])
+        self.error_var.set("Logging in...")
+        self.client.post("/user/login", self.login_done, self.login_failed, json=data)
 
+    def login_done(self, response):
+        self.login_button.state(["!disabled"])
         if response.status_code == 200:
-            LoginFrame.jwt_token = response.json().get("jwt_token")  # Store JWT token in class variable
+            self.client.token = response_json(response).get("jwt_token")
             self.error_var.set("Login successful.")
-            MainFrame.jwt_token = self.jwt_token
-            frame = MainFrame(self.master)
-            frame.update_balances()
-            frame.update_messages()
+            frame = MainFrame(self.master, self.client)
+            frame.start_events()
             self.pack_forget()
             frame.pack(fill="both", expand=1)
+        elif response.status_code == 503:
+            self.error_var.set("Server busy, try again shortly.")
         else:
             self.error_var.set("Invalid credentials.")
+
+    def login_failed(self, error):
+        self.login_button.state(["!disabled"])
+        self.error_var.set("Server unreachable.")
@@ -1,15 +1,22 @@
+import threading
+import time
 import tkinter as tk
 from tkinter import ttk
 import requests
+from ..client import ApiClient, response_json
 from ..config import *
 
 class MainFrame(ttk.Frame):
-    jwt_token = None  # Class variable to store JWT token
-
-    def __init__(self, container):
+    def __init__(self, container, client: ApiClient):
         super().__init__(container)
+        self.client = client
         self.amount_var = tk.StringVar()
         self.to_var = tk.StringVar()
+        self.status_var = tk.StringVar()
+        self.balances_etag = None
+        self.balance_rows = {}  # (account_id, currency_id) -> row in the balances listbox
+        self.balance_keys = []  # row in the balances listbox -> (account_id, currency_id)
+        self.events_running = False
         self.create_widgets()
 
     def create_widgets(self):
@@ -24,12 +31,13 @@ class MainFrame(ttk.Frame):
         ttk.Entry(transaction_frame, textvariable=self.amount_var).grid(row=1, column=1, padx=5, pady=5)
 
         ttk.Button(transaction_frame, text="Make Transaction", command=self.make_transaction).grid(row=2, column=0, columnspan=2, pady=10)
+        ttk.Label(transaction_frame, textvariable=self.status_var).grid(row=3, column=0, columnspan=2, pady=5)
 
-        # Balances Frame
+        # Balances Frame; the selected balance is the account and currency a transaction is sent from
         balances_frame = ttk.LabelFrame(self, text="Balances")
         balances_frame.grid(row=0, column=1, rowspan=2, padx=10, pady=10, sticky="nsew")
 
-        self.balances_listbox = tk.Listbox(balances_frame, width=30, height=5)
+        self.balances_listbox = tk.Listbox(balances_frame, width=30, height=5, exportselection=False)
         self.balances_listbox.grid(row=0, column=0, padx=5, pady=5)
 
         # Messages Frame
@@ -40,55 +48,115 @@ class MainFrame(ttk.Frame):
         self.messages_listbox.grid(row=0, column=0, padx=5, pady=5)
 
     def make_transaction(self):
-        if not MainFrame.jwt_token:
-            self.update_messages("User not logged in.")
+        selection = self.balances_listbox.curselection()
+        if not selection:
+            self.status_var.set("Select a balance to send from.")
             return
 
+        from_account, currency_id = self.balance_keys[selection[0]]
         to_account = self.to_var.get()
-        amount = float(self.amount_var.get())
-        currency_id = tk.simpledialog.askstring("Currency", "Enter Currency ID:")
-        data = {"to": to_account, "amount": amount, "currency_id": currency_id}
+        amount = self.amount_var.get().strip()  # Sent as a decimal string so no precision is lost
+        data = {"from": from_account, "to": to_account, "amount": amount, "currency": currency_id}
 
-        headers = {"Authorization": f"Bearer {MainFrame.jwt_token}"}
-        response = requests.post(f"{BASE_URL}/user/transaction", json=data, headers=headers)
+        self.status_var.set("Sending...")
+        self.client.post("/user/transaction", self.transaction_done, self.request_failed, json=data)
 
+    def transaction_done(self, response):
         if response.status_code == 200:
+            self.status_var.set("Transaction successful.")
             self.update_balances()
-            self.update_messages("Transaction successful.")
         else:
-            self.update_messages("Transaction failed.")
+            self.status_var.set(f"Transaction failed: {response_json(response).get('error', response.status_code)}")
+
+    def request_failed(self, error):
+        self.status_var.set(f"Server unreachable: {error.__class__.__name__}")
 
     def update_balances(self):
-        if not MainFrame.jwt_token:
-            self.update_messages("User not logged in.")
-            return
+        headers = {"If-None-Match": self.balances_etag} if self.balances_etag else None
+        self.client.get("/user/balance", self.show_balances, self.request_failed, headers=headers)
 
-        headers = {"Authorization": f"Bearer {MainFrame.jwt_token}"}
-        response = requests.get(f"{BASE_URL}/user/balance", headers=headers)
+    def show_balances(self, response):
+        if response.status_code == 304:
+            return  # Balances have not changed since the last fetch
 
         if response.status_code == 200:
-            balances = response.json().get("balances", [])
+            self.balances_etag = response.headers.get("ETag")
+            balances = response_json(response).get("balances", [])
             self.balances_listbox.delete(0, tk.END)
+            self.balance_rows = {}
+            self.balance_keys = []
 
             for balance in balances:
+                key = (balance["account_id"], balance["currency_id"])
+                self.balance_rows[key] = len(self.balance_keys)
+                self.balance_keys.append(key)
                 self.balances_listbox.insert(tk.END, f"{balance['currency_id']}: {balance['balance']}")
 
-    def update_messages(self, message):
-        self.messages_listbox.insert(tk.END, message)
-
     def update_messages(self):
-        if not MainFrame.jwt_token:
-            self.messages_listbox.insert(tk.END, "User not logged in.")
-            return
-
-        headers = {"Authorization": f"Bearer {MainFrame.jwt_token}"}
-        response = requests.get(f"{BASE_URL}/user/messages", headers=headers)
+        self.client.get("/user/messages", self.show_messages, self.request_failed)
 
+    def show_messages(self, response):
         if response.status_code == 200:
-            messages = response.json().get("messages", [])
+            messages = response_json(response).get("messages", [])
             self.messages_listbox.delete(0, tk.END)
 
             for message in messages:
                 self.messages_listbox.insert(tk.END, f"{message['owner']['owner_id']}: {message['data']}")
         else:
-            self.messages_listbox.insert(tk.END, "Failed to retrieve messages.")
+            self.status_var.set("Failed to retrieve messages.")
+
+    def start_events(self):
+        # Balances and messages are kept current from the server's change feed instead of being polled
+        self.events_running = True
+        threading.Thread(target=self.poll_events, daemon=True).start()
+
+    def destroy(self):
+        self.events_running = False
+        super().destroy()
+
+    def poll_events(self):
+        last_event_id = None
+
+        while self.events_running:
+            params = {"timeout": EVENTS_WAIT}
+            if last_event_id is not None:
+                params["after"] = last_event_id
+            try:
+                # Uses the client's connection pool but stays on its own thread, as it is blocked most of the time
+                response = self.client.session.get(f"{self.client.base_url}/user/events", params=params,
+                                                   headers=self.client.headers(), timeout=EVENTS_WAIT + REQUEST_TIMEOUT)
+            except requests.RequestException:
+                time.sleep(EVENTS_RETRY)
+                continue
+
+            if response.status_code == 401:
+                break
+            body = response_json(response)
+            if response.status_code != 200 or "last_event_id" not in body:
+                time.sleep(EVENTS_RETRY)
+                continue
+
+            # Tk widgets may only be touched from the UI thread, so everything is handed over through the client
+            if last_event_id is None or body.get("reset"):
+                # Subscribed (or fell too far behind): reload both lists at once, deltas take over from here
+                self.client.call_soon(self.update_balances)
+                self.client.call_soon(self.update_messages)
+            else:
+                for event in body.get("events", []):
+                    self.client.call_soon(self.apply_event, event)
+            last_event_id = body["last_event_id"]
+
+    def apply_event(self, event):
+        if event["type"] == "balance":
+            row = self.balance_rows.get((event["account_id"], event["currency_id"]))
+            if row is None:
+                self.update_balances()  # A balance we have not seen yet, e.g. a new account
+                return
+            selected = self.balances_listbox.curselection()
+            self.balances_listbox.delete(row)
+            self.balances_listbox.insert(row, f"{event['currency_id']}: {event['balance']}")
+            if row in selected:
+                self.balances_listbox.selection_set(row)
+        elif event["type"] == "message":
+            # The messages list is newest first
+            self.messages_listbox.insert(0, f"{event['owner']['owner_id']}: {event['data']}")
@@ -8,5 +8,5 @@ class SimpleBankApp(tk.Tk):
 
 if __name__ == "__main__":
     app = SimpleBankApp()
-    frames.LoginFrame(app).pack(fill="both", expand=1)
+    frames.LoginFrame(app, ApiClient(app)).pack(fill="both", expand=1)
     app.mainloop()
@@ -0,0 +1,221 @@
+import json
+import os
+import random
+import sys
+import threading
+import uuid
+from datetime import datetime, timedelta
+import pytest
+
+# The backend runs from its own directory and imports its modules flat
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "backend"))
+
+from storage import SqliteDataEngine, create_data_engine
+from transfers import TransferEngine, TransferError
+
+# Every generated account starts with this much of each currency it holds (minor units)
+START_BALANCE = 100000000
+
+# The helpers below are handed to tests as session fixtures of the same name
+
+def generate_data(users: int, banks: int, accounts_per_user: int, transactions_per_account: int,
+                  currencies_per_account: int = 1, seed: int = 0) -> dict:
+    # A data file in the current format: one currency per bank, users with accounts spread over the banks, and
+    # histories whose rows are a minute apart. Passwords are the legacy plaintext "password<n>".
+    rng = random.Random(seed)
+    new_id = lambda: str(uuid.UUID(int=rng.getrandbits(128), version=4))
+    created_at = "2023-12-09 13:46:59.591897"
+    start = datetime(2023, 12, 9, 13, 46, 59)
+
+    currency_list = []
+    bank_list = []
+    for b in range(banks):
+        bank_id = new_id()
+        currency_list.append({"currency_id": new_id(), "name": f"Currency {b}", "code": f"C{b:02d}", "symbol": "§",
+                              "bank_id": bank_id, "created_at": created_at, "scale": 2})
+        bank_list.append({"bank_id": bank_id, "name": f"Bank {b}", "bank_type": "country", "created_at": created_at,
+                          "account_types": [{"type_id": new_id(), "name": "Personal", "description": "For personal uses"}],
+                          "admin_authentication": [], "accounts": []})
+
+    user_list = []
+    for u in range(users):
+        user_id = new_id()
+        user_list.append({"user_id": user_id, "name": f"user{u}", "email": f"user{u}@example.com",
+                          "password": f"password{u}", "created_at": created_at})
+        for _ in range(accounts_per_user):
+            b = rng.randrange(banks)
+            # The bank's own currency first, then others drawn from the remaining banks
+            held = [b] + rng.sample([other for other in range(banks) if other != b], currencies_per_account - 1)
+            bank_list[b]["accounts"].append({
+                "account_id": new_id(),
+                "bank_id": bank_list[b]["bank_id"],
+                "type_id": bank_list[b]["account_types"][0]["type_id"],
+                "owner": {"type": "user", "owner_id": user_id},
+                "created_at": created_at,
+                "balance": [{"currency_id": currency_list[c]["currency_id"], "balance": START_BALANCE} for c in held],
+                "messages": [],
+                "transactions": [],
+                "authentication": []
+            })
+
+    accounts = [account for bank in bank_list for account in bank["accounts"]]
+    for account in accounts:
+        for t in range(transactions_per_account):
+            currency_id = rng.choice(account["balance"])["currency_id"]
+            account["transactions"].append({
+                "from": account["account_id"],
+                "to": rng.choice(accounts)["account_id"],
+                "when": (start + timedelta(minutes=t)).strftime("%Y-%m-%d %H:%M:%S.%f"),
+                "currency": {"currency_id": currency_id, "previous_balance": START_BALANCE, "new_balance": START_BALANCE}
+            })
+
+    return {"money_format": "minor_units", "currencies": currency_list, "users": user_list, "banks": bank_list}
+
+def accounts_of(data: dict) -> list:
+    return [account for bank in data["banks"] for account in bank["accounts"]]
+
+def open_engine(engine_type: str, data: dict, directory: str, **options):
+    # A loaded engine of the given type holding data, with its files in directory
+    if engine_type == "sqlite":
+        # Single process, so there are no other workers' commits to poll for
+        engine = SqliteDataEngine(database_path=os.path.join(directory, "bank.db"), sync_interval=0)
+        engine.load_data()
+        engine.import_json(data)
+        return engine
+    file_path = os.path.join(directory, "data.json")
+    with open(file_path, "w") as file:
+        json.dump(data, file)
+    engine = create_data_engine(engine_type, file_path, **options)
+    engine.load_data()
+    return engine
+
+def money_supply(engine, data: dict) -> dict:
+    # currency_id -> sum of every account's balance
+    totals = {}
+    for account in accounts_of(data):
+        for currency_id, balance in engine.find_account_by_id(account["account_id"]).balances.items():
+            totals[currency_id] = totals.get(currency_id, 0) + balance
+    return totals
+
+def run_transfers(transfer_engine: TransferEngine, data: dict, threads: int, transfers: int) -> int:
+    # Random same-currency transfers between accounts holding the currency, split over the threads;
+    # returns how many were applied
+    by_currency = {}
+    for account in accounts_of(data):
+        for balance in account["balance"]:
+            by_currency.setdefault(balance["currency_id"], []).append(account)
+    groups = sorted(by_currency.items())
+    applied = []
+
+    def worker(seed):
+        rng = random.Random(seed)
+        count = 0
+        for _ in range(transfers // threads):
+            currency_id, group = rng.choice(groups)
+            sender, recipient = rng.choice(group), rng.choice(group)
+            try:
+                transfer_engine.transfer(sender["owner"]["owner_id"], {"from": sender["account_id"], "to": recipient["account_id"],
+                                                                     "currency": currency_id, "amount": rng.randint(1, 100)})
+                count += 1
+            except TransferError:
+                pass
+        applied.append(count)
+
+    workers = [threading.Thread(target=worker, args=(seed,)) for seed in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return sum(applied)
+
+def release(engine):
+    # Lets another engine open the same files, as after the process holding them died
+    if getattr(engine, "journal_file", None) is not None:
+        engine.journal_file.close()
+    if getattr(engine, "lock_file", None) is not None:
+        engine.lock_file.close()
+
+def reopen(engine):
+    # The engine a restart would load from the same files
+    release(engine)
+    if isinstance(engine, SqliteDataEngine):
+        reopened = SqliteDataEngine(database_path=engine.database_path, sync_interval=0)
+    else:
+        reopened = type(engine)(file_path=engine.file_path)
+    reopened.load_data()
+    return reopened
+
+
+@pytest.fixture
+def data() -> dict:
+    # Two currencies per account, so transfers and filters see more than one currency in each history
+    return generate_data(users=12, banks=3, accounts_per_user=2, transactions_per_account=20, currencies_per_account=2)
+
+@pytest.fixture
+def switch_interval():
+    # Threads switch far more often than usual, so races between them show up in a short run
+    previous = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    yield
+    sys.setswitchinterval(previous)
+
+@pytest.fixture(scope="session", name="generate_data")
+def generate_data_fixture():
+    return generate_data
+
+@pytest.fixture(scope="session", name="accounts_of")
+def accounts_of_fixture():
+    return accounts_of
+
+@pytest.fixture(scope="session", name="open_engine")
+def open_engine_fixture():
+    return open_engine
+
+@pytest.fixture(scope="session", name="money_supply")
+def money_supply_fixture():
+    return money_supply
+
+@pytest.fixture(scope="session", name="run_transfers")
+def run_transfers_fixture():
+    return run_transfers
+
+@pytest.fixture(scope="session", name="release")
+def release_fixture():
+    return release
+
+@pytest.fixture(scope="session", name="reopen")
+def reopen_fixture():
+    return reopen
+
+@pytest.fixture(scope="session")
+def app_data() -> dict:
+    # What the app under test starts from; user0 administers bank 0
+    data = generate_data(users=8, banks=2, accounts_per_user=2, transactions_per_account=5, currencies_per_account=2, seed=1)
+    data["banks"][0]["admin_authentication"].append({"user_id": data["users"][0]["user_id"], "permissions": ["*"]})
+    return data
+
+@pytest.fixture(scope="session")
+def app_module(tmp_path_factory, app_data):
+    # app.py reads its settings from the environment and loads its data file on import, so it is imported once per run
+    file_path = tmp_path_factory.mktemp("app") / "data.json"
+    file_path.write_text(json.dumps(app_data))
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setenv("BANK_DATA_FILE", str(file_path))
+        monkeypatch.setenv("BANK_SCHEDULER", "0")
+        monkeypatch.setenv("BANK_PASSWORD_HASH_COST", "16")
+        import app
+    return app
+
+@pytest.fixture
+def client(app_module):
+    return app_module.app.test_client()
+
+@pytest.fixture
+def login(client, app_data):
+    # Headers authenticating as the nth generated user
+    def login(user: int) -> dict:
+        response = client.post("/user/login", json={"email": f"user{user}@example.com", "password": f"password{user}"})
+        assert response.status_code == 200
+        return {"Authorization": f"Bearer {response.json['jwt_token']}"}
+    return login
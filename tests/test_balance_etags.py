@@ -0,0 +1,78 @@
+import pytest
+from summaries import BalanceSummaries
+
+@pytest.fixture
+def engine(tmp_path, data, open_engine):
+    return open_engine("json", data, str(tmp_path))
+
+def owned_account(engine, data, user: int):
+    return engine.find_user_accounts(data["users"][user]["user_id"])[0]
+
+def test_summaries_are_cached_until_a_balance_changes(engine, data):
+    summaries = BalanceSummaries(engine)
+    user_id = data["users"][0]["user_id"]
+    body, etag = summaries.get(user_id)
+    assert summaries.get(user_id) == (body, etag)
+
+    account = owned_account(engine, data, 0)
+    currency_id = next(iter(account.balances))
+    engine.set_balance(account, currency_id, account.balances[currency_id])
+    assert summaries.get(user_id) == (body, etag)
+
+    engine.set_balance(account, currency_id, account.balances[currency_id] - 100)
+    new_body, new_etag = summaries.get(user_id)
+    assert new_etag != etag and new_body != body
+
+def test_transfers_refresh_both_owners(engine, data):
+    summaries = BalanceSummaries(engine)
+    sender, recipient = owned_account(engine, data, 0), owned_account(engine, data, 1)
+    currency_id = next(iter(sender.balances))
+    engine.set_balance(recipient, currency_id, recipient.balances.get(currency_id, 0))
+    before = [summaries.get(account.owner.owner_id)[1] for account in (sender, recipient)]
+    engine.transfer(sender, recipient, currency_id, 5)
+    after = [summaries.get(account.owner.owner_id)[1] for account in (sender, recipient)]
+    assert all(old != new for old, new in zip(before, after))
+
+def test_rebuilt_summaries_never_reuse_an_etag(engine, data):
+    summaries = BalanceSummaries(engine)
+    user_id = data["users"][0]["user_id"]
+    _, etag = summaries.get(user_id)
+    summaries.on_commit([{"op": "reload"}])
+    assert summaries.get(user_id)[1] != etag
+    # A restart starts a new epoch
+    assert BalanceSummaries(engine).get(user_id)[1] != etag
+
+def test_users_without_accounts_have_no_summary(engine):
+    assert BalanceSummaries(engine).get("nobody") is None
+
+def test_balance_polls_get_304_until_the_balance_changes(client, login, app_module):
+    headers = login(2)
+    response = client.get("/user/balance", headers=headers)
+    assert response.status_code == 200
+    etag = response.headers["ETag"]
+    assert response.headers["Cache-Control"] == "private, no-cache"
+
+    unchanged = client.get("/user/balance", headers={**headers, "If-None-Match": etag})
+    assert unchanged.status_code == 304
+    assert unchanged.data == b""
+    assert unchanged.headers["ETag"] == etag
+
+    user_id = app_module.data_engine.find_user("user2@example.com").user_id
+    account = app_module.data_engine.find_user_accounts(user_id)[0]
+    currency_id = next(iter(account.balances))
+    app_module.data_engine.set_balance(account, currency_id, account.balances[currency_id] + 1)
+    changed = client.get("/user/balance", headers={**headers, "If-None-Match": etag})
+    assert changed.status_code == 200
+    assert changed.headers["ETag"] != etag
+    assert changed.json == client.get("/user/balance", headers=headers).json
+
+@pytest.mark.parametrize("path", ["/info/banks", "/info/currencies", "/info/exchange_rates"])
+def test_reference_data_answers_conditional_requests(client, path):
+    response = client.get(path)
+    assert response.status_code == 200
+    etag = response.headers["ETag"]
+    assert response.headers["Cache-Control"].startswith("public, max-age=")
+    unchanged = client.get(path, headers={"If-None-Match": etag})
+    assert unchanged.status_code == 304
+    assert unchanged.data == b""
+    assert client.get(path, headers={"If-None-Match": '"stale"'}).status_code == 200
@@ -0,0 +1,72 @@
+import pytest
+
+@pytest.fixture
+def accounts(app_data):
+    # User 1's first account, a currency it holds, and another user's account holding the same currency
+    sender = next(a for bank in app_data["banks"] for a in bank["accounts"] if a["owner"]["owner_id"] == app_data["users"][1]["user_id"])
+    currency_id = sender["balance"][0]["currency_id"]
+    recipient = next(a for bank in app_data["banks"] for a in bank["accounts"]
+                     if a["owner"]["owner_id"] != sender["owner"]["owner_id"] and currency_id in {b["currency_id"] for b in a["balance"]})
+    return sender["account_id"], recipient["account_id"], currency_id
+
+def balances(app_module, *account_ids) -> list:
+    return [app_module.data_engine.find_account_by_id(account_id).balances.copy() for account_id in account_ids]
+
+def test_atomic_batch_applies_nothing_when_one_transfer_fails(client, login, app_module, accounts):
+    sender, recipient, currency_id = accounts
+    before = balances(app_module, sender, recipient)
+    response = client.post("/user/transactions/batch", headers=login(1), json={"transfers": [
+        {"from": sender, "to": recipient, "currency": currency_id, "amount": "1.00"},
+        {"from": sender, "to": recipient, "currency": currency_id, "amount": "1e12"},
+    ]})
+    assert response.status_code == 400
+    assert response.json["applied"] == 0
+    assert [result["status"] for result in response.json["results"]] == ["not_applied", "failed"]
+    assert balances(app_module, sender, recipient) == before
+
+def test_best_effort_batch_applies_every_valid_transfer(client, login, app_module, accounts):
+    sender, recipient, currency_id = accounts
+    [sender_before, recipient_before] = balances(app_module, sender, recipient)
+    response = client.post("/user/transactions/batch", headers=login(1), json={"mode": "best_effort", "transfers": [
+        {"from": sender, "to": recipient, "currency": currency_id, "amount": "1.50"},
+        {"from": sender, "to": "missing", "currency": currency_id, "amount": "1.00"},
+        {"from": sender, "to": recipient, "currency": currency_id, "amount": "0.25"},
+    ]})
+    assert response.status_code == 200
+    assert response.json["applied"] == 2
+    assert [result["status"] for result in response.json["results"]] == ["applied", "failed", "applied"]
+    [sender_after, recipient_after] = balances(app_module, sender, recipient)
+    assert sender_after[currency_id] == sender_before[currency_id] - 175
+    assert recipient_after[currency_id] == recipient_before[currency_id] + 175
+
+def test_batch_transfers_see_each_other(client, login, app_module, accounts):
+    # Together they overdraw the sender, so the second is refused even though each alone is affordable
+    sender, recipient, currency_id = accounts
+    [before] = balances(app_module, sender)
+    three_quarters = f"{before[currency_id] * 3 // 4 / 100:.2f}"
+    response = client.post("/user/transactions/batch", headers=login(1), json={"mode": "best_effort", "transfers": [
+        {"from": sender, "to": recipient, "currency": currency_id, "amount": three_quarters},
+        {"from": sender, "to": recipient, "currency": currency_id, "amount": three_quarters},
+    ]})
+    assert [result["status"] for result in response.json["results"]] == ["applied", "failed"]
+    assert balances(app_module, sender)[0][currency_id] >= 0
+
+@pytest.mark.parametrize("body", [[1, 2], "transfers", 7, None, {"transfers": []}, {"transfers": {"from": "x"}}, {"transfers": [1]}])
+def test_malformed_batches_are_rejected(client, login, body):
+    response = client.post("/user/transactions/batch", headers=login(1), json=body)
+    assert response.status_code == 400
+    assert "error" in response.json
+
+def test_batch_mode_is_checked(client, login, accounts):
+    sender, recipient, currency_id = accounts
+    response = client.post("/user/transactions/batch", headers=login(1), json={"mode": "some", "transfers": [
+        {"from": sender, "to": recipient, "currency": currency_id, "amount": "1"}]})
+    assert response.status_code == 400
+
+@pytest.mark.parametrize("body", [[1], "x"])
+def test_single_transfer_rejects_a_body_that_is_not_an_object(client, login, body):
+    response = client.post("/user/transaction", headers=login(1), json=body)
+    assert response.status_code == 400
+
+def test_batch_needs_a_login(client):
+    assert client.post("/user/transactions/batch", json={"transfers": []}).status_code == 401
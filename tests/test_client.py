@@ -0,0 +1,126 @@
+import logging
+import os
+import sys
+import threading
+import pytest
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "frontend_tkinter"))
+
+from frontend_lib.client import ApiClient, response_json
+
+class FakeRoot:
+    # Stands in for Tk: records after() calls instead of running an event loop
+    def __init__(self):
+        self.scheduled = []
+
+    def after(self, ms, callback):
+        self.scheduled.append(callback)
+
+
+class FakeResponse:
+    def __init__(self, status_code=200, body=None, text=""):
+        self.status_code = status_code
+        self.body = body
+        self.text = text
+
+    def json(self):
+        if self.body is None:
+            raise requests.exceptions.JSONDecodeError("Expecting value", self.text, 0)
+        return self.body
+
+
+class FakeSession:
+    # Answers every request once release is set, counting the requests it was sent
+    def __init__(self):
+        self.release = threading.Event()
+        self.requests = []
+        self.lock = threading.Lock()
+
+    def request(self, method, url, headers=None, timeout=None, **kwargs):
+        with self.lock:
+            self.requests.append((method, url, headers))
+        self.release.wait(5)
+        return FakeResponse(body={"url": url})
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def client():
+    client = ApiClient(FakeRoot(), base_url="http://bank", workers=4)
+    client.session = FakeSession()
+    yield client
+    client.session.release.set()
+    client.pool.shutdown(wait=True)
+
+def drain(client, count: int) -> list:
+    # Runs the Tk side until count callbacks have been handed over
+    results = []
+    for _ in range(count):
+        callback, args = client.results.get(timeout=5)
+        results.append((callback, args))
+    return results
+
+def test_pump_keeps_going_after_a_callback_fails(client, caplog):
+    calls = []
+    def broken():
+        raise RuntimeError("handler bug")
+    client.call_soon(calls.append, 1)
+    client.call_soon(broken)
+    client.call_soon(calls.append, 2)
+    with caplog.at_level(logging.ERROR, logger="frontend_lib.client"):
+        client.pump()
+    assert calls == [1, 2]
+    assert "handler bug" in caplog.text
+    assert client.root.scheduled[-1] == client.pump
+
+def test_pump_reschedules_even_when_interrupted(client):
+    def interrupt():
+        raise KeyboardInterrupt
+    client.call_soon(interrupt)
+    scheduled = len(client.root.scheduled)
+    with pytest.raises(KeyboardInterrupt):
+        client.pump()
+    assert len(client.root.scheduled) == scheduled + 1
+
+def test_identical_gets_share_one_request(client):
+    answers = []
+    for _ in range(3):
+        client.get("/user/balance", answers.append)
+    client.session.release.set()
+    for callback, args in drain(client, 3):
+        callback(*args)
+    assert len(client.session.requests) == 1
+    assert [answer.json() for answer in answers] == [{"url": "http://bank/user/balance"}] * 3
+    assert client.in_flight == {}
+
+def test_gets_with_different_headers_are_not_shared(client):
+    client.get("/user/balance", print)
+    client.get("/user/balance", print, headers={"If-None-Match": '"v1"'})
+    client.token = "other-user"
+    client.get("/user/balance", print)
+    client.session.release.set()
+    drain(client, 3)
+    sent = sorted(str(headers) for _, _, headers in client.session.requests)
+    assert sent == sorted(["{}", "{'If-None-Match': '\"v1\"'}", "{'Authorization': 'Bearer other-user'}"])
+
+def test_failed_requests_release_their_key(client):
+    def unreachable(*args, **kwargs):
+        raise requests.ConnectionError("down")
+    client.session.request = unreachable
+    errors = []
+    client.get("/info/banks", print, errors.append)
+    callback, args = drain(client, 1)[0]
+    callback(*args)
+    assert isinstance(errors[0], requests.ConnectionError)
+    assert client.in_flight == {}
+
+@pytest.mark.parametrize("response, expected", [
+    (FakeResponse(body={"error": "nope"}), {"error": "nope"}),
+    (FakeResponse(body=["not", "an", "object"]), {}),
+    (FakeResponse(502, text="<html>Bad Gateway</html>"), {}),
+])
+def test_response_json_reads_non_json_bodies_as_empty(response, expected):
+    assert response_json(response) == expected
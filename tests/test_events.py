@@ -0,0 +1,130 @@
+import threading
+import time
+import pytest
+from events import ChangeFeed
+
+@pytest.fixture
+def engine(tmp_path, data, open_engine):
+    return open_engine("json", data, str(tmp_path))
+
+def owned_account(engine, data, user: int):
+    return engine.find_user_accounts(data["users"][user]["user_id"])[0]
+
+def bump(engine, account, amount: int = 1):
+    currency_id = next(iter(account.balances))
+    engine.set_balance(account, currency_id, account.balances[currency_id] + amount)
+
+def test_subscribers_see_both_sides_of_a_transfer(engine, data):
+    feed = ChangeFeed(engine)
+    sender, recipient = owned_account(engine, data, 0), owned_account(engine, data, 1)
+    currency_id = next(iter(sender.balances))
+    engine.set_balance(recipient, currency_id, recipient.balances.get(currency_id, 0))
+    positions = {account.owner.owner_id: feed.subscribe(account.owner.owner_id) for account in (sender, recipient)}
+    engine.transfer(sender, recipient, currency_id, 250)
+
+    for account, amount in ((sender, "2.50"), (recipient, "2.50")):
+        events, last_event_id, reset = feed.wait(account.owner.owner_id, positions[account.owner.owner_id], timeout=0)
+        assert not reset
+        assert [event["type"] for event in events] == ["transaction", "balance"]
+        assert events[0]["amount"] == amount and events[0]["account_id"] == account.account_id
+        assert last_event_id == events[-1]["id"]
+        # Resuming from the last id returns nothing new
+        assert feed.wait(account.owner.owner_id, last_event_id, timeout=0)[0::2] == ([], False)
+
+def test_only_subscribers_get_buffers(engine, data):
+    feed = ChangeFeed(engine)
+    bump(engine, owned_account(engine, data, 0))
+    assert feed.buffers == {}
+    feed.subscribe(data["users"][1]["user_id"])
+    bump(engine, owned_account(engine, data, 0))
+    assert list(feed.buffers) == [data["users"][1]["user_id"]]
+    assert not feed.buffers[data["users"][1]["user_id"]]
+
+def test_waiting_returns_as_soon_as_an_event_arrives(engine, data):
+    feed = ChangeFeed(engine)
+    user_id = data["users"][0]["user_id"]
+    position = feed.subscribe(user_id)
+    timer = threading.Timer(0.05, bump, args=(engine, owned_account(engine, data, 0)))
+    timer.start()
+    started = time.monotonic()
+    events, _, _ = feed.wait(user_id, position, timeout=10)
+    timer.join()
+    assert [event["type"] for event in events] == ["balance"]
+    assert time.monotonic() - started < 5
+
+@pytest.mark.parametrize("position", ["other-1", "garbage", "{epoch}-999"])
+def test_positions_from_another_feed_or_the_future_reset(engine, data, position):
+    feed = ChangeFeed(engine)
+    user_id = data["users"][0]["user_id"]
+    feed.subscribe(user_id)
+    events, last_event_id, reset = feed.wait(user_id, position.format(epoch=feed.epoch), timeout=0)
+    assert (events, reset) == ([], True)
+    assert feed.wait(user_id, last_event_id, timeout=0) == ([], last_event_id, False)
+
+def test_clients_that_fell_behind_the_buffer_reset(engine, data):
+    feed = ChangeFeed(engine, buffer_size=2)
+    user_id = data["users"][0]["user_id"]
+    position = feed.subscribe(user_id)
+    account = owned_account(engine, data, 0)
+    for _ in range(3):
+        bump(engine, account)
+    assert feed.wait(user_id, position, timeout=0)[2]
+
+def test_a_reload_resets_every_subscriber(engine, data):
+    feed = ChangeFeed(engine)
+    user_id = data["users"][0]["user_id"]
+    position = feed.subscribe(user_id)
+    feed.on_commit([{"op": "reload"}])
+    assert feed.wait(user_id, position, timeout=0)[2]
+
+def test_idle_buffers_are_swept(engine, data):
+    feed = ChangeFeed(engine)
+    idle, active = data["users"][0]["user_id"], data["users"][1]["user_id"]
+    position = feed.subscribe(idle)
+    feed.subscribe(active)
+    # The idle user last polled long ago, and the sweep is due
+    feed.last_seen[idle] -= feed.idle_ttl + 1
+    feed.next_sweep = 0
+    bump(engine, owned_account(engine, data, 1))
+    assert list(feed.buffers) == [active]
+    assert idle not in feed.last_seen and idle not in feed.dropped
+    # Coming back after the sweep, the client has missed events and has to reload
+    assert feed.wait(idle, position, timeout=0)[2]
+
+def test_users_with_a_request_waiting_are_not_swept(engine, data):
+    feed = ChangeFeed(engine)
+    user_id = data["users"][0]["user_id"]
+    position = feed.subscribe(user_id)
+    waiter = threading.Thread(target=feed.wait, args=(user_id, position, 10))
+    waiter.start()
+    while user_id not in feed.waiting:
+        time.sleep(0.001)
+    with feed.condition:
+        feed.last_seen[user_id] -= feed.idle_ttl + 1
+        feed.next_sweep = 0
+        feed.sweep()
+    assert user_id in feed.buffers
+    bump(engine, owned_account(engine, data, 0))
+    waiter.join()
+    assert user_id not in feed.waiting
+
+def test_polling_the_events_endpoint(client, login, app_module):
+    headers = login(3)
+    start = client.get("/user/events", headers=headers)
+    assert start.status_code == 200
+    assert start.json["events"] == [] and not start.json["reset"]
+
+    user_id = app_module.data_engine.find_user("user3@example.com").user_id
+    bump(app_module.data_engine, app_module.data_engine.find_user_accounts(user_id)[0])
+    response = client.get("/user/events", headers=headers, query_string={"after": start.json["last_event_id"], "timeout": 0})
+    assert [event["type"] for event in response.json["events"]] == ["balance"]
+    assert response.json["last_event_id"] == response.json["events"][-1]["id"]
+
+    # Last-Event-ID is honoured like the after parameter
+    again = client.get("/user/events", headers={**headers, "Last-Event-ID": response.json["last_event_id"]}, query_string={"timeout": 0})
+    assert again.json == {"events": [], "last_event_id": response.json["last_event_id"], "reset": False}
+
+@pytest.mark.parametrize("timeout", ["nan", "-1", "soon"])
+def test_events_endpoint_refuses_bad_timeouts(client, login, timeout):
+    response = client.get("/user/events", headers=login(3), query_string={"after": "x-1", "timeout": timeout})
+    assert response.status_code == 400
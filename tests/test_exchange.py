@@ -0,0 +1,141 @@
+from fractions import Fraction
+import pytest
+from exchange import ExchangeRates
+from models import ExchangeRate
+from money import MAX_MINOR_UNITS, parse_rate
+from transfers import TransferEngine, TransferError
+
+@pytest.mark.parametrize("value, expected", [("1.5", "1.5"), (2, "2"), (0.25, "0.25"), ("1e9", "1E+9"), ("0.000000001", "1E-9")])
+def test_rates_are_read_exactly(value, expected):
+    assert parse_rate(value) == expected
+    assert Fraction(parse_rate(value)) == Fraction(str(value))
+
+@pytest.mark.parametrize("value", ["1e30", "1000000001", "1e-10", "0", "-1", "nan", "inf", "abc", True, None, [1],
+                                   "1.0000000000000000001"])
+def test_rates_out_of_range_or_malformed_are_refused(value):
+    with pytest.raises(ValueError):
+        parse_rate(value)
+
+@pytest.fixture(params=["json", "sqlite"])
+def engine(request, tmp_path, data, open_engine):
+    return open_engine(request.param, data, str(tmp_path))
+
+@pytest.fixture
+def currencies(engine):
+    return sorted(engine.find_currencies(), key=lambda currency: currency.code)
+
+def publish(engine, from_currency, to_currency, rate: str):
+    engine.set_exchange_rate(ExchangeRate(from_currency.bank_id, from_currency.currency_id, to_currency.currency_id, rate,
+                                          "2024-01-01 00:00:00.000000"))
+
+def test_conversions_use_direct_inverse_and_multi_hop_rates(engine, currencies):
+    a, b, c = currencies
+    rates = ExchangeRates(engine)
+    publish(engine, a, b, "2")
+    publish(engine, b, c, "0.3")
+    assert rates.convert(a, b, 150).to_amount == 300
+    # Inverted for the way back, rounding down
+    assert rates.convert(b, a, 301).to_amount == 150
+    via = rates.convert(a, c, 1000)
+    assert (via.to_amount, via.via, Fraction(via.rate)) == (600, [b.currency_id], Fraction(3, 5))
+    # A rate change rebuilds the table
+    publish(engine, a, c, "1")
+    assert rates.convert(a, c, 1000).to_amount == 1000
+
+def accounts_holding(engine, data, currency_id: str, to_currency_id: str):
+    # A sender holding currency_id and another user's account holding to_currency_id
+    accounts = [engine.find_account_by_id(account["account_id"]) for bank in data["banks"] for account in bank["accounts"]]
+    sender = next(account for account in accounts if currency_id in account.balances)
+    recipient = next(account for account in accounts
+                     if to_currency_id in account.balances and account.owner.owner_id != sender.owner.owner_id)
+    return sender, recipient
+
+def state(engine, *accounts) -> list:
+    return [(account.balances.copy(), len(account.transactions)) for account in
+            (engine.find_account_by_id(account.account_id) for account in accounts)]
+
+def test_cross_currency_transfers_credit_the_converted_amount(engine, currencies, data):
+    a, b, _ = currencies
+    publish(engine, a, b, "2.5")
+    sender, recipient = accounts_holding(engine, data, a.currency_id, b.currency_id)
+    [(sender_before, _), (recipient_before, _)] = state(engine, sender, recipient)
+    TransferEngine(engine, ExchangeRates(engine)).transfer(sender.owner.owner_id, {
+        "from": sender.account_id, "to": recipient.account_id, "currency": a.currency_id, "to_currency": b.currency_id, "amount": "1.00"})
+    [(sender_after, _), (recipient_after, _)] = state(engine, sender, recipient)
+    assert sender_after[a.currency_id] == sender_before[a.currency_id] - 100
+    assert recipient_after[b.currency_id] == recipient_before[b.currency_id] + 250
+    conversion = engine.find_account_by_id(recipient.account_id).transactions[-1].conversion
+    assert (conversion.from_amount, conversion.to_amount) == (100, 250)
+
+def test_conversions_beyond_the_storable_range_are_refused_whole(engine, currencies, data):
+    a, b, c = currencies
+    # Each rate is within bounds, but two hops multiply to 1e18
+    publish(engine, a, b, "1e9")
+    publish(engine, b, c, "1e9")
+    sender, recipient = accounts_holding(engine, data, a.currency_id, c.currency_id)
+    before = state(engine, sender, recipient)
+    with pytest.raises(TransferError, match="Converted amount is too large"):
+        TransferEngine(engine, ExchangeRates(engine)).transfer(sender.owner.owner_id, {
+            "from": sender.account_id, "to": recipient.account_id, "currency": a.currency_id, "to_currency": c.currency_id,
+            "amount": "1000.00"})
+    assert state(engine, sender, recipient) == before
+
+def test_recipient_balances_stay_storable(engine, currencies, data):
+    a = currencies[0]
+    sender, recipient = accounts_holding(engine, data, a.currency_id, a.currency_id)
+    engine.set_balance(recipient, a.currency_id, MAX_MINOR_UNITS - 10)
+    before = state(engine, sender, recipient)
+    transfers = TransferEngine(engine)
+    with pytest.raises(TransferError, match="Recipient balance"):
+        transfers.transfer(sender.owner.owner_id, {"from": sender.account_id, "to": recipient.account_id,
+                                                   "currency": a.currency_id, "amount": "0.11"})
+    assert state(engine, sender, recipient) == before
+    # Transfers in one batch count towards the limit together
+    results = transfers.transfer_batch(sender.owner.owner_id, [
+        {"from": sender.account_id, "to": recipient.account_id, "currency": a.currency_id, "amount": "0.06"},
+        {"from": sender.account_id, "to": recipient.account_id, "currency": a.currency_id, "amount": "0.05"},
+    ])
+    assert [result["status"] for result in results] == ["not_applied", "failed"]
+    transfers.transfer(sender.owner.owner_id, {"from": sender.account_id, "to": recipient.account_id,
+                                               "currency": a.currency_id, "amount": "0.10"})
+    assert engine.find_account_by_id(recipient.account_id).balances[a.currency_id] == MAX_MINOR_UNITS
+
+def test_engines_refuse_transfer_records_that_would_overflow(engine, currencies, data):
+    # The engines check every side before changing any, whatever reaches them
+    a, b, _ = currencies
+    sender, recipient = accounts_holding(engine, data, a.currency_id, b.currency_id)
+    before = state(engine, sender, recipient)
+    record = {"op": "transfer", "from": sender.account_id, "to": recipient.account_id, "currency_id": a.currency_id,
+              "amount": 1, "when": "2024-01-01 00:00:00.000000",
+              "conversion": {"from_currency_id": a.currency_id, "from_amount": 1, "to_currency_id": b.currency_id,
+                             "to_amount": 10 ** 30, "rate": "1e30", "via": []}}
+    with pytest.raises(ValueError):
+        engine.mutate(record)
+    assert state(engine, sender, recipient) == before
+
+@pytest.mark.parametrize("body, status", [
+    ({"rate": "1e30"}, 400),
+    ({"rate": "1e-30"}, 400),
+    ({"rate": "abc"}, 400),
+    ({"rate": "1.25"}, 200),
+])
+def test_rate_publishing_checks_the_rate(client, login, app_data, body, status):
+    bank = app_data["banks"][0]
+    response = client.post(f"/bank/{bank['bank_id']}/exchange_rates", headers=login(0), json={
+        "from": app_data["currencies"][0]["currency_id"], "to": app_data["currencies"][1]["currency_id"], **body})
+    assert response.status_code == status
+
+@pytest.mark.parametrize("body", [[1], "rate", None])
+def test_rate_publishing_refuses_bodies_that_are_not_objects(client, login, app_data, body):
+    response = client.post(f"/bank/{app_data['banks'][0]['bank_id']}/exchange_rates", headers=login(0), json=body)
+    assert response.status_code == 400
+
+@pytest.mark.parametrize("amount, status", [("10.00", 200), ("0", 400), ("-5", 400), ("1e30", 400), ("0.001", 400)])
+def test_quotes(client, login, app_data, amount, status):
+    bank = app_data["banks"][0]
+    a, b = app_data["currencies"][0]["currency_id"], app_data["currencies"][1]["currency_id"]
+    client.post(f"/bank/{bank['bank_id']}/exchange_rates", headers=login(0), json={"from": a, "to": b, "rate": "2"})
+    response = client.get("/info/exchange_rates/quote", query_string={"from": a, "to": b, "amount": amount})
+    assert response.status_code == status
+    if status == 200:
+        assert (response.json["from_amount"], response.json["to_amount"]) == ("10.00", "20.00")
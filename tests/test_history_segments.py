@@ -0,0 +1,69 @@
+import json
+import os
+import pytest
+from storage import JsonDataEngine
+
+def history_of(engine, account_id: str) -> list:
+    account = engine.find_account_by_id(account_id)
+    return [transaction.to_json() for transaction in account.transactions]
+
+@pytest.fixture
+def segmented(tmp_path, data, open_engine):
+    # An engine that has saved its histories into a history file next to the snapshot
+    engine = open_engine("json", data, str(tmp_path))
+    engine.history_segments = True
+    engine.save_data()
+    return engine
+
+def test_snapshots_are_self_contained_by_default(tmp_path, data, open_engine, accounts_of):
+    engine = open_engine("json", data, str(tmp_path))
+    engine.save_data()
+    with open(engine.file_path) as file:
+        saved = json.load(file)
+    assert "history_file" not in saved
+    assert [name for name in os.listdir(tmp_path) if ".history." in name] == []
+    account = accounts_of(saved)[0]
+    assert len(account["transactions"]) == len(accounts_of(data)[0]["transactions"])
+
+def test_segmented_histories_load_on_first_access(segmented, data, reopen, accounts_of):
+    expected = {account["account_id"]: history_of(segmented, account["account_id"]) for account in accounts_of(data)}
+    engine = reopen(segmented)
+    first, *others = accounts_of(data)
+    assert not engine.find_account_by_id(first["account_id"]).history_loaded
+    assert history_of(engine, first["account_id"]) == expected[first["account_id"]]
+    assert engine.find_account_by_id(first["account_id"]).history_loaded
+    assert not any(engine.find_account_by_id(account["account_id"]).history_loaded for account in others)
+    assert {account_id: history_of(engine, account_id) for account_id in expected} == expected
+
+def test_only_changed_histories_are_rewritten(segmented, data, accounts_of):
+    sender, recipient, untouched = (segmented.find_account_by_id(account["account_id"]) for account in accounts_of(data)[:3])
+    currency_id = next(iter(sender.balances))
+    segmented.set_balance(recipient, currency_id, recipient.balances.get(currency_id, 0))
+    segment = dict(untouched.history_segment)
+    history_size = segmented.history_size
+    segmented.transfer(sender, recipient, currency_id, 5)
+    segmented.save_data()
+    # The two changed histories are appended after everything already in the file
+    assert untouched.history_segment == segment
+    assert sender.history_segment["offset"] >= history_size
+    assert recipient.history_segment["offset"] >= history_size
+
+def test_transfers_after_a_segmented_save_survive_a_restart(segmented, data, reopen, accounts_of):
+    sender, recipient = (segmented.find_account_by_id(account["account_id"]) for account in accounts_of(data)[:2])
+    currency_id = next(iter(sender.balances))
+    segmented.set_balance(recipient, currency_id, recipient.balances.get(currency_id, 0))
+    segmented.transfer(sender, recipient, currency_id, 7)
+    segmented.save_data()
+    expected = history_of(segmented, sender.account_id)
+    engine = reopen(segmented)
+    assert history_of(engine, sender.account_id) == expected
+
+def test_saving_without_segments_writes_histories_back_inline(segmented, data, reopen, accounts_of):
+    engine = reopen(segmented)
+    assert not engine.history_segments
+    engine.save_data()
+    with open(engine.file_path) as file:
+        saved = json.load(file)
+    assert "history_file" not in saved
+    for account in accounts_of(saved):
+        assert account["transactions"] == history_of(engine, account["account_id"])
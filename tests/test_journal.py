@@ -0,0 +1,46 @@
+import json
+import os
+from transfers import TransferEngine
+
+def test_replay_restores_committed_records(tmp_path, data, open_engine, run_transfers, reopen):
+    engine = open_engine("journal", data, str(tmp_path), compact_every=1000)
+    run_transfers(TransferEngine(engine), data, threads=4, transfers=100)
+    engine.add_message(data["users"][0]["user_id"], "after the transfers")
+    expected = engine.data_model.to_json()
+    assert os.path.getsize(engine.journal_path) > 0
+
+    # Reopened without a final save, as after a crash
+    restarted = reopen(engine)
+    assert restarted.data_model.to_json() == expected
+    # The replayed records were folded into a new snapshot and the journal started over
+    assert os.path.getsize(restarted.journal_path) == 0
+    assert restarted.journal_seq == engine.journal_seq
+
+def test_replay_skips_records_already_compacted(tmp_path, data, open_engine, run_transfers, reopen):
+    # Compacting every 7 records leaves a journal whose records partly precede the snapshot
+    engine = open_engine("journal", data, str(tmp_path), compact_every=7)
+    run_transfers(TransferEngine(engine), data, threads=4, transfers=60)
+    expected = engine.data_model.to_json()
+
+    assert reopen(engine).data_model.to_json() == expected
+
+def test_torn_tail_is_dropped(tmp_path, data, open_engine, run_transfers, release, reopen):
+    engine = open_engine("journal", data, str(tmp_path), compact_every=1000)
+    run_transfers(TransferEngine(engine), data, threads=2, transfers=20)
+    expected = engine.data_model.to_json()
+    release(engine)
+
+    # A record cut off halfway through its write
+    account_id = data["banks"][0]["accounts"][0]["account_id"]
+    torn = json.dumps({"op": "balance", "account_id": account_id, "currency_id": "x", "balance": 1, "seq": engine.journal_seq + 1})
+    with open(engine.journal_path, "a") as file:
+        file.write(torn[:len(torn) // 2])
+
+    restarted = reopen(engine)
+    assert restarted.data_model.to_json() == expected
+
+    # Records committed after the restart are replayed on the next one, not lost behind the torn line
+    sender, recipient = restarted.find_user_accounts(data["users"][1]["user_id"])
+    restarted.transfer(sender, recipient, next(c for c in sender.balances if c in recipient.balances), 5)
+    expected = restarted.data_model.to_json()
+    assert reopen(restarted).data_model.to_json() == expected
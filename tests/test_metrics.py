@@ -0,0 +1,65 @@
+import pytest
+from metrics import MetricsRegistry, SlowRequestProfiler
+
+def test_histograms_render_cumulative_buckets():
+    registry = MetricsRegistry()
+    registry.describe("op_seconds", "histogram", "Time per op")
+    for value in (0.00005, 0.003, 0.003, 20.0):
+        registry.observe("op_seconds", value, op="load")
+    lines = registry.render().splitlines()
+    assert lines[:2] == ["# HELP op_seconds Time per op", "# TYPE op_seconds histogram"]
+    assert 'op_seconds_bucket{op="load",le="0.0001"} 1' in lines
+    assert 'op_seconds_bucket{op="load",le="0.005"} 3' in lines
+    assert 'op_seconds_bucket{op="load",le="10.0"} 3' in lines
+    assert 'op_seconds_bucket{op="load",le="+Inf"} 4' in lines
+    assert 'op_seconds_count{op="load"} 4' in lines
+
+def test_counters_gauges_and_label_escaping():
+    registry = MetricsRegistry()
+    registry.increment("requests_total", route='/a"b', status=200)
+    registry.increment("requests_total", 2, route='/a"b', status=200)
+    registry.add_collector(lambda: [("cache_entries", {}, 7)])
+    text = registry.render()
+    assert 'requests_total{route="/a\\"b",status="200"} 3' in text
+    assert "# TYPE cache_entries gauge\ncache_entries 7" in text
+
+def test_instrumented_methods_are_timed_per_instance():
+    class Store:
+        def find(self, key):
+            return key * 2
+
+    registry = MetricsRegistry()
+    store = Store()
+    registry.instrument(store, ("find", "missing"), "store_seconds")
+    assert store.find(21) == 42
+    assert registry.histogram("store_seconds", op="find").count == 1
+    assert "missing" not in registry.render()
+    assert Store().find(1) == 2 and registry.histogram("store_seconds", op="find").count == 1
+
+def test_the_profiler_keeps_only_the_slowest_requests(tmp_path):
+    profiler = SlowRequestProfiler(str(tmp_path), keep=2)
+    for seconds in (0.3, 0.1, 0.5, 0.2):
+        profile = profiler.start()
+        # Only one request is profiled at a time
+        assert profiler.start() is None
+        profiler.finish(profile, seconds, "/user/balance")
+    assert sorted(seconds for seconds, _ in profiler.slowest) == [0.3, 0.5]
+    assert len(list(tmp_path.iterdir())) == 2
+
+@pytest.mark.parametrize("path", ["/metrics", "/info/token_cache"])
+def test_operational_endpoints_answer_localhost(client, path):
+    for address in ("127.0.0.1", "::1"):
+        assert client.get(path, environ_base={"REMOTE_ADDR": address}).status_code == 200
+
+@pytest.mark.parametrize("path", ["/metrics", "/info/token_cache"])
+def test_operational_endpoints_refuse_other_addresses(client, path):
+    response = client.get(path, environ_base={"REMOTE_ADDR": "10.0.0.5"})
+    assert response.status_code == 403
+    assert response.json == {"error": "Not permitted from this address"}
+
+def test_requests_show_up_in_the_metrics(client):
+    client.get("/info/banks")
+    text = client.get("/metrics").get_data(as_text=True)
+    assert "# TYPE bank_request_seconds histogram" in text
+    assert 'bank_requests_total{route="/info/banks",method="GET",status="200"}' in text
+    assert "bank_token_cache_entries " in text
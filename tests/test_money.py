@@ -0,0 +1,107 @@
+import copy
+import json
+import pytest
+from models import MONEY_FORMAT, DataModel
+from money import MAX_MINOR_UNITS, format_amount, parse_amount, parse_legacy_amount
+from storage import JsonDataEngine
+
+@pytest.mark.parametrize("value, scale, minor", [
+    (100.0 - 99.9, 2, 10),   # 0.09999999999999432
+    (0.1 + 0.2, 2, 30),      # 0.30000000000000004
+    (1e-17, 2, 0),
+    (0.125, 2, 12),          # Half to even
+    (0.135, 2, 14),
+    (-12.345, 2, -1234),
+    (7, 0, 7),
+    ("19.99", 2, 1999),
+    (2.5, 0, 2),
+])
+def test_legacy_amounts_round_half_even(value, scale, minor):
+    assert parse_legacy_amount(value, scale) == minor
+
+@pytest.mark.parametrize("value", ["abc", "", None, True, float("nan"), float("inf"), [1]])
+def test_legacy_amounts_reject_non_numbers(value):
+    with pytest.raises(ValueError):
+        parse_legacy_amount(value)
+
+def test_api_amounts_stay_strict():
+    assert parse_amount("0.10") == 10
+    with pytest.raises(ValueError):
+        parse_amount(100.0 - 99.9)
+
+@pytest.mark.parametrize("value", ["1e999999999", "-1e999999999", "1e30", 1e300, "92233720368547758.08", format_amount(-MAX_MINOR_UNITS - 1)])
+def test_amounts_beyond_the_history_range_are_invalid(value):
+    # Overflowing the decimal context or the 64-bit history columns is a ValueError like any other bad amount
+    with pytest.raises(ValueError):
+        parse_amount(value)
+    with pytest.raises(ValueError):
+        parse_legacy_amount(value)
+
+def test_largest_storable_amount_is_accepted():
+    assert parse_amount(format_amount(MAX_MINOR_UNITS)) == MAX_MINOR_UNITS
+    assert parse_amount(format_amount(-MAX_MINOR_UNITS)) == -MAX_MINOR_UNITS
+
+def legacy_file(data: dict) -> dict:
+    # The same data as an older version stored it: float balances and no money_format
+    legacy = copy.deepcopy(data)
+    del legacy["money_format"]
+    for bank in legacy["banks"]:
+        for account in bank["accounts"]:
+            for balance in account["balance"]:
+                balance["balance"] /= 100
+            for transaction in account["transactions"]:
+                transaction["currency"]["previous_balance"] /= 100
+                transaction["currency"]["new_balance"] /= 100
+    return legacy
+
+def test_legacy_file_is_upgraded_on_load(tmp_path, data):
+    legacy = legacy_file(data)
+    account = legacy["banks"][0]["accounts"][0]
+    account["balance"][0]["balance"] = 100.0 - 99.9
+    account["transactions"][0]["currency"]["previous_balance"] = 0.1 + 0.2
+    file_path = tmp_path / "data.json"
+    file_path.write_text(json.dumps(legacy))
+
+    engine = JsonDataEngine(file_path=str(file_path))
+    engine.load_data()
+    loaded = engine.find_account_by_id(account["account_id"])
+    assert loaded.balances[account["balance"][0]["currency_id"]] == 10
+    assert loaded.transactions[0].previous_balance == 30
+    expected = DataModel.from_json(copy.deepcopy(data)).to_json()
+    expected["banks"][0]["accounts"][0]["balance"][0]["balance"] = 10
+    expected["banks"][0]["accounts"][0]["transactions"][0]["currency"]["previous_balance"] = 30
+    assert engine.data_model.to_json() == expected
+
+    # Saved in the current format, which loads as it is
+    engine.save_data()
+    saved = json.loads(file_path.read_text())
+    assert saved["money_format"] == MONEY_FORMAT
+    assert DataModel.from_json(saved).to_json() == expected
+
+def test_legacy_file_with_bad_amount_is_refused(tmp_path, data):
+    legacy = legacy_file(data)
+    legacy["banks"][0]["accounts"][0]["balance"][0]["balance"] = "abc"
+    file_path = tmp_path / "data.json"
+    file_path.write_text(json.dumps(legacy))
+
+    with pytest.raises(ValueError):
+        JsonDataEngine(file_path=str(file_path)).load_data()
+
+def own_accounts(app_data, user: int) -> list:
+    return [a for bank in app_data["banks"] for a in bank["accounts"] if a["owner"]["owner_id"] == app_data["users"][user]["user_id"]]
+
+@pytest.mark.parametrize("amount", ["1e999999999", "1e30", "abc", "0.001"])
+def test_bad_amounts_are_refused_by_the_api(client, login, app_data, amount):
+    sender, recipient = own_accounts(app_data, 2)
+    currency_id = next(b["currency_id"] for b in sender["balance"] if b["currency_id"] in {c["currency_id"] for c in recipient["balance"]})
+    headers = login(2)
+
+    response = client.post("/user/transaction", headers=headers, json={"from": sender["account_id"], "to": recipient["account_id"],
+                                                                      "currency": currency_id, "amount": amount})
+    assert (response.status_code, response.json) == (400, {"error": "Invalid amount"})
+    response = client.post("/user/standing_orders", headers=headers, json={"from": sender["account_id"], "to": recipient["account_id"],
+                                                                          "currency": currency_id, "amount": amount, "interval": "day"})
+    assert response.status_code == 400
+    other = next(c["currency_id"] for c in app_data["currencies"] if c["currency_id"] != currency_id)
+    response = client.get("/info/exchange_rates/quote", query_string={"from": currency_id, "to": other, "amount": amount})
+    assert response.status_code == 400
@@ -0,0 +1,164 @@
+import base64
+import json
+import random
+import pytest
+from transfers import TransferEngine
+
+@pytest.fixture(scope="module", params=["json", "journal", "sqlite"])
+def dataset(request, tmp_path_factory, generate_data, open_engine, run_transfers):
+    # Read-only for the tests, so each engine is set up once for the module
+    data = generate_data(users=12, banks=3, accounts_per_user=2, transactions_per_account=20, currencies_per_account=2)
+    engine = open_engine(request.param, data, str(tmp_path_factory.mktemp(request.param)))
+    # New rows on top of the loaded ones, recorded on both sides of each transfer
+    run_transfers(TransferEngine(engine), data, threads=2, transfers=200)
+    for user in data["users"][::2]:
+        for n in range(3):
+            engine.add_message(user["user_id"], f"message {n} from {user['name']}")
+    return request.param, engine, data
+
+def transaction_row(account_id, transaction) -> tuple:
+    return account_id, json.dumps(transaction.to_json(), sort_keys=True)
+
+def all_transactions(engine, user_id, account_id=None, since=None, until=None, currency_id=None, counterparty=None) -> list:
+    # Every matching row, read straight from the account histories
+    rows = []
+    for account in engine.find_user_accounts(user_id):
+        if account_id is not None and account.account_id != account_id:
+            continue
+        for transaction in account.transactions:
+            if since is not None and transaction.when < since:
+                continue
+            if until is not None and transaction.when > until:
+                continue
+            if currency_id is not None and transaction.currency_id != currency_id:
+                continue
+            if counterparty is not None and counterparty not in (transaction.from_id, transaction.to_id):
+                continue
+            rows.append(transaction_row(account.account_id, transaction))
+    return sorted(rows)
+
+def paged(find, limit: int, expected: int, **filters) -> list:
+    # Every page in turn until the cursor runs out; a cursor that stops advancing fails instead of looping
+    items = []
+    cursor = None
+    for _ in range(expected // limit + 2):
+        page, cursor = find(limit=limit, cursor=cursor, **filters)
+        assert len(page) <= limit
+        items.extend(page)
+        if cursor is None:
+            return items
+        # A cursor is only handed out with a full page
+        assert len(page) == limit
+    pytest.fail(f"more than {expected} items paged for {filters}")
+
+@pytest.mark.parametrize("limit", [1, 3, 7, 500])
+def test_find_transactions_pages_match_full_scan(dataset, limit):
+    engine_type, engine, data = dataset
+    rng = random.Random(limit)
+    for user in rng.sample(data["users"], 4):
+        user_id = user["user_id"]
+        accounts = engine.find_user_accounts(user_id)
+        transactions = [t for account in accounts for t in account.transactions]
+        assert transactions
+        whens = sorted(t.when for t in transactions)
+        some = rng.choice(transactions)
+        cases = [
+            {},
+            {"account_id": accounts[-1].account_id},
+            {"currency_id": some.currency_id},
+            {"counterparty": some.to_id if some.to_id not in {a.account_id for a in accounts} else some.from_id},
+            {"counterparty": accounts[0].account_id},
+            {"since": whens[len(whens) // 3], "until": whens[2 * len(whens) // 3]},
+            {"since": whens[len(whens) // 2], "currency_id": some.currency_id},
+            {"until": whens[0][:4] + "-12-31 00:00:00.000000", "counterparty": some.from_id},
+        ]
+        for filters in cases:
+            expected = all_transactions(engine, user_id, **filters)
+            page = paged(lambda **kwargs: engine.find_transactions(user_id, **kwargs), limit, len(expected), **filters)
+            assert sorted(transaction_row(*item) for item in page) == expected, filters
+            if engine_type != "sqlite":
+                # The JSON engines merge the accounts newest first
+                assert [t.when for _, t in page] == sorted((t.when for _, t in page), reverse=True)
+
+@pytest.mark.parametrize("limit", [1, 2, 4, 500])
+def test_find_messages_pages_match_full_scan(dataset, limit):
+    engine_type, engine, data = dataset
+    rng = random.Random(limit)
+    for user in rng.sample(data["users"], 6):
+        user_id = user["user_id"]
+        accounts = engine.find_user_accounts(user_id)
+        messages = [(account.account_id, message.owner.owner_id, message.data) for account in accounts for message in account.messages]
+        cases = [{}, {"account_id": accounts[0].account_id}, {"counterparty": user_id}, {"counterparty": data["users"][2]["user_id"]}]
+        for filters in cases:
+            expected = sorted(row for row in messages if (filters.get("account_id") in (None, row[0]) and
+                                                         filters.get("counterparty") in (None, row[1])))
+            page = paged(lambda **kwargs: engine.find_messages(user_id, **kwargs), limit, len(expected), **filters)
+            assert sorted((account_id, message.owner.owner_id, message.data) for account_id, message in page) == expected, filters
+
+@pytest.mark.parametrize("cursor", [
+    {"positions": {"account": "x"}},
+    {"positions": {"account": -1}},
+    {"positions": {"account": 1.5}},
+    {"positions": {"account": True}},
+    {"positions": [1]},
+    {"positions": None},
+    {"id": 3},
+    {},
+])
+def test_json_engines_refuse_tampered_cursors(dataset, cursor):
+    engine_type, engine, _ = dataset
+    if engine_type == "sqlite":
+        pytest.skip("SQLite cursors are row ids")
+    with pytest.raises(ValueError):
+        engine.check_cursor(cursor)
+
+@pytest.mark.parametrize("cursor", [{"id": "x"}, {"id": -1}, {"id": 2.5}, {"id": False}, {"positions": {}}, {}])
+def test_sqlite_refuses_tampered_cursors(dataset, cursor):
+    engine_type, engine, _ = dataset
+    if engine_type != "sqlite":
+        pytest.skip("JSON engine cursors are row positions")
+    with pytest.raises(ValueError):
+        engine.check_cursor(cursor)
+
+def test_handed_out_cursors_are_accepted(dataset):
+    _, engine, data = dataset
+    user_id = data["users"][0]["user_id"]
+    for find in (engine.find_transactions, engine.find_messages):
+        _, cursor = find(user_id, limit=1)
+        engine.check_cursor(json.loads(json.dumps(cursor)))
+
+def encoded(cursor) -> str:
+    return base64.urlsafe_b64encode(json.dumps(cursor).encode()).decode()
+
+@pytest.mark.parametrize("path", ["/user/transactions", "/user/messages"])
+@pytest.mark.parametrize("cursor", [
+    encoded({"positions": {"account": "x"}}),
+    encoded({"positions": [1]}),
+    encoded({"positions": {"account": -4}}),
+    encoded([1]),
+    encoded("x"),
+    "not base64!",
+    encoded("x")[:-2] + "\xff",
+])
+def test_api_answers_tampered_cursors_with_400(client, login, path, cursor):
+    response = client.get(path, headers=login(3), query_string={"cursor": cursor})
+    assert response.status_code == 400
+    assert response.json == {"error": "Invalid query: malformed cursor"}
+
+@pytest.mark.parametrize("path, key", [("/user/transactions", "transactions"), ("/user/messages", "messages")])
+def test_api_pages_follow_next_cursor(client, login, app_module, app_data, path, key):
+    headers = login(4)
+    app_module.data_engine.add_message(app_data["users"][4]["user_id"], "one")
+    app_module.data_engine.add_message(app_data["users"][4]["user_id"], "two")
+    everything = client.get(path, headers=headers, query_string={"limit": 500}).json[key]
+    items = []
+    cursor = None
+    while True:
+        query = {"limit": 2} if cursor is None else {"limit": 2, "cursor": cursor}
+        body = client.get(path, headers=headers, query_string=query).json
+        items.extend(body[key])
+        cursor = body["next_cursor"]
+        if cursor is None:
+            break
+    assert items == everything
+    assert items
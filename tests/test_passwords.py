@@ -0,0 +1,62 @@
+import threading
+import pytest
+from passwords import PasswordHasher, PasswordPoolBusy, hash_password, verify_password
+
+def test_hashes_verify_only_their_own_password():
+    stored = hash_password("secret", n=16)
+    assert stored.startswith("scrypt$16$8$1$")
+    assert verify_password("secret", stored)
+    assert not verify_password("Secret", stored)
+    # Salted, so the same password never hashes the same way twice
+    assert hash_password("secret", n=16) != stored
+
+def test_legacy_plaintext_passwords_still_verify():
+    assert verify_password("password1", "password1")
+    assert not verify_password("password1", "password2")
+
+def test_plaintext_and_weaker_hashes_need_a_rehash():
+    hasher = PasswordHasher(n=32, workers=1)
+    assert hasher.needs_rehash("password1")
+    assert hasher.needs_rehash(hash_password("secret", n=16))
+    assert not hasher.needs_rehash(hasher.hash("secret"))
+
+def test_a_full_pool_turns_checks_away():
+    hasher = PasswordHasher(n=16, workers=1, max_pending=1)
+    started, release = threading.Event(), threading.Event()
+    blocked = threading.Thread(target=hasher.run, args=(lambda: (started.set(), release.wait()),))
+    blocked.start()
+    started.wait()
+    try:
+        with pytest.raises(PasswordPoolBusy):
+            hasher.verify("secret", "secret")
+    finally:
+        release.set()
+        blocked.join()
+    assert hasher.verify("secret", "secret")
+
+def test_login_upgrades_plaintext_passwords(client, app_module):
+    # Other tests may have logged this user in already
+    app_module.data_engine.set_password(app_module.data_engine.find_user("user2@example.com"), "password2")
+    response = client.post("/user/login", json={"email": "user2@example.com", "password": "password2"})
+    assert response.status_code == 200
+    stored = app_module.data_engine.find_user("user2@example.com").password
+    assert stored.startswith("scrypt$16$")
+    assert "password2" not in stored
+    # The upgraded hash is what later logins check
+    assert client.post("/user/login", json={"email": "user2@example.com", "password": "password2"}).status_code == 200
+    assert app_module.data_engine.find_user("user2@example.com").password == stored
+
+def test_login_rehashes_outdated_hashes(client, app_module):
+    user = app_module.data_engine.find_user("user5@example.com")
+    app_module.data_engine.set_password(user, hash_password("password5", n=32))
+    assert client.post("/user/login", json={"email": "user5@example.com", "password": "password5"}).status_code == 200
+    assert app_module.data_engine.find_user("user5@example.com").password.startswith("scrypt$16$")
+
+@pytest.mark.parametrize("email, password", [("user6@example.com", "password7"), ("nobody@example.com", "password6")])
+def test_login_refuses_bad_credentials(client, app_module, email, password):
+    stored = app_module.data_engine.find_user("user6@example.com").password
+    response = client.post("/user/login", json={"email": email, "password": password})
+    assert response.status_code == 401
+    assert response.json == {"error": "Invalid credentials"}
+    # A failed login leaves the stored password alone
+    assert app_module.data_engine.find_user("user6@example.com").password == stored
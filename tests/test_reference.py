@@ -0,0 +1,71 @@
+import json
+import pytest
+from models import Currency
+from reference import ReferenceData
+
+@pytest.fixture
+def engine(tmp_path, data, open_engine):
+    return open_engine("json", data, str(tmp_path))
+
+def new_currency(engine, code: str) -> Currency:
+    bank = engine.find_banks()[0]
+    currency = Currency(f"currency-{code}", f"Currency {code}", code, "¤", bank.bank_id, "2024-01-01 00:00:00.000000")
+    engine.add_currency(currency)
+    return currency
+
+def test_responses_are_cached_until_their_data_changes(engine, data):
+    reference = ReferenceData(engine)
+    banks, currencies = reference.get("banks"), reference.get("currencies")
+    assert reference.get("banks") is banks and reference.get("currencies") is currencies
+
+    # New accounts and transfers leave the reference data alone
+    account = engine.find_user_accounts(data["users"][0]["user_id"])[0]
+    engine.set_balance(account, next(iter(account.balances)), 1)
+    assert reference.get("banks") is banks
+
+    currency = new_currency(engine, "NEW")
+    assert reference.get("banks") is banks
+    body, etag = reference.get("currencies")
+    assert etag != currencies[1]
+    assert currency.currency_id in [c["currency_id"] for c in json.loads(body)["currencies"]]
+
+def test_etags_are_derived_from_the_content(engine):
+    assert ReferenceData(engine).get("banks") == ReferenceData(engine).get("banks")
+
+def test_a_reload_drops_every_response(engine):
+    reference = ReferenceData(engine)
+    for name in ("banks", "currencies", "exchange_rates"):
+        reference.get(name)
+    reference.on_commit([{"op": "reload"}])
+    assert reference.responses == {}
+
+def test_a_response_rendered_across_a_change_is_not_kept(engine, monkeypatch):
+    reference = ReferenceData(engine)
+    render = reference.render
+
+    def render_then_change(name):
+        # A currency commits after the old list was read but before it was cached
+        rendered = render(name)
+        monkeypatch.setattr(reference, "render", render)
+        new_currency(engine, "RACE")
+        return rendered
+
+    monkeypatch.setattr(reference, "render", render_then_change)
+    stale, _ = reference.get("currencies")
+    assert "currency-RACE" not in stale.decode()
+    assert "currencies" not in reference.responses
+    fresh, _ = reference.get("currencies")
+    assert "currency-RACE" in fresh.decode()
+
+def test_published_rates_show_up_in_the_rate_list(client, login, app_module, app_data):
+    before = client.get("/info/exchange_rates")
+    bank = app_data["banks"][0]
+    own, other = app_data["currencies"][0]["currency_id"], app_data["currencies"][1]["currency_id"]
+    assert app_data["currencies"][0]["bank_id"] == bank["bank_id"]
+    response = client.post(f"/bank/{bank['bank_id']}/exchange_rates", headers=login(0),
+                           json={"from": own, "to": other, "rate": "1.2345"})
+    assert response.status_code == 200
+    after = client.get("/info/exchange_rates", headers={"If-None-Match": before.headers["ETag"]})
+    assert after.status_code == 200
+    assert {"from": own, "to": other, "rate": "1.2345"}.items() <= next(
+        rate for rate in after.json["exchange_rates"] if (rate["from"], rate["to"]) == (own, other)).items()
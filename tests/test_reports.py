@@ -0,0 +1,129 @@
+from datetime import datetime
+import pytest
+from reports import BankReports, period_bounds
+from transfers import TransferEngine
+
+PREFIX = {"day": 10, "month": 7, "year": 4}
+
+@pytest.fixture(params=["json", "sqlite"])
+def dataset(request, tmp_path, generate_data, open_engine, run_transfers):
+    data = generate_data(users=10, banks=3, accounts_per_user=2, transactions_per_account=10, currencies_per_account=2)
+    engine = open_engine(request.param, data, str(tmp_path))
+    # Rows that actually move money, on top of the generated ones that leave balances as they were
+    run_transfers(TransferEngine(engine), data, threads=1, transfers=200)
+    return engine, data
+
+@pytest.fixture(params=[False, True], ids=["python", "numpy"])
+def use_numpy(request):
+    if request.param:
+        pytest.importorskip("numpy")
+    return request.param
+
+def bank_accounts(engine, data, bank_id) -> list:
+    return [account for user in data["users"] for account in engine.find_user_accounts(user["user_id"]) if account.bank_id == bank_id]
+
+def expected_balances(engine, data, bank_id) -> dict:
+    # Worked out account by account
+    report = {}
+    for account in bank_accounts(engine, data, bank_id):
+        for currency_id, balance in account.balances.items():
+            totals = report.setdefault(currency_id, {"total": 0, "accounts": 0, "balances": []})
+            totals["total"] += balance
+            totals["accounts"] += 1
+            totals["balances"].append(balance)
+    return report
+
+def expected_volume(engine, data, bank_id, period) -> dict:
+    # Worked out row by row from the account histories
+    report = {}
+    for account in bank_accounts(engine, data, bank_id):
+        for transaction in account.transactions:
+            totals = report.setdefault(transaction.when[:PREFIX[period]], {}).setdefault(transaction.currency_id, [0, 0, 0])
+            delta = transaction.new_balance - transaction.previous_balance
+            totals[0 if delta >= 0 else 1] += abs(delta)
+            totals[2] += 1
+    return report
+
+def check_balances(reports, engine, data, bank_id):
+    report = reports.balances(bank_id)
+    expected = expected_balances(engine, data, bank_id)
+    assert sorted(report) == sorted(expected)
+    for currency_id, totals in report.items():
+        assert (totals["total"], totals["accounts"]) == (expected[currency_id]["total"], expected[currency_id]["accounts"])
+        assert [balance for _, balance in totals["top"]] == sorted(expected[currency_id]["balances"], reverse=True)
+
+def test_reports_match_the_accounts(dataset, use_numpy):
+    engine, data = dataset
+    reports = BankReports(engine, use_numpy=use_numpy)
+    for bank in data["banks"]:
+        check_balances(reports, engine, data, bank["bank_id"])
+        for period in PREFIX:
+            assert reports.volume(bank["bank_id"], period) == expected_volume(engine, data, bank["bank_id"], period)
+    assert any(totals[0] for bank in data["banks"] for day in reports.volume(bank["bank_id"], "day").values() for totals in day.values())
+
+def test_reports_follow_commits(dataset, use_numpy):
+    engine, data = dataset
+    reports = BankReports(engine, use_numpy=use_numpy)
+    bank_id = data["banks"][0]["bank_id"]
+    check_balances(reports, engine, data, bank_id)
+    before = reports.volume(bank_id, "day")
+
+    sender = bank_accounts(engine, data, bank_id)[0]
+    currency_id = next(iter(sender.balances))
+    recipient = next(account for account in bank_accounts(engine, data, bank_id)
+                     if currency_id in account.balances and account.account_id != sender.account_id)
+    TransferEngine(engine).transfer(sender.owner.owner_id, {"from": sender.account_id, "to": recipient.account_id,
+                                                            "currency": currency_id, "amount": 12345})
+    check_balances(reports, engine, data, bank_id)
+    after = reports.volume(bank_id, "day")
+    assert after == expected_volume(engine, data, bank_id, "day")
+    # Only today's totals were computed again
+    today = datetime.now().strftime("%Y-%m-%d")
+    assert after[today][currency_id][:2] >= [12345, 12345]
+    assert {key: totals for key, totals in after.items() if key != today} == {key: totals for key, totals in before.items() if key != today}
+
+def test_period_bounds():
+    assert period_bounds("day", "2024-02-28") == ("2024-02-28 00:00:00.000000", "2024-02-28 23:59:59.999999")
+    assert period_bounds("month", "2024-02") == ("2024-02-01 00:00:00.000000", "2024-02-29 23:59:59.999999")
+    assert period_bounds("year", "2023") == ("2023-01-01 00:00:00.000000", "2023-12-31 23:59:59.999999")
+
+def test_report_endpoints_need_an_admin(client, login, app_data):
+    bank_id = app_data["banks"][0]["bank_id"]
+    for report in ("deposits", "top_accounts", "volume"):
+        path = f"/bank/{bank_id}/reports/{report}"
+        assert client.get(path).status_code == 401
+        assert client.get(path, headers=login(1)).status_code == 403
+        # user0 administers bank 0 only
+        assert client.get(f"/bank/{app_data['banks'][1]['bank_id']}/reports/{report}", headers=login(0)).status_code == 403
+        assert client.get(f"/bank/no-such-bank/reports/{report}", headers=login(0)).status_code == 404
+        assert client.get(path, headers=login(0)).status_code == 200
+
+def test_report_endpoints(client, login, app_module, app_data):
+    headers = login(0)
+    bank_id = app_data["banks"][0]["bank_id"]
+    engine = app_module.data_engine
+    expected = expected_balances(engine, app_data, bank_id)
+
+    deposits = client.get(f"/bank/{bank_id}/reports/deposits", headers=headers).json["deposits"]
+    assert sorted(deposit["currency_id"] for deposit in deposits) == sorted(expected)
+    for deposit in deposits:
+        scale = engine.find_currency_by_id(deposit["currency_id"]).scale
+        assert deposit["total"] == app_module.format_amount(expected[deposit["currency_id"]]["total"], scale)
+        assert deposit["accounts"] == expected[deposit["currency_id"]]["accounts"]
+
+    currency_id = deposits[0]["currency_id"]
+    top = client.get(f"/bank/{bank_id}/reports/top_accounts?limit=2&currency={currency_id}", headers=headers).json["top_accounts"]
+    assert [entry["currency_id"] for entry in top] == [currency_id]
+    assert len(top[0]["accounts"]) == min(2, expected[currency_id]["accounts"])
+    for query in ("limit=0", "limit=101", "limit=many"):
+        assert client.get(f"/bank/{bank_id}/reports/top_accounts?{query}", headers=headers).status_code == 400
+
+    volume = client.get(f"/bank/{bank_id}/reports/volume?period=month", headers=headers).json
+    assert volume["period"] == "month"
+    expected_rows = expected_volume(engine, app_data, bank_id, "month")
+    assert [(row["period"], row["currency_id"], row["count"]) for row in volume["volume"]] == \
+           [(key, currency, totals[2]) for key in sorted(expected_rows) for currency, totals in sorted(expected_rows[key].items())]
+    assert client.get(f"/bank/{bank_id}/reports/volume?since=2023-12-01T00:00:00&until=2023-12-31T00:00:00",
+                      headers=headers).status_code == 200
+    for query in ("period=week", "since=yesterday"):
+        assert client.get(f"/bank/{bank_id}/reports/volume?{query}", headers=headers).status_code == 400
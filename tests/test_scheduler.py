@@ -0,0 +1,135 @@
+import logging
+import threading
+from datetime import datetime, timedelta
+import pytest
+from models import WHEN_FORMAT, StandingOrder
+from scheduler import PaymentScheduler
+from transfers import TransferEngine, TransferError
+
+@pytest.fixture(params=["json", "sqlite"])
+def engine(request, tmp_path, data, open_engine):
+    return open_engine(request.param, data, str(tmp_path))
+
+@pytest.fixture
+def scheduler(engine):
+    scheduler = PaymentScheduler(engine, TransferEngine(engine))
+    scheduler.load()
+    return scheduler
+
+@pytest.fixture
+def accounts(engine, data):
+    # A sender and another user's account holding the sender's first currency
+    sender = engine.find_user_accounts(data["users"][0]["user_id"])[0]
+    currency_id = next(iter(sender.balances))
+    recipient = engine.find_user_accounts(data["users"][1]["user_id"])[0]
+    engine.set_balance(recipient, currency_id, recipient.balances.get(currency_id, 0))
+    return engine.find_account_by_id(sender.account_id), engine.find_account_by_id(recipient.account_id), currency_id
+
+def order_data(accounts, **fields) -> dict:
+    sender, recipient, currency_id = accounts
+    return {"from": sender.account_id, "to": recipient.account_id, "currency": currency_id, "amount": "1.00",
+            "interval": "day", **fields}
+
+def later(**delta) -> str:
+    return (datetime.now() + timedelta(**delta)).strftime(WHEN_FORMAT)
+
+@pytest.mark.parametrize("fields, error", [
+    ({"every": 0}, "every must be"),
+    ({"every": 1001}, "every must be"),
+    ({"every": True}, "every must be"),
+    ({"every": "2"}, "every must be"),
+    ({"interval": "fortnight"}, "interval must be"),
+    ({"start": "2001-01-01T00:00:00"}, "in the past"),
+    ({"start": "2200-01-01T00:00:00"}, "start must be within"),
+    ({"start": "next tuesday"}, "Invalid start time"),
+    ({"start": 12}, "Invalid start time"),
+    ({"amount": "0"}, "Invalid amount"),
+])
+def test_create_refuses_bad_orders(scheduler, engine, accounts, fields, error):
+    with pytest.raises(TransferError, match=error):
+        scheduler.create(accounts[0].owner.owner_id, order_data(accounts, **fields))
+    assert engine.find_standing_orders() == []
+
+def test_zoned_start_times_are_stored_in_utc(scheduler, accounts):
+    start = (datetime.now() + timedelta(days=30)).replace(hour=12, minute=0, second=0, microsecond=0)
+    order = scheduler.create(accounts[0].owner.owner_id, order_data(accounts, start=start.isoformat() + "+02:00"))
+    assert order.start == start.replace(hour=10).strftime(WHEN_FORMAT)
+
+def test_missed_runs_are_caught_up(scheduler, engine, accounts):
+    sender, recipient, currency_id = accounts
+    before = sender.balances[currency_id], recipient.balances[currency_id]
+    order = scheduler.create(sender.owner.owner_id, order_data(accounts, every=2))
+    assert scheduler.run_due(later(days=6, hours=1)) == 4
+    stored = engine.find_standing_order(order.order_id)
+    assert (stored.runs, stored.last_status) == (4, "applied")
+    assert engine.find_account_by_id(sender.account_id).balances[currency_id] == before[0] - 400
+    assert engine.find_account_by_id(recipient.account_id).balances[currency_id] == before[1] + 400
+    # Nothing is due again until the next run
+    assert scheduler.run_due(later(days=6, hours=2)) == 0
+
+def test_failed_runs_are_recorded_and_the_order_moves_on(scheduler, engine, accounts):
+    sender, _, currency_id = accounts
+    order = scheduler.create(sender.owner.owner_id, order_data(accounts))
+    engine.set_balance(sender, currency_id, 50)
+    assert scheduler.run_due(later(hours=1)) == 1
+    stored = engine.find_standing_order(order.order_id)
+    assert (stored.runs, stored.last_status) == (1, "Insufficient balance in the sender account")
+    assert engine.find_account_by_id(sender.account_id).balances[currency_id] == 50
+
+def test_an_order_that_cannot_run_is_cancelled_without_stopping_the_rest(scheduler, engine, accounts, caplog):
+    sender, recipient, currency_id = accounts
+    now = datetime.now().strftime(WHEN_FORMAT)
+    # Stored before orders were bounded: its second run would fall after the year 9999
+    broken = StandingOrder("broken", sender.account_id, recipient.account_id, currency_id, None, 100, "month", 1000000, now, 0, now)
+    engine.add_standing_order(broken)
+    good = scheduler.create(sender.owner.owner_id, order_data(accounts))
+    with caplog.at_level(logging.ERROR, logger="scheduler"):
+        assert scheduler.run_due(later(hours=1)) == 1
+    assert "Standing order broken cannot be run" in caplog.text
+    assert engine.find_standing_order("broken") is None
+    assert engine.find_standing_order(good.order_id).runs == 1
+    assert scheduler.run_due(later(days=1, hours=1)) == 1
+
+def test_run_forever_logs_failures_and_keeps_going(scheduler, monkeypatch, caplog):
+    calls = []
+
+    def run_due():
+        calls.append(1)
+        if len(calls) == 1:
+            raise RuntimeError("disk full")
+        scheduler.stop()
+        return 0
+
+    monkeypatch.setattr(scheduler, "run_due", run_due)
+    scheduler.retry_interval = 0
+    scheduler.heap = [("2000-01-01 00:00:00.000000", "due", 0)]
+    scheduler.running = True
+    with caplog.at_level(logging.ERROR, logger="scheduler"):
+        thread = threading.Thread(target=scheduler.run_forever)
+        thread.start()
+        thread.join(5)
+    assert not thread.is_alive()
+    assert len(calls) == 2
+    assert "Standing orders failed" in caplog.text and "disk full" in caplog.text
+
+def test_standing_order_endpoints(client, login, app_data):
+    headers = login(5)
+    sender = next(account for bank in app_data["banks"] for account in bank["accounts"]
+                  if account["owner"]["owner_id"] == app_data["users"][5]["user_id"])
+    currency_id = sender["balance"][0]["currency_id"]
+    body = {"from": sender["account_id"], "to": sender["account_id"], "currency": currency_id, "amount": "2.50",
+            "interval": "week", "start": later(days=3)}
+    for bad in ([body], "order", None, {**body, "every": 1000000}, {**body, "start": "2999-01-01T00:00:00"}):
+        assert client.post("/user/standing_orders", headers=headers, json=bad).status_code == 400
+
+    created = client.post("/user/standing_orders", headers=headers, json=body)
+    assert created.status_code == 200
+    order = created.json["standing_order"]
+    assert (order["amount"], order["interval"], order["runs"]) == ("2.50", "week", 0)
+    listed = client.get("/user/standing_orders", headers=headers).json["standing_orders"]
+    assert order["order_id"] in [o["order_id"] for o in listed]
+
+    cancel = f"/user/standing_orders/{order['order_id']}/cancel"
+    assert client.post(cancel, headers=login(6)).status_code == 404
+    assert client.post(cancel, headers=headers).status_code == 200
+    assert client.post(cancel, headers=headers).status_code == 404
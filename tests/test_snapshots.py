@@ -0,0 +1,57 @@
+import logging
+import os
+import subprocess
+import sys
+import pytest
+from storage import JsonDataEngine, convert_snapshot
+from transfers import TransferEngine
+
+BACKEND = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "backend")
+
+def load(file_path: str) -> dict:
+    engine = JsonDataEngine(file_path=file_path)
+    engine.load_data()
+    model = engine.data_model.to_json()
+    engine.close()
+    return model
+
+@pytest.mark.parametrize("engine_type", ["json", "journal"])
+def test_convert_round_trip(tmp_path, data, open_engine, run_transfers, engine_type):
+    # A journal left behind is folded into the converted snapshot
+    engine = open_engine(engine_type, data, str(tmp_path), **({"compact_every": 1000} if engine_type == "journal" else {}))
+    run_transfers(TransferEngine(engine), data, threads=2, transfers=50)
+    engine.add_message(data["users"][0]["user_id"], "before the conversion")
+    expected = engine.data_model.to_json()
+    engine.close()
+
+    # Through the binary format, with its history file beside the snapshot, and back to one JSON file
+    binary_path = str(tmp_path / "data.bin")
+    convert_snapshot(engine.file_path, binary_path, "binary")
+    with open(binary_path, "rb") as file:
+        assert file.read(1) != b"{"
+    assert load(binary_path) == expected
+
+    json_path = str(tmp_path / "converted.json")
+    convert_snapshot(binary_path, json_path, "json")
+    assert load(json_path) == expected
+    # The JSON snapshot is self-contained: it loads with the binary files gone
+    for name in os.listdir(tmp_path):
+        if name.startswith("data.bin"):
+            os.remove(tmp_path / name)
+    assert load(json_path) == expected
+
+def test_saves_are_logged_not_printed(tmp_path, data, open_engine, capsys, caplog):
+    engine = open_engine("json", data, str(tmp_path))
+    with caplog.at_level(logging.INFO, logger="storage"):
+        engine.save_data()
+    assert "Data saved" in caplog.text
+    assert capsys.readouterr().out == ""
+
+def test_convert_command_prints_one_line(tmp_path, data, open_engine):
+    engine = open_engine("json", data, str(tmp_path))
+    engine.close()
+    target = str(tmp_path / "data.bin")
+    result = subprocess.run([sys.executable, "storage.py", "convert", engine.file_path, target, "--format", "binary"],
+                            cwd=BACKEND, capture_output=True, text=True, check=True)
+    assert result.stdout == f"Converted {engine.file_path} to {target} (binary)\n"
+    assert load(target) == load(engine.file_path)
@@ -0,0 +1,61 @@
+import json
+import pytest
+from transfers import TransferEngine, TransferError
+
+@pytest.fixture
+def engines(tmp_path, data, open_engine):
+    # The same data imported into SQLite and loaded by the JSON engine
+    (tmp_path / "json").mkdir()
+    return open_engine("sqlite", data, str(tmp_path)), open_engine("json", data, str(tmp_path / "json"))
+
+def model_of(engine, data, accounts_of) -> dict:
+    accounts = {}
+    for account in accounts_of(data):
+        stored = engine.find_account_by_id(account["account_id"]).to_json()
+        # SQLite lists an account's balances in key order rather than the order they were added in
+        stored["balance"].sort(key=lambda balance: balance["currency_id"])
+        accounts[stored["account_id"]] = json.dumps(stored, sort_keys=True)
+    return {
+        "users": sorted(json.dumps(engine.find_user(user["email"]).to_json(), sort_keys=True) for user in data["users"]),
+        "currencies": sorted(json.dumps(currency.to_json(), sort_keys=True) for currency in engine.find_currencies()),
+        "banks": sorted(json.dumps(bank.info_json(), sort_keys=True) for bank in engine.find_banks()),
+        "accounts": accounts,
+    }
+
+def test_import_matches_the_json_engine(engines, data, accounts_of):
+    sqlite, json_engine = engines
+    assert model_of(sqlite, data, accounts_of) == model_of(json_engine, data, accounts_of)
+    user = data["users"][3]
+    assert sorted(a.account_id for a in sqlite.find_user_accounts(user["user_id"])) == \
+        sorted(a.account_id for a in json_engine.find_user_accounts(user["user_id"]))
+    assert sqlite.find_user("nobody@example.com") is None
+    assert sqlite.find_account_by_id("missing") is None
+
+def test_transfers_survive_a_restart(engines, data, accounts_of, reopen):
+    sqlite, _ = engines
+    account = accounts_of(data)[0]
+    sender = sqlite.find_account_by_id(account["account_id"])
+    recipient = next(sqlite.find_account_by_id(a["account_id"]) for a in accounts_of(data)[1:]
+                     if account["balance"][0]["currency_id"] in {b["currency_id"] for b in a["balance"]})
+    currency_id = account["balance"][0]["currency_id"]
+    TransferEngine(sqlite).transfer(account["owner"]["owner_id"], {"from": sender.account_id, "to": recipient.account_id,
+                                                                   "currency": currency_id, "amount": "12.34"})
+    expected = model_of(sqlite, data, accounts_of)
+
+    restarted = reopen(sqlite)
+    assert model_of(restarted, data, accounts_of) == expected
+    assert restarted.find_account_by_id(sender.account_id).balances[currency_id] == account["balance"][0]["balance"] - 1234
+
+def test_failed_write_transaction_rolls_back(engines, data, accounts_of):
+    sqlite, _ = engines
+    account = accounts_of(data)[0]
+    currency_id = account["balance"][0]["currency_id"]
+    before = model_of(sqlite, data, accounts_of)
+    sender = sqlite.find_account_by_id(account["account_id"])
+
+    with pytest.raises(TransferError):
+        with sqlite.write_transaction():
+            sqlite.transfer(sender, sender, currency_id, 5)
+            raise TransferError("Rejected after the write")
+
+    assert model_of(sqlite, data, accounts_of) == before
@@ -0,0 +1,70 @@
+import time
+import jwt
+import pytest
+from tokens import TokenCache
+
+SECRET = "test-secret-long-enough-for-hs256!!"
+
+def token_for(user_id: str, expires_in: float = 3600) -> str:
+    return jwt.encode({"user_id": user_id, "exp": int(time.time() + expires_in)}, SECRET, algorithm="HS256")
+
+def test_verified_tokens_are_cached():
+    cache = TokenCache(SECRET, dict)
+    token = token_for("alice")
+    assert cache.verify(token) == "alice"
+    assert cache.verify(token) == "alice"
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert cache.verify(token + "x") is None
+    assert cache.verify(token_for("alice", expires_in=-10)) is None
+
+def test_the_cache_evicts_the_least_recently_used_token():
+    cache = TokenCache(SECRET, dict, max_size=2)
+    first, second, third = (token_for(name) for name in ("a", "b", "c"))
+    for token in (first, second, first, third):
+        cache.verify(token)
+    assert cache.digest(second) not in cache.entries
+    assert cache.digest(first) in cache.entries
+
+def test_revoked_tokens_are_rejected_even_when_cached():
+    cache = TokenCache(SECRET, dict)
+    token = token_for("alice")
+    assert cache.verify(token) == "alice"
+    cache.on_commit([cache.revocation(token)])
+    assert cache.verify(token) is None
+    assert cache.verify(token_for("alice", expires_in=7200)) == "alice"
+    assert cache.stats()["revoked"] == 1
+
+def test_stored_revocations_are_loaded_at_startup_and_on_reload():
+    token = token_for("alice")
+    stored = {}
+    cache = TokenCache(SECRET, lambda: dict(stored))
+    assert cache.verify(token) == "alice"
+    revocation = TokenCache(SECRET, dict).revocation(token)
+    stored[revocation["digest"]] = revocation["exp"]
+    # Another worker's logout this one fell too far behind to see
+    cache.on_commit([{"op": "reload"}])
+    assert cache.verify(token) is None
+    assert TokenCache(SECRET, lambda: dict(stored)).verify(token) is None
+
+@pytest.mark.parametrize("engine_type", ["json", "journal", "sqlite"])
+def test_revocations_survive_a_restart(tmp_path, data, open_engine, reopen, engine_type):
+    engine = open_engine(engine_type, data, str(tmp_path))
+    cache = TokenCache(SECRET, engine.find_revoked_tokens)
+    token = token_for("alice")
+    expired = {"op": "revoke", "digest": "00" * 32, "exp": time.time() - 1}
+    engine.mutate(expired)
+    engine.mutate(cache.revocation(token))
+    engine = reopen(engine)
+    assert list(engine.find_revoked_tokens()) == [cache.digest(token).hex()]
+    assert TokenCache(SECRET, engine.find_revoked_tokens).verify(token) is None
+
+def test_logout_revokes_the_token(client, login, app_module):
+    headers = login(1)
+    assert client.get("/user/balance", headers=headers).status_code == 200
+    assert client.post("/user/logout", headers=headers).status_code == 200
+    assert client.get("/user/balance", headers=headers).status_code == 401
+    assert client.post("/user/logout", headers=headers).status_code == 401
+    # What a restarted worker would load
+    digest = app_module.token_cache.digest(headers["Authorization"].split()[1]).hex()
+    assert digest in app_module.data_engine.find_revoked_tokens()
+    assert client.get("/user/balance", headers=login(1)).status_code == 200
@@ -0,0 +1,78 @@
+import pytest
+from transfers import TransferEngine
+
+@pytest.fixture(scope="module", params=["json", "journal", "sqlite"])
+def dataset(request, tmp_path_factory, generate_data, open_engine, run_transfers):
+    data = generate_data(users=10, banks=3, accounts_per_user=2, transactions_per_account=30, currencies_per_account=2)
+    engine = open_engine(request.param, data, str(tmp_path_factory.mktemp(request.param)))
+    # Rows that actually move money, on top of the generated ones that leave balances as they were
+    run_transfers(TransferEngine(engine), data, threads=2, transfers=300)
+    return request.param, engine, data
+
+PREFIX = {"day": 10, "month": 7, "year": 4}
+
+def expected_totals(engine, user_id, period, account_id=None, since=None, until=None, currency_id=None, counterparty=None) -> list:
+    # The same sums worked out row by row from the account histories
+    totals = {}
+    for account in engine.find_user_accounts(user_id):
+        if account_id is not None and account.account_id != account_id:
+            continue
+        for transaction in account.transactions:
+            if since is not None and transaction.when < since or until is not None and transaction.when > until:
+                continue
+            if currency_id is not None and transaction.currency_id != currency_id:
+                continue
+            if counterparty is not None and counterparty not in (transaction.from_id, transaction.to_id):
+                continue
+            total = totals.setdefault((transaction.when[:PREFIX[period]], transaction.currency_id), [0, 0, 0])
+            delta = transaction.new_balance - transaction.previous_balance
+            total[0 if delta >= 0 else 1] += abs(delta)
+            total[2] += 1
+    return [{"period": key[0], "currency_id": key[1], "in": total[0], "out": total[1], "count": total[2]}
+            for key, total in sorted(totals.items())]
+
+@pytest.mark.parametrize("period", ["day", "month", "year"])
+def test_totals_match_the_histories(dataset, period):
+    _, engine, data = dataset
+    for user in data["users"]:
+        totals = engine.transaction_totals(user["user_id"], period)
+        assert totals == expected_totals(engine, user["user_id"], period)
+    assert any(total["in"] or total["out"] for user in data["users"] for total in engine.transaction_totals(user["user_id"], period))
+
+def test_filtered_totals_match_the_histories(dataset, accounts_of):
+    _, engine, data = dataset
+    user_id = data["users"][1]["user_id"]
+    account = engine.find_user_accounts(user_id)[0]
+    currency_id = next(iter(account.balances))
+    other = accounts_of(data)[-1]["account_id"]
+    for filters in (
+        {"account_id": account.account_id},
+        {"currency_id": currency_id},
+        {"since": "2023-12-09 13:50:00.000000", "until": "2023-12-09 14:00:00.000000"},
+        {"since": "2024-01-01 00:00:00.000000"},
+        {"counterparty": other},
+        {"counterparty": account.account_id},
+        {"account_id": account.account_id, "currency_id": currency_id, "counterparty": other},
+    ):
+        assert engine.transaction_totals(user_id, "day", **filters) == expected_totals(engine, user_id, "day", **filters), filters
+
+def test_users_without_transactions_have_no_totals(dataset):
+    _, engine, _ = dataset
+    assert engine.transaction_totals("nobody", "month") == []
+
+def test_summary_endpoint_formats_amounts(client, login, app_module):
+    headers = login(4)
+    response = client.get("/user/transactions/summary", headers=headers, query_string={"period": "year"})
+    assert response.status_code == 200
+    assert response.json["period"] == "year"
+    user_id = app_module.data_engine.find_user("user4@example.com").user_id
+    expected = expected_totals(app_module.data_engine, user_id, "year")
+    assert [(total["period"], total["currency_id"], total["count"]) for total in response.json["totals"]] == \
+           [(total["period"], total["currency_id"], total["count"]) for total in expected]
+    assert all(isinstance(total["in"], str) and "." in total["in"] for total in response.json["totals"])
+
+@pytest.mark.parametrize("query", [{"period": "week"}, {"since": "yesterday"}, {"until": "2024-13-01"}])
+def test_summary_endpoint_refuses_bad_queries(client, login, query):
+    response = client.get("/user/transactions/summary", headers=login(4), query_string=query)
+    assert response.status_code == 400
+    assert response.json["error"].startswith("Invalid query")
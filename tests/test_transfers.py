@@ -0,0 +1,70 @@
+import threading
+import pytest
+from money import format_amount
+from transfers import TransferEngine, TransferError
+
+def snapshot_supply(snapshot: dict) -> dict:
+    totals = {}
+    for bank in snapshot["banks"]:
+        for account in bank["accounts"]:
+            for balance in account["balance"]:
+                totals[balance["currency_id"]] = totals.get(balance["currency_id"], 0) + balance["balance"]
+    return totals
+
+def watch_snapshots(engine) -> list:
+    # The money supply of every snapshot a JSON engine writes, read on its way to disk
+    supplies = []
+    write_snapshot = engine.write_snapshot
+    def checked_write(snapshot: dict):
+        supplies.append(snapshot_supply(snapshot))
+        write_snapshot(snapshot)
+    engine.write_snapshot = checked_write
+    return supplies
+
+@pytest.mark.parametrize("engine_type, options", [
+    ("json", {}),
+    ("journal", {"compact_every": 25}),
+    ("sqlite", {}),
+], ids=["json", "journal", "sqlite"])
+def test_concurrent_transfers_conserve_money(tmp_path, data, switch_interval, open_engine, money_supply, run_transfers, reopen,
+                                             engine_type, options):
+    engine = open_engine(engine_type, data, str(tmp_path), **options)
+    before = money_supply(engine, data)
+    snapshots = watch_snapshots(engine) if engine_type != "sqlite" else []
+
+    assert run_transfers(TransferEngine(engine), data, threads=8, transfers=400) > 0
+
+    assert money_supply(engine, data) == before
+    # Every snapshot written during the run holds whole transfers only
+    assert all(supply == before for supply in snapshots)
+    if engine_type != "sqlite":
+        assert snapshots
+    assert money_supply(reopen(engine), data) == before
+
+def test_overdrawing_transfers_are_refused_under_contention(tmp_path, data, switch_interval, open_engine):
+    # Many threads draining one account at once: it never goes below zero and exactly the affordable ones apply
+    engine = open_engine("json", data, str(tmp_path))
+    account = data["banks"][0]["accounts"][0]
+    currency_id = account["balance"][0]["currency_id"]
+    recipients = [a for bank in data["banks"] for a in bank["accounts"]
+                  if a is not account and currency_id in {b["currency_id"] for b in a["balance"]}]
+    transfer_engine = TransferEngine(engine)
+    # A tenth of the balance each, so exactly ten of the sixteen transfers can be afforded
+    amount = format_amount(account["balance"][0]["balance"] // 10)
+    results = []
+
+    def drain(recipient):
+        try:
+            transfer_engine.transfer(account["owner"]["owner_id"], {"from": account["account_id"], "to": recipient["account_id"],
+                                                                   "currency": currency_id, "amount": amount})
+            results.append(True)
+        except TransferError:
+            results.append(False)
+
+    threads = [threading.Thread(target=drain, args=(recipients[i % len(recipients)],)) for i in range(16)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results.count(True) == 10
+    assert engine.find_account_by_id(account["account_id"]).balances[currency_id] == 0
@@ -0,0 +1,69 @@
+import logging
+import sqlite3
+import threading
+import pytest
+from storage import JsonDataEngine, SqliteDataEngine
+
+@pytest.fixture
+def workers(tmp_path, data, open_engine):
+    # Two worker processes' engines on one database
+    first = open_engine("sqlite", data, str(tmp_path))
+    second = SqliteDataEngine(database_path=first.database_path, sync_interval=0)
+    second.load_data()
+    return first, second
+
+def test_workers_replay_each_others_commits(workers, data):
+    first, second = workers
+    seen = []
+    second.add_listener(seen.append)
+    user_id = data["users"][0]["user_id"]
+    account = first.find_user_accounts(user_id)[0]
+    currency_id = next(iter(account.balances))
+    first.set_balance(account, currency_id, 1234)
+
+    second.sync()
+    assert seen == [[{"op": "balance", "account_id": account.account_id, "currency_id": currency_id, "balance": 1234}]]
+    assert second.find_account_by_id(account.account_id).balances[currency_id] == 1234
+    # Already replayed records are not handed out again
+    second.sync()
+    assert len(seen) == 1
+
+def test_workers_that_fell_behind_reload(workers, data):
+    first, second = workers
+    seen = []
+    second.add_listener(seen.append)
+    account = first.find_user_accounts(data["users"][0]["user_id"])[0]
+    currency_id = next(iter(account.balances))
+    for balance in (1, 2, 3):
+        first.set_balance(account, currency_id, balance)
+    # The oldest changes were pruned before this worker saw them
+    first.connection.execute("DELETE FROM changes WHERE seq = (SELECT MIN(seq) FROM changes)")
+    second.sync()
+    assert [records[0]["op"] for records in seen] == ["reload", "balance", "balance"]
+
+def test_sync_failures_are_logged_and_retried(workers, monkeypatch, caplog):
+    _, second = workers
+    synced, stop = threading.Event(), threading.Event()
+    failures = [sqlite3.OperationalError("database is locked")]
+
+    def sync():
+        if failures:
+            raise failures.pop()
+        synced.set()
+        stop.wait()
+
+    monkeypatch.setattr(second, "sync", sync)
+    second.sync_interval = 0.001
+    with caplog.at_level(logging.ERROR, logger="storage"):
+        threading.Thread(target=second.sync_forever, daemon=True).start()
+        assert synced.wait(5)
+    # Leaves the daemon thread asleep between syncs
+    second.sync_interval = 3600
+    stop.set()
+    assert "Storage sync failed" in caplog.text
+    assert "database is locked" in caplog.text
+
+def test_json_files_refuse_a_second_process(tmp_path, data, open_engine):
+    engine = open_engine("json", data, str(tmp_path))
+    with pytest.raises(RuntimeError, match="in use by another process"):
+        JsonDataEngine(file_path=engine.file_path).load_data()